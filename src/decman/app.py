@@ -82,6 +82,24 @@ def main():
         default=False,
         help="force building of packages that are already cached",
     )
+    parser.add_argument(
+        "--refresh-aur-cache",
+        action="store_true",
+        default=False,
+        help="ignore cached AUR package information and fetch it again",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="continue a failed foreign package install from the first unfinished build",
+    )
+    parser.add_argument(
+        "--prune-sources",
+        action="store_true",
+        default=False,
+        help="remove least recently used sources from the source cache and exit",
+    )
 
     args = parser.parse_args()
 
@@ -110,7 +128,10 @@ def main():
         # When print cli option is used, show info output
         if args.print:
             conf.quiet_output = False
-        Core(store, opts).run()
+        if args.prune_sources:
+            _prune_sources()
+        else:
+            Core(store, opts).run()
     except err.UserFacingError as error:
         l.print_error(error.user_facing_msg)
         for line in traceback.format_exc().splitlines():
@@ -134,6 +155,21 @@ def main():
         sys.exit(2)
 
 
+def _prune_sources():
+    source_cache = fpm.SourceCache.from_config()
+    if source_cache is None:
+        l.print_info("Source cache is disabled.")
+        return
+
+    try:
+        removed, freed = source_cache.prune()
+    except OSError as error:
+        raise err.UserFacingError("Failed to prune the source cache.") from error
+    l.print_summary(
+        f"Removed {removed} cached sources, freed {freed / 1024**2:.1f} MiB."
+    )
+
+
 def _set_up(store: l.Store, args):
     source = store.source_file
     source_changed = False
@@ -185,6 +221,8 @@ def _set_up(store: l.Store, args):
         not args.no_commands,
         args.upgrade_devel,
         args.force_build,
+        args.refresh_aur_cache,
+        args.resume,
     )
 
 
@@ -203,55 +241,67 @@ class Core:
             self.run_commands,
             self.upgrade_devel,
             self.force_build,
+            self.refresh_aur_cache,
+            self.resume,
         ) = opts
 
         self.store = store
         self.source = _resolve_source()
         self.pacman = l.Pacman()
         self.systemctl = l.Systemd(store)
-        self.fpkg_search = fpm.ExtendedPackageSearch(self.pacman)
+        self.fpkg_search = fpm.ExtendedPackageSearch(
+            self.pacman, refresh_cache=self.refresh_aur_cache
+        )
 
         for upkg in self.source.all_user_pkgs():
             self.fpkg_search.add_user_pkg(
                 fpm.PackageInfo.from_user_package(upkg, self.pacman)
             )
 
-        self.fpm = fpm.ForeignPackageManager(store, self.pacman, self.fpkg_search)
+        self.fpm = fpm.ForeignPackageManager(
+            store, self.pacman, self.fpkg_search, resume=self.resume
+        )
 
     def run(self):
         """
         Run the main logic of decman.
         """
-        if self.update_units:
-            self._disable_units()
+        try:
+            if self.update_units:
+                self._disable_units()
 
-        if self.update_files:
-            self._create_and_remove_files()
+            if self.update_files:
+                self._create_and_remove_files()
 
-        if self.update_packages:
-            self._remove_pkgs()
-            self._upgrade_pkgs()
-            self._install_pkgs()
-            # Offer to remove orphan packages after package operations
-            if not self.only_print:
-                self._offer_remove_orphans()
-                # Optionally clean pacman cache automatically (safer -Sc)
-                self._offer_clean_pkg_cache()
-
-            # Optionally ensure niri-qml is installed (AUR or source), controlled by config
-            self._ensure_qml_niri()
-
-        if self.update_units:
-            self._enable_units()
-
-        if self.run_commands:
-            self._run_modules()
-            all_enabled_modules = {}
-            for mod, version in self.source.all_enabled_modules():
-                all_enabled_modules[mod] = version
-            # Enabled modules are really only stored for commands,
-            # so they can be set only when the commands were exacuted.
-            self.store.enabled_modules = all_enabled_modules
+            if self.update_packages:
+                self._remove_pkgs()
+                self._upgrade_pkgs()
+                self._install_pkgs()
+                # Offer to remove orphan packages after package operations
+                if not self.only_print:
+                    self._offer_remove_orphans()
+                    # Optionally clean pacman cache automatically (safer -Sc)
+                    self._offer_clean_pkg_cache()
+
+                # Optionally ensure niri-qml is installed (AUR or source), controlled by config
+                self._ensure_qml_niri()
+
+            if self.update_units:
+                self._enable_units()
+
+            if self.run_commands:
+                self._run_modules()
+                all_enabled_modules = {}
+                for mod, version in self.source.all_enabled_modules():
+                    all_enabled_modules[mod] = version
+                # Enabled modules are really only stored for commands,
+                # so they can be set only when the commands were exacuted.
+                self.store.enabled_modules = all_enabled_modules
+        finally:
+            self.fpkg_search.save_cache()
+            self.fpkg_search.print_rpc_statistics()
+            l.resource_usage.print_summary(self.store.resource_usage_history)
+            self.store.add_resource_usage(l.resource_usage)
 
     def _disable_units(self):
         to_disable = self.source.units_to_disable(self.store)
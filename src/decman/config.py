@@ -133,6 +133,25 @@ class Commands:
         """
         return ["git", "clone", repo, dest]
 
+    def git_clone_mirror(self, repo: str, dest: str) -> list[str]:
+        """
+        Running this command creates a bare mirror of a git repository to the given destination.
+        """
+        return ["git", "clone", "--mirror", repo, dest]
+
+    def git_fetch_mirror(self, repo: str) -> list[str]:
+        """
+        Running this command updates the mirror in the current directory from the given
+        repository. Only new objects are transferred.
+        """
+        return ["git", "fetch", "--prune", repo, "+refs/*:refs/*"]
+
+    def git_ls_remote(self, repo: str, ref: str) -> list[str]:
+        """
+        Running this command outputs the commit id of the given ref in a remote repository.
+        """
+        return ["git", "ls-remote", repo, ref]
+
     def git_diff(self, from_commit: str) -> list[str]:
         """
         Running this command outputs the difference between the given commit and
@@ -178,18 +197,33 @@ class Commands:
             "--noconfirm",
         ] + packages
 
-    def resolve_real_name(self, chroot_dir: str, pkg: str) -> list[str]:
+    def resolve_real_names(self, chroot_dir: str, pkgs: list[str]) -> list[str]:
         """
-        This command prints a real name of a package. For example, it prints the package which provides a virtual package.
+        This command prints the real names of packages inside the chroot. For example, it prints
+        the package which provides a virtual package.
+
+        Each package is printed on its own line as the given name and the real name separated by
+        a tab. The real name is empty if it can't be resolved.
         """
-        return [
-            "arch-nspawn",
-            chroot_dir,
-            "pacman",
-            "-Sddp",
-            "--print-format=%n",
-            pkg,
-        ]
+        script = (
+            'for pkg; do printf "%s\\t%s\\n" "$pkg" '
+            '"$(pacman -Sddp --print-format=%n -- "$pkg" 2>/dev/null | head -n 1)"; done'
+        )
+        return ["arch-nspawn", chroot_dir, "sh", "-c", script, "sh"] + pkgs
+
+    def upgrade_chroot(
+        self, chroot_dir: str, bind_mounts: typing.Optional[list[str]] = None
+    ) -> list[str]:
+        """
+        Running this command upgrades all packages in the given chroot.
+
+        The bind_mounts directories are mounted read-only to the same paths in the chroot.
+        """
+        return (
+            ["arch-nspawn", chroot_dir]
+            + [f"--bind-ro={directory}" for directory in bind_mounts or []]
+            + ["pacman", "-Syu", "--noconfirm"]
+        )
 
     def remove_chroot_packages(self, chroot_dir: str, packages: list[str]):
         """
@@ -198,20 +232,53 @@ class Commands:
         return ["arch-nspawn", chroot_dir, "pacman", "-Rsu", "--noconfirm"] + packages
 
     def make_chroot_pkg(
-        self, chroot_wd_dir: str, user: str, pkgfiles_to_install: list[str]
+        self,
+        chroot_wd_dir: str,
+        user: str,
+        pkgfiles_to_install: list[str],
+        working_copy: typing.Optional[str] = None,
+        bind_mounts: typing.Optional[list[str]] = None,
+        read_only_bind_mounts: typing.Optional[list[str]] = None,
     ) -> list[str]:
         """
         Running this command creates a package file using the given chroot.
         The package is created as the user and the pkg_files_to_install are installed
         in the chroot before the package is created.
+
+        When working_copy is given, the package is built in a copy of the chroot with that name.
+        The bind_mounts directories are mounted read-write and the read_only_bind_mounts
+        directories read-only to the same paths in the chroot.
         """
         makechrootpkg_cmd = ["makechrootpkg", "-c", "-r", chroot_wd_dir, "-U", user]
 
+        if working_copy is not None:
+            makechrootpkg_cmd += ["-l", working_copy]
+
+        for directory in bind_mounts or []:
+            makechrootpkg_cmd += ["-d", directory]
+
+        for directory in read_only_bind_mounts or []:
+            makechrootpkg_cmd += ["-D", directory]
+
         for pkgfile in pkgfiles_to_install:
             makechrootpkg_cmd += ["-I", pkgfile]
 
         return makechrootpkg_cmd
 
+    def repo_add(self, db_path: str, pkg_files: list[str]) -> list[str]:
+        """
+        Running this command adds the given package files to a pacman repository database.
+        Older versions of the packages are replaced in the database.
+        """
+        return ["repo-add", "--quiet", db_path] + pkg_files
+
+    def ccache_stats(self) -> list[str]:
+        """
+        Running this command outputs ccache statistics as tab separated key-value pairs. The cache
+        directory is given with the CCACHE_DIR environment variable.
+        """
+        return ["ccache", "--print-stats"]
+
 
 commands: Commands = Commands()
 debug_output: bool = False
@@ -243,11 +310,72 @@ print_pacman_output_highlights: bool = True
 
 makepkg_user: str = "nobody"
 build_dir: str = "/tmp/decman/build"
+# Directory of the master chroot used for building foreign packages. The chroot is kept between
+# runs and updated with 'pacman -Syu'. It is recreated when its packages, pacman_config_file or
+# makepkg_config_file change, or when a previous run didn't clean it up.
+build_chroot_dir: str = "/var/lib/decman/chroot"
+makepkg_config_file: str = "/etc/makepkg.conf"
+# Maximum number of foreign packages built at the same time. Packages that don't depend on each
+# other are built in separate copies of the build chroot when this is greater than 1.
+max_parallel_builds: int = 1
+# Maximum number of PKGBUILD repositories cloned at the same time.
+max_parallel_clones: int = 8
+# Compiler cache used when building foreign packages. When set to "ccache" or "sccache", the cache
+# is installed to the build chroot and compiler_cache_dir is mounted to builds, so that rebuilds
+# of large packages can reuse earlier compilation results.
+compiler_cache: typing.Optional[str] = None  # "ccache" | "sccache" | None
+compiler_cache_dir: str = "/var/cache/decman/compiler-cache"
+# Directory where makepkg stores downloaded sources (SRCDEST) and source packages (SRCPKGDEST)
+# between builds. When the cache is larger than source_cache_max_size bytes, the least recently
+# used sources are removed (0 means no limit). Set to None to download sources for every build.
+# Running decman with '--prune-sources' only prunes the cache.
+source_cache_dir: typing.Optional[str] = "/var/cache/decman/sources"
+source_cache_max_size: int = 20 * 1024**3
+# Directory where the VCS sources of devel packages (-git, -hg, ...) are kept between builds, one
+# directory per pkgbase. Upstream changes are then fetched incrementally. Devel packages with git
+# sources are only rebuilt when an upstream commit has changed since the previous build. Set to
+# None to use the source cache for devel packages too.
+devel_work_dir: typing.Optional[str] = "/var/lib/decman/devel"
 pkg_cache_dir: str = "/var/cache/decman"
+# Directory where the output of foreign package builds is written, one directory per pkgbase.
+# At most build_logs_kept logs are kept for each pkgbase. When a build fails, the last
+# build_log_tail_lines lines of its output are printed. Set to None to not write build logs.
+build_log_dir: typing.Optional[str] = "/var/log/decman/builds"
+build_logs_kept: int = 5
+build_log_tail_lines: int = 50
+# Number of runs whose resource usage is kept in the store. Wall time, CPU time and peak memory of
+# commands and package builds are printed at the end of a run and compared to the previous runs.
+resource_usage_history_size: int = 30
+# Name of the pacman repository of built foreign packages in pkg_cache_dir. The repository is
+# updated with repo-add and mounted to chroot builds, so makepkg installs foreign build
+# dependencies from it in one pacman transaction. Set to None to install them into the chroot
+# file by file with 'makechrootpkg -I' instead.
+local_repo_name: typing.Optional[str] = "decman"
+# Directory of bare mirrors of PKGBUILD repositories. Mirrors are updated with 'git fetch' and
+# cloned locally to build_dir, so only new commits are downloaded.
+pkgbuild_mirror_dir: str = "/var/cache/decman/pkgbuilds"
 aur_rpc_timeout: typing.Optional[int] = 30
+# Maximum number of kept-alive connections to the AUR. This is also the maximum number of concurrent
+# AUR RPC requests made while resolving dependencies.
+aur_rpc_pool_size: int = 4
+# Seconds that AUR package information is cached on disk in pkg_cache_dir. Upgrades of AUR packages
+# may be noticed up to this much later. Set to 0 to disable the cache. The cache can be refreshed
+# once with the '--refresh-aur-cache' argument.
+aur_cache_ttl: int = 3600
+# Path to a local copy of the AUR metadata dump (packages-meta-ext-v1.json.gz from
+# https://aur.archlinux.org/packages-meta-ext-v1.json.gz). When set, package information and
+# provider searches are answered from an index of the dump instead of the AUR RPC. The index is
+# stored in pkg_cache_dir and rebuilt when the dump changes.
+aur_metadata_dump: typing.Optional[str] = None
 enable_fpm: bool = True
 number_of_packages_stored_in_cache: int = 3
 
+# When true (default), decman reads pacman's databases directly instead of running pacman for every
+# package query. Pacman is still used when the databases can't be read.
+read_pacman_databases: bool = True
+pacman_config_file: str = "/etc/pacman.conf"
+pacman_db_path: str = "/var/lib/pacman"
+
 # Whether decman should use yay for AUR packages when available.
 # If enabled and yay is found, decman will use yay (run as SUDO_USER) to install/upgrade
 # declared AUR packages instead of the built-in foreign package manager.
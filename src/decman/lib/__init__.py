@@ -2,19 +2,24 @@
 Library module for decman.
 """
 
+import contextlib
 import json
 import os
 import pty
+import select
 import shutil
+import signal
 import subprocess
 import sys
 import threading
 import time
+import tty
 import typing
 
 import decman
 import decman.config as conf
 import decman.error as err
+from decman.lib import alpm
 
 _DECMAN_MSG_TAG = "[\033[1;35mDECMAN\033[m]"
 _RED_PREFIX = "\033[91m"
@@ -209,7 +214,15 @@ class Store:
         self.enabled_modules: dict[str, str] = {}
         self.created_files: list[str] = []
         self.pkgbuild_latest_reviewed_commits: dict[str, str] = {}
+        # Upstream commits of the VCS sources of the latest build of each devel pkgbase.
+        self.devel_upstream_commits: dict[str, dict[str, str]] = {}
+        # Package bases built by unfinished foreign package installs by install plan.
+        self.build_checkpoints: dict[str, dict[str, list[str]]] = {}
         self._package_file_cache: dict[str, list[tuple[str, str, int]]] = {}
+        # Build key, path and SHA-256 hash of the latest built file of each package.
+        self._package_build_keys: dict[str, tuple[str, str, str]] = {}
+        # Resource usage of child processes in previous runs, oldest first.
+        self.resource_usage_history: list[dict[str, typing.Any]] = []
 
     def add_enabled_user_systemd_unit(self, user: str, unit: str):
         """
@@ -274,6 +287,35 @@ class Store:
         )
         return (latest_version, latest_path)
 
+    def get_build_key(self, package: str) -> typing.Optional[tuple[str, str]]:
+        """
+        Returns the build key and the SHA-256 hash of the latest cached file of a package as a
+        tuple (key, sha256). Returns None if the file was cached without a build key.
+        """
+        entry = self.get_package(package)
+        record = self._package_build_keys.get(package)
+        if entry is None or record is None or record[1] != entry[1]:
+            return None
+        return (record[0], record[2])
+
+    def set_build_key(self, package: str, key: str, path: str, sha256: str):
+        """
+        Records the build key and the SHA-256 hash of a cached package file.
+        """
+        self._package_build_keys[package] = (key, path, sha256)
+
+    def add_resource_usage(self, accounting: "ResourceAccounting"):
+        """
+        Adds the resource usage of a run to the history. Only the latest
+        conf.resource_usage_history_size runs are kept.
+        """
+        if accounting.is_empty():
+            return
+        self.resource_usage_history.append(accounting.to_dict())
+        del self.resource_usage_history[
+            : max(0, len(self.resource_usage_history) - conf.resource_usage_history_size)
+        ]
+
     def add_package_to_cache(self, package: str, version: str, path_to_built_pkg: str):
         """
         Adds a built package to the package file cache. Tries to remove excess cached packages.
@@ -345,7 +387,11 @@ class Store:
             "enabled_modules": self.enabled_modules,
             "created_files": self.created_files,
             "package_file_cache": self._package_file_cache,
+            "package_build_keys": self._package_build_keys,
             "pkgbuild_git_commits": self.pkgbuild_latest_reviewed_commits,
+            "devel_upstream_commits": self.devel_upstream_commits,
+            "build_checkpoints": self.build_checkpoints,
+            "resource_usage_history": self.resource_usage_history,
         }
 
         try:
@@ -389,10 +435,14 @@ class Store:
                 store.enabled_modules = d.get("enabled_modules", {})
                 store.created_files = d.get("created_files", [])
                 store._package_file_cache = d.get("package_file_cache", {})
+                store._package_build_keys = d.get("package_build_keys", {})
                 store.pkgbuild_latest_reviewed_commits = d.get(
                     "pkgbuild_git_commits",
                     {},
                 )
+                store.devel_upstream_commits = d.get("devel_upstream_commits", {})
+                store.build_checkpoints = d.get("build_checkpoints", {})
+                store.resource_usage_history = d.get("resource_usage_history", [])
 
             return store
         except json.JSONDecodeError as e:
@@ -710,15 +760,81 @@ class Pacman:
 
     def __init__(self):
         self._installable = {}
+        self._sync_index: typing.Optional[alpm.SyncDbIndex] = None
+        self._sync_index_read = False
+        self._local_db: typing.Optional[alpm.LocalDb] = None
+        self._local_db_mtime = 0
+
+    def _get_sync_index(self) -> typing.Optional[alpm.SyncDbIndex]:
+        """
+        Returns an index of the sync databases. The databases are read only once.
+
+        Returns None if reading databases is disabled or fails.
+        """
+        if not conf.read_pacman_databases:
+            return None
+
+        if not self._sync_index_read:
+            self._sync_index_read = True
+            try:
+                self._sync_index = alpm.SyncDbIndex.load(
+                    conf.pacman_config_file, conf.pacman_db_path
+                )
+                print_debug(
+                    f"Read {len(self._sync_index.packages)} packages from sync databases."
+                )
+            except OSError as e:
+                print_debug(f"Failed to read sync databases: {e}")
+                print_debug("Falling back to pacman for package queries.")
+
+        return self._sync_index
+
+    def _invalidate_sync_index(self):
+        self._installable = {}
+        self._sync_index = None
+        self._sync_index_read = False
+
+    def _get_local_db(self) -> typing.Optional[alpm.LocalDb]:
+        """
+        Returns a snapshot of the local database. The snapshot is read again only when the
+        database has changed.
+
+        Returns None if reading databases is disabled or fails.
+        """
+        if not conf.read_pacman_databases:
+            return None
+
+        try:
+            # Adding or removing packages changes the mtime of the directory. Changing the
+            # install reason doesn't, so methods doing that invalidate the snapshot themselves.
+            mtime = os.stat(os.path.join(conf.pacman_db_path, "local")).st_mtime_ns
+            if self._local_db is None or self._local_db_mtime != mtime:
+                self._local_db = alpm.LocalDb.load(conf.pacman_db_path)
+                self._local_db_mtime = mtime
+                print_debug(
+                    f"Read {len(self._local_db.packages)} packages from the local database."
+                )
+        except OSError as e:
+            print_debug(f"Failed to read the local database: {e}")
+            print_debug("Falling back to pacman for package queries.")
+            self._local_db = None
+
+        return self._local_db
+
+    def _invalidate_local_db(self):
+        self._local_db = None
 
     def get_installed(self) -> list[str]:
         """
-        Returns a list of installed packages.
+        Returns a list of explicitly installed packages.
         """
+        local_db = self._get_local_db()
+        if local_db is not None:
+            return local_db.explicitly_installed()
 
         try:
             packages = (
-                subprocess.run(
+                run_command(
                     conf.commands.list_pkgs(),
                     check=True,
                     stdout=subprocess.PIPE,
@@ -740,23 +856,47 @@ class Pacman:
         if dep in self._installable:
             return self._installable[dep]
 
-        result = (
-            subprocess.run(
-                conf.commands.is_installable(dep), check=False, capture_output=True
-            ).returncode
-            == 0
-        )
+        index = self._get_sync_index()
+        if index is not None:
+            result = index.is_satisfiable(dep)
+        else:
+            result = (
+                run_command(
+                    conf.commands.is_installable(dep), check=False, capture_output=True
+                ).returncode
+                == 0
+            )
+
         self._installable[dep] = result
         return result
 
+    def get_satisfier_version(self, dep: str) -> typing.Optional[str]:
+        """
+        Returns the name and version of the package that satisfies a dependency in the sync
+        databases. Returns None if it can't be determined.
+        """
+        index = self._get_sync_index()
+        if index is None:
+            return None
+
+        pkg = index.find_satisfier(dep)
+        if pkg is None:
+            return None
+        return f"{pkg.name} {pkg.version}"
+
     def get_versioned_foreign_packages(self) -> list[tuple[str, str]]:
         """
         Returns a list of installed packages and their versions that aren't from pacman databases,
         basically AUR packages.
         """
+        local_db = self._get_local_db()
+        index = self._get_sync_index()
+        if local_db is not None and index is not None:
+            return [(pkg.name, pkg.version) for pkg in local_db.foreign(index)]
+
         try:
             output = (
-                subprocess.run(
+                run_command(
                     conf.commands.list_foreign_pkgs_versioned(),
                     check=True,
                     stdout=subprocess.PIPE,
@@ -787,6 +927,7 @@ class Pacman:
         returncode, output = echo_and_capture_command(
             conf.commands.install_pkgs(packages)
         )
+        self._invalidate_local_db()
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to install packages using pacman. Process exited with code {returncode}."
@@ -796,7 +937,7 @@ class Pacman:
 
         if packages:
             try:
-                subprocess.run(
+                run_command(
                     conf.commands.set_as_explicitly_installed(packages),
                     check=True,
                     capture_output=conf.suppress_command_output,
@@ -816,6 +957,7 @@ class Pacman:
             return
 
         returncode, output = echo_and_capture_command(conf.commands.install_deps(deps))
+        self._invalidate_local_db()
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to install packages as dependencies using pacman. Process exited with code {returncode}."
@@ -834,6 +976,7 @@ class Pacman:
         returncode, output = echo_and_capture_command(
             conf.commands.install_files(files)
         )
+        self._invalidate_local_db()
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to install package files using pacman. Process exited with code {returncode}."
@@ -843,7 +986,7 @@ class Pacman:
 
         if as_explicit:
             try:
-                subprocess.run(
+                run_command(
                     conf.commands.set_as_explicitly_installed(as_explicit),
                     check=True,
                     capture_output=conf.suppress_command_output,
@@ -860,6 +1003,11 @@ class Pacman:
         Upgrades all packages.
         """
         returncode, output = echo_and_capture_command(conf.commands.upgrade())
+
+        # The sync databases were refreshed
+        self._invalidate_sync_index()
+        self._invalidate_local_db()
+
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to upgrade packages using pacman. Process exited with code {returncode}."
@@ -875,6 +1023,7 @@ class Pacman:
             return
 
         returncode, output = echo_and_capture_command(conf.commands.remove(packages))
+        self._invalidate_local_db()
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to remove packages using pacman. Process exited with code {returncode}."
@@ -886,8 +1035,12 @@ class Pacman:
         """
         Returns a list of orphaned packages (installed as dependencies, not required).
         """
+        local_db = self._get_local_db()
+        if local_db is not None:
+            return local_db.orphans()
+
         try:
-            result = subprocess.run(
+            result = run_command(
                 conf.commands.list_orphans(), check=False, stdout=subprocess.PIPE
             )
             output = result.stdout.decode().strip()
@@ -912,6 +1065,7 @@ class Pacman:
         returncode, output = echo_and_capture_command(
             conf.commands.remove_orphans(packages)
         )
+        self._invalidate_local_db()
         if returncode != 0:
             raise err.UserFacingError(
                 f"Failed to remove orphan packages using pacman. Process exited with code {returncode}."
@@ -947,18 +1101,51 @@ def echo_and_capture_command(program: list[str]) -> tuple[int, str]:
 
     Returns a tuple containing the return code of the program as well as all output of the program.
     """
-
-    output = ""
-
-    def read(fd):
-        nonlocal output
-        buffer = os.read(fd, 1024)
-        output += buffer.decode(encoding="utf-8")
-        return buffer
-
-    returncode = os.waitstatus_to_exitcode(pty.spawn(program, read))
-
-    return (returncode, output)
+    started = time.monotonic()
+    pid, master_fd = pty.fork()
+    if pid == pty.CHILD:
+        try:
+            os.execvp(program[0], program)
+        finally:
+            os._exit(127)  # pylint: disable=protected-access
+
+    output = []
+    stdin_mode = None
+    try:
+        stdin_mode = tty.tcgetattr(pty.STDIN_FILENO)
+        tty.setraw(pty.STDIN_FILENO)
+    except tty.error:
+        pass
+
+    # Same as pty.spawn, which can't be used since it reaps the program itself.
+    try:
+        fds = [master_fd, pty.STDIN_FILENO]
+        while True:
+            readable, _, _ = select.select(fds, [], [])
+            if master_fd in readable:
+                try:
+                    data = os.read(master_fd, 1024)
+                except OSError:
+                    # Reading fails with EIO once the program has exited.
+                    data = b""
+                if not data:
+                    break
+                os.write(pty.STDOUT_FILENO, data)
+                output.append(data)
+            if pty.STDIN_FILENO in readable:
+                data = os.read(pty.STDIN_FILENO, 1024)
+                if data:
+                    os.write(master_fd, data)
+                else:
+                    fds.remove(pty.STDIN_FILENO)
+    finally:
+        if stdin_mode is not None:
+            tty.tcsetattr(pty.STDIN_FILENO, tty.TCSAFLUSH, stdin_mode)
+        os.close(master_fd)
+
+    returncode = reap_child(pid, program, started)
+
+    return (returncode, b"".join(output).decode(encoding="utf-8", errors="replace"))
 
 
 class Systemd:
@@ -977,7 +1164,7 @@ class Systemd:
             return
 
         try:
-            subprocess.run(
+            run_command(
                 conf.commands.enable_units(units),
                 check=True,
                 capture_output=conf.suppress_command_output,
@@ -996,7 +1183,7 @@ class Systemd:
             return
 
         try:
-            subprocess.run(
+            run_command(
                 conf.commands.disable_units(units),
                 check=True,
                 capture_output=conf.suppress_command_output,
@@ -1019,7 +1206,7 @@ class Systemd:
             return
 
         try:
-            subprocess.run(
+            run_command(
                 conf.commands.enable_user_units(units, user),
                 check=True,
                 capture_output=conf.suppress_command_output,
@@ -1040,7 +1227,7 @@ class Systemd:
             return
 
         try:
-            subprocess.run(
+            run_command(
                 conf.commands.disable_user_units(units, user),
                 check=True,
                 capture_output=conf.suppress_command_output,
@@ -1052,3 +1239,271 @@ class Systemd:
 
         for unit in units:
             self.state.remove_enabled_user_systemd_unit(user, unit)
+
+
+def reap_child(
+    pid: int,
+    command: list[str],
+    started: float,
+    timeout: typing.Optional[float] = None,
+) -> int:
+    """
+    Waits for a child process with wait4 and records its resource usage.
+
+    Returns the exit code of the process. Processes killed by a signal have a negative exit code.
+
+    Raises:
+        subprocess.TimeoutExpired
+            If timeout is given and the process ran longer than timeout seconds. The process is
+            killed and reaped before raising.
+    """
+    options = 0 if timeout is None else os.WNOHANG
+    timed_out = False
+    while True:
+        reaped, status, rusage = os.wait4(pid, options)
+        if reaped != 0:
+            break
+        assert timeout is not None
+        if time.monotonic() - started < timeout:
+            time.sleep(0.05)
+            continue
+        # The process hasn't been reaped yet, so the pid can't have been reused.
+        os.kill(pid, signal.SIGKILL)
+        options = 0
+        timed_out = True
+
+    resource_usage.record(
+        command,
+        ResourceUsage(
+            wall_time=time.monotonic() - started,
+            user_time=rusage.ru_utime,
+            system_time=rusage.ru_stime,
+            max_rss=rusage.ru_maxrss,
+            processes=1,
+        ),
+    )
+    if timed_out:
+        raise subprocess.TimeoutExpired(command, typing.cast(float, timeout))
+    return os.waitstatus_to_exitcode(status)
+
+
+def run_command(
+    command: list[str],
+    check: bool = False,
+    capture_output: bool = False,
+    stdout: typing.Optional[int] = None,
+    cwd: typing.Optional[str] = None,
+    env: typing.Optional[dict[str, str]] = None,
+    timeout: typing.Optional[float] = None,
+) -> subprocess.CompletedProcess:
+    """
+    Runs a command like subprocess.run and records its resource usage.
+
+    Raises:
+        subprocess.CalledProcessError
+            If check is set and the command exits with a non-zero status.
+        subprocess.TimeoutExpired
+            If timeout is given and the command runs longer than timeout seconds.
+    """
+    stderr = None
+    if capture_output:
+        stdout = stderr = subprocess.PIPE
+
+    started = time.monotonic()
+    with subprocess.Popen(
+        command, stdout=stdout, stderr=stderr, cwd=cwd, env=env
+    ) as process:
+        outputs: dict[str, bytes] = {}
+
+        def read(name: str, stream: typing.IO[bytes]):
+            outputs[name] = stream.read()
+
+        # Both pipes are read at the same time so that a full pipe can't block the process.
+        readers = [
+            threading.Thread(target=read, args=(name, stream))
+            for name, stream in [("stdout", process.stdout), ("stderr", process.stderr)]
+            if stream is not None
+        ]
+        for reader in readers:
+            reader.start()
+
+        try:
+            # The process is reaped here, so Popen doesn't wait for it again.
+            process.returncode = reap_child(process.pid, command, started, timeout)
+        except subprocess.TimeoutExpired as e:
+            process.returncode = -signal.SIGKILL
+            for reader in readers:
+                reader.join()
+            e.output, e.stderr = outputs.get("stdout"), outputs.get("stderr")
+            raise
+
+        for reader in readers:
+            reader.join()
+
+    result = subprocess.CompletedProcess(
+        command, process.returncode, outputs.get("stdout"), outputs.get("stderr")
+    )
+    if check:
+        result.check_returncode()
+    return result
+
+
+class ResourceUsage:
+    """
+    Wall time, CPU time and the peak memory use of child processes.
+
+    max_rss is in KiB like in getrusage. Usage of several processes is combined by summing times and
+    taking the largest max_rss.
+    """
+
+    def __init__(
+        self,
+        wall_time: float = 0.0,
+        user_time: float = 0.0,
+        system_time: float = 0.0,
+        max_rss: int = 0,
+        processes: int = 0,
+    ):
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.processes = processes
+
+    def add(self, other: "ResourceUsage"):
+        """
+        Adds the usage of other processes to this usage.
+        """
+        self.wall_time += other.wall_time
+        self.user_time += other.user_time
+        self.system_time += other.system_time
+        self.max_rss = max(self.max_rss, other.max_rss)
+        self.processes += other.processes
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Returns the usage as a JSON serializable dict.
+        """
+        return {
+            "wall_time": round(self.wall_time, 3),
+            "user_time": round(self.user_time, 3),
+            "system_time": round(self.system_time, 3),
+            "max_rss": self.max_rss,
+            "processes": self.processes,
+        }
+
+    @staticmethod
+    def from_dict(d: dict[str, typing.Any]) -> "ResourceUsage":
+        """
+        Creates usage from a dict created with to_dict.
+        """
+        return ResourceUsage(
+            wall_time=d.get("wall_time", 0.0),
+            user_time=d.get("user_time", 0.0),
+            system_time=d.get("system_time", 0.0),
+            max_rss=d.get("max_rss", 0),
+            processes=d.get("processes", 0),
+        )
+
+
+class ResourceAccounting:
+    """
+    Resource usage of child processes during a decman run.
+
+    Usage is recorded per command and per package base. Processes are attributed to the package
+    base that the thread running them is building.
+    """
+
+    def __init__(self):
+        self.commands: dict[str, ResourceUsage] = {}
+        self.pkgbases: dict[str, ResourceUsage] = {}
+        self._lock = threading.Lock()
+        self._current = threading.local()
+
+    @contextlib.contextmanager
+    def attribute_to(self, pkgbase: str):
+        """
+        Attributes processes run by the current thread to the package base inside the context.
+        """
+        previous = getattr(self._current, "pkgbase", None)
+        self._current.pkgbase = pkgbase
+        try:
+            yield
+        finally:
+            self._current.pkgbase = previous
+
+    def record(self, command: list[str], usage: ResourceUsage):
+        """
+        Records the usage of a process that ran the command.
+        """
+        name = os.path.basename(command[0]) if command else "?"
+        pkgbase = getattr(self._current, "pkgbase", None)
+        with self._lock:
+            self.commands.setdefault(name, ResourceUsage()).add(usage)
+            if pkgbase is not None:
+                self.pkgbases.setdefault(pkgbase, ResourceUsage()).add(usage)
+
+    def is_empty(self) -> bool:
+        """
+        Returns True if no processes have been recorded.
+        """
+        return not self.commands
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Returns the recorded usage as a JSON serializable dict.
+        """
+        with self._lock:
+            return {
+                "time": int(time.time()),
+                "commands": {k: v.to_dict() for k, v in self.commands.items()},
+                "pkgbases": {k: v.to_dict() for k, v in self.pkgbases.items()},
+            }
+
+    def print_summary(self, history: list[dict[str, typing.Any]]):
+        """
+        Prints the recorded usage as tables. The wall time of each row is compared to the latest
+        run in history that has the same row.
+        """
+        if self.is_empty():
+            return
+
+        for heading, title, kind, usages in [
+            ("Resource usage of package builds:", "Package base", "pkgbases", self.pkgbases),
+            ("Resource usage of commands:", "Command", "commands", self.commands),
+        ]:
+            if not usages:
+                continue
+
+            width = max(len(title), *map(len, usages))
+            print_summary(heading)
+            print_continuation(
+                f"{title:<{width}}  {'Runs':>5}  {'Wall':>9}  {'User':>9}  {'System':>9}  "
+                f"{'Max RSS':>10}  {'Previous':>9}"
+            )
+            for name, usage in sorted(
+                usages.items(), key=lambda item: item[1].wall_time, reverse=True
+            ):
+                previous = _find_previous_usage(history, kind, name)
+                previous_wall = (
+                    f"{previous.wall_time:>8.1f}s" if previous is not None else f"{'-':>9}"
+                )
+                print_continuation(
+                    f"{name:<{width}}  {usage.processes:>5}  {usage.wall_time:>8.1f}s  "
+                    f"{usage.user_time:>8.1f}s  {usage.system_time:>8.1f}s  "
+                    f"{usage.max_rss / 1024:>6.1f} MiB  {previous_wall}"
+                )
+
+
+def _find_previous_usage(
+    history: list[dict[str, typing.Any]], kind: str, name: str
+) -> typing.Optional[ResourceUsage]:
+    for entry in reversed(history):
+        usage = entry.get(kind, {}).get(name)
+        if usage is not None:
+            return ResourceUsage.from_dict(usage)
+    return None
+
+
+# Resource usage of the child processes of this run.
+resource_usage = ResourceAccounting()
@@ -0,0 +1,602 @@
+"""
+Module for reading pacman's databases directly.
+
+Pacman is slow to start and its output has to be parsed, so answering many small queries by
+running pacman is expensive. The readers in this module parse the database files once and answer
+queries from memory.
+"""
+
+import functools
+import io
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import typing
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_DEP_RX = re.compile(r"^(?P<name>[^<>=]+)(?:(?P<op><=|>=|<|>|=)(?P<version>.*))?$")
+
+
+def parse_desc(text: str) -> dict[str, list[str]]:
+    """
+    Parses the contents of a pacman database desc file.
+
+    The result maps each %SECTION% name (without the percent signs) to its lines.
+    """
+    result: dict[str, list[str]] = {}
+    section = None
+    for line in text.splitlines():
+        if len(line) > 2 and line.startswith("%") and line.endswith("%"):
+            section = line[1:-1]
+            result[section] = []
+        elif line == "":
+            section = None
+        elif section is not None:
+            result[section].append(line)
+    return result
+
+
+def parse_dep(dep: str) -> tuple[str, typing.Optional[str], typing.Optional[str]]:
+    """
+    Splits a dependency specification like 'foo>=1.2' into a tuple (name, operator, version).
+
+    Operator and version are None when the dependency is not versioned.
+    """
+    match = _DEP_RX.match(dep.strip())
+    if match is None:
+        return (dep, None, None)
+    return (match.group("name"), match.group("op"), match.group("version"))
+
+
+def _is_digit(c: int) -> bool:
+    return 0x30 <= c <= 0x39
+
+
+def _is_alpha(c: int) -> bool:
+    return 0x41 <= c <= 0x5A or 0x61 <= c <= 0x7A
+
+
+def _rpmvercmp(a: bytes, b: bytes) -> int:
+    # Port of rpmvercmp from libalpm. Versions are handled as bytes, because only ASCII letters
+    # and digits are significant and separator lengths are compared in bytes.
+    if a == b:
+        return 0
+
+    one = ptr1 = 0
+    two = ptr2 = 0
+
+    while one < len(a) and two < len(b):
+        while one < len(a) and not (_is_digit(a[one]) or _is_alpha(a[one])):
+            one += 1
+        while two < len(b) and not (_is_digit(b[two]) or _is_alpha(b[two])):
+            two += 1
+
+        if not (one < len(a) and two < len(b)):
+            break
+
+        # If the separator lengths were different, we are finished
+        if one - ptr1 != two - ptr2:
+            return -1 if one - ptr1 < two - ptr2 else 1
+
+        ptr1 = one
+        ptr2 = two
+
+        # Grab the first completely alpha or completely numeric segment
+        if _is_digit(a[ptr1]):
+            while ptr1 < len(a) and _is_digit(a[ptr1]):
+                ptr1 += 1
+            while ptr2 < len(b) and _is_digit(b[ptr2]):
+                ptr2 += 1
+            isnum = True
+        else:
+            while ptr1 < len(a) and _is_alpha(a[ptr1]):
+                ptr1 += 1
+            while ptr2 < len(b) and _is_alpha(b[ptr2]):
+                ptr2 += 1
+            isnum = False
+
+        # The segments are of different types. Numeric segments are always newer.
+        if two == ptr2:
+            return 1 if isnum else -1
+
+        seg1 = a[one:ptr1]
+        seg2 = b[two:ptr2]
+
+        if isnum:
+            # Whichever number has more digits wins
+            seg1 = seg1.lstrip(b"0")
+            seg2 = seg2.lstrip(b"0")
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+
+        if seg1 != seg2:
+            return -1 if seg1 < seg2 else 1
+
+        one = ptr1
+        two = ptr2
+
+    # All segments compared identically but the separators were different
+    if one >= len(a) and two >= len(b):
+        return 0
+
+    # A remaining alpha string never beats an empty string
+    rest1 = a[one] if one < len(a) else None
+    rest2 = b[two] if two < len(b) else None
+    if (rest1 is None and not (rest2 is not None and _is_alpha(rest2))) or (
+        rest1 is not None and _is_alpha(rest1)
+    ):
+        return -1
+    return 1
+
+
+def _parse_evr(evr: bytes) -> tuple[bytes, bytes, typing.Optional[bytes]]:
+    index = 0
+    while index < len(evr) and _is_digit(evr[index]):
+        index += 1
+
+    if index < len(evr) and evr[index : index + 1] == b":":
+        epoch = evr[:index] or b"0"
+        version = evr[index + 1 :]
+    else:
+        epoch = b"0"
+        version = evr
+
+    release = None
+    if b"-" in evr[index:]:
+        version, _, release = version.rpartition(b"-")
+
+    return (epoch, version, release)
+
+
+@functools.cache
+def vercmp(a: str, b: str) -> int:
+    """
+    Compares two package versions of the form [epoch:]version[-release] like pacman's vercmp.
+
+    Returns -1 if a is older than b, 0 if they are equal and 1 if a is newer than b. Results are
+    memoized.
+    """
+    if a == b:
+        return 0
+
+    epoch1, version1, release1 = _parse_evr(a.encode())
+    epoch2, version2, release2 = _parse_evr(b.encode())
+
+    result = _rpmvercmp(epoch1, epoch2)
+    if result == 0:
+        result = _rpmvercmp(version1, version2)
+        if result == 0 and release1 is not None and release2 is not None:
+            result = _rpmvercmp(release1, release2)
+    return result
+
+
+def version_satisfies(version: str, op: typing.Optional[str], required: str) -> bool:
+    """
+    Returns True if the version satisfies the version requirement of a dependency.
+    """
+    if op is None:
+        return True
+
+    result = vercmp(version, required)
+    return {
+        "=": result == 0,
+        ">=": result >= 0,
+        "<=": result <= 0,
+        ">": result > 0,
+        "<": result < 0,
+    }[op]
+
+
+def satisfies(name: str, version: str, provides: list[str], dep: str) -> bool:
+    """
+    Returns True if a package with the given name, version and provisions satisfies the
+    dependency.
+
+    Like in pacman, unversioned provisions don't satisfy versioned dependencies.
+    """
+    dep_name, op, required = parse_dep(dep)
+
+    if name == dep_name and version_satisfies(version, op, required or ""):
+        return True
+
+    for provided in provides:
+        provided_name, _, provided_version = parse_dep(provided)
+        if provided_name != dep_name:
+            continue
+        if op is None:
+            return True
+        if provided_version is not None and version_satisfies(
+            provided_version, op, required or ""
+        ):
+            return True
+
+    return False
+
+
+def read_repo_names(config_file: str) -> list[str]:
+    """
+    Returns the names of the repositories configured in a pacman.conf in the order pacman uses
+    them.
+    """
+    repos = []
+    with open(config_file, "rt", encoding="utf-8") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if line.startswith("[") and line.endswith("]"):
+                name = line[1:-1].strip()
+                if name != "options" and name not in repos:
+                    repos.append(name)
+    return repos
+
+
+def open_db_archive(path: str) -> tarfile.TarFile:
+    """
+    Opens a pacman database archive.
+
+    Gzip, bzip2 and xz are handled by tarfile. Zstandard compressed databases are decompressed
+    using the zstd binary.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(4)
+
+    if magic != _ZSTD_MAGIC:
+        try:
+            return tarfile.open(path, "r:*")
+        except tarfile.TarError as error:
+            raise OSError(f"Failed to read pacman database '{path}': {error}") from error
+
+    zstd = shutil.which("zstd")
+    if zstd is None:
+        raise OSError(f"Reading '{path}' requires zstd, but it is not installed.")
+
+    try:
+        data = subprocess.run(
+            [zstd, "-dcq", path], check=True, stdout=subprocess.PIPE
+        ).stdout
+        return tarfile.open(fileobj=io.BytesIO(data), mode="r:")
+    except (subprocess.CalledProcessError, tarfile.TarError) as error:
+        raise OSError(f"Failed to read pacman database '{path}': {error}") from error
+
+
+class SyncPackage:
+    """
+    Package found in a pacman sync database.
+    """
+
+    __slots__ = ("depends", "groups", "name", "provides", "repo", "version")
+
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        repo: str,
+        provides: list[str],
+        depends: list[str],
+        groups: list[str],
+    ):
+        self.name = name
+        self.version = version
+        self.repo = repo
+        self.provides = provides
+        self.depends = depends
+        self.groups = groups
+
+    def __repr__(self) -> str:
+        return f"{self.repo}/{self.name} {self.version}"
+
+
+class SyncDbIndex:
+    """
+    In-memory index of the packages in pacman sync databases.
+
+    The index contains package names, versions, provides, dependencies and groups.
+    """
+
+    def __init__(self):
+        self.packages: dict[str, SyncPackage] = {}
+        self.groups: dict[str, list[str]] = {}
+        self._providers: dict[str, list[tuple[SyncPackage, typing.Optional[str]]]] = {}
+
+    def add_package(self, pkg: SyncPackage):
+        """
+        Adds a package to the index.
+
+        If a package with the same name has already been added, the new package is ignored,
+        because pacman prefers the repository that is listed first.
+        """
+        if pkg.name in self.packages:
+            return
+
+        self.packages[pkg.name] = pkg
+
+        for provided in pkg.provides:
+            name, _, version = parse_dep(provided)
+            self._providers.setdefault(name, []).append((pkg, version))
+
+        for group in pkg.groups:
+            self.groups.setdefault(group, []).append(pkg.name)
+
+    def add_db(self, repo: str, path: str):
+        """
+        Reads a sync database archive and adds all packages in it to the index.
+        """
+        # Old databases store dependencies in a separate file, so the sections of each entry are
+        # collected before the packages are created.
+        entries: dict[str, dict[str, list[str]]] = {}
+
+        with open_db_archive(path) as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+
+                entry, _, filename = member.name.rpartition("/")
+                if filename not in ("desc", "depends"):
+                    continue
+
+                file = archive.extractfile(member)
+                if file is None:
+                    continue
+
+                desc = parse_desc(file.read().decode("utf-8", errors="replace"))
+                entries.setdefault(entry, {}).update(desc)
+
+        for desc in entries.values():
+            if not desc.get("NAME") or not desc.get("VERSION"):
+                continue
+            self.add_package(
+                SyncPackage(
+                    name=desc["NAME"][0],
+                    version=desc["VERSION"][0],
+                    repo=repo,
+                    provides=desc.get("PROVIDES", []),
+                    depends=desc.get("DEPENDS", []),
+                    groups=desc.get("GROUPS", []),
+                )
+            )
+
+    def find_satisfier(self, dep: str) -> typing.Optional[SyncPackage]:
+        """
+        Returns the package that satisfies the dependency or None if there is no such package.
+
+        A package with the exact name is preferred over packages providing the dependency.
+        """
+        name, _, _ = parse_dep(dep)
+
+        pkg = self.packages.get(name)
+        if pkg is not None and satisfies(pkg.name, pkg.version, [], dep):
+            return pkg
+
+        for provider, _ in self._providers.get(name, []):
+            if satisfies(provider.name, provider.version, provider.provides, dep):
+                return provider
+
+        return None
+
+    def is_satisfiable(self, dep: str) -> bool:
+        """
+        Returns True if the dependency can be installed from the sync databases.
+
+        Groups are also accepted like 'pacman -S' does.
+        """
+        if self.find_satisfier(dep) is not None:
+            return True
+        name, op, _ = parse_dep(dep)
+        return op is None and name in self.groups
+
+    @staticmethod
+    def load(config_file: str, db_path: str) -> "SyncDbIndex":
+        """
+        Reads the sync databases of every repository configured in the given pacman.conf.
+
+        Repositories without a database file are skipped like pacman does.
+        """
+        index = SyncDbIndex()
+        for repo in read_repo_names(config_file):
+            path = os.path.join(db_path, "sync", f"{repo}.db")
+            if os.path.exists(path):
+                index.add_db(repo, path)
+        return index
+
+
+class LocalPackage:
+    """
+    Package found in the pacman local database, meaning that it is installed.
+    """
+
+    __slots__ = ("depends", "explicit", "name", "optdepends", "provides", "version")
+
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        explicit: bool,
+        provides: list[str],
+        depends: list[str],
+        optdepends: list[str],
+    ):
+        self.name = name
+        self.version = version
+        self.explicit = explicit
+        self.provides = provides
+        self.depends = depends
+        self.optdepends = optdepends
+
+    def __repr__(self) -> str:
+        return f"{self.name} {self.version}"
+
+
+class LocalDb:
+    """
+    Snapshot of the pacman local database.
+
+    The snapshot contains the name, version, install reason, provides and dependencies of every
+    installed package.
+    """
+
+    def __init__(self):
+        self.packages: dict[str, LocalPackage] = {}
+
+    def add_package(self, pkg: LocalPackage):
+        """
+        Adds a package to the snapshot.
+        """
+        self.packages[pkg.name] = pkg
+
+    def explicitly_installed(self) -> list[str]:
+        """
+        Returns the names of explicitly installed packages like 'pacman -Qeq'.
+        """
+        return sorted(name for name, pkg in self.packages.items() if pkg.explicit)
+
+    def foreign(self, index: SyncDbIndex) -> list[LocalPackage]:
+        """
+        Returns installed packages that are not in the sync databases like 'pacman -Qm'.
+        """
+        return sorted(
+            (pkg for name, pkg in self.packages.items() if name not in index.packages),
+            key=lambda pkg: pkg.name,
+        )
+
+    def orphans(self) -> list[str]:
+        """
+        Returns packages installed as dependencies that are neither required nor optionally
+        required by any installed package like 'pacman -Qdtq'.
+        """
+        providers: dict[str, list[LocalPackage]] = {}
+        for pkg in self.packages.values():
+            providers.setdefault(pkg.name, []).append(pkg)
+            for provided in pkg.provides:
+                providers.setdefault(parse_dep(provided)[0], []).append(pkg)
+
+        required = set()
+        for pkg in self.packages.values():
+            optdeps = [optdep.split(":", 1)[0] for optdep in pkg.optdepends]
+            for dep in pkg.depends + optdeps:
+                for provider in providers.get(parse_dep(dep)[0], []):
+                    if satisfies(provider.name, provider.version, provider.provides, dep):
+                        required.add(provider.name)
+
+        return sorted(
+            name
+            for name, pkg in self.packages.items()
+            if not pkg.explicit and name not in required
+        )
+
+    @staticmethod
+    def load(db_path: str) -> "LocalDb":
+        """
+        Reads every desc file of the local database.
+        """
+        db = LocalDb()
+        for entry in os.scandir(os.path.join(db_path, "local")):
+            if not entry.is_dir():
+                continue
+
+            with open(
+                os.path.join(entry.path, "desc"), "rt", encoding="utf-8", errors="replace"
+            ) as file:
+                desc = parse_desc(file.read())
+
+            if not desc.get("NAME") or not desc.get("VERSION"):
+                continue
+
+            db.add_package(
+                LocalPackage(
+                    name=desc["NAME"][0],
+                    version=desc["VERSION"][0],
+                    explicit=desc.get("REASON", ["0"])[0] != "1",
+                    provides=desc.get("PROVIDES", []),
+                    depends=desc.get("DEPENDS", []),
+                    optdepends=desc.get("OPTDEPENDS", []),
+                )
+            )
+        return db
+
+
+class PackageFile:
+    """
+    Information about a package file read from its .PKGINFO.
+    """
+
+    __slots__ = ("arch", "name", "path", "version")
+
+    def __init__(self, path: str, name: str, version: str, arch: str):
+        self.path = path
+        self.name = name
+        self.version = version
+        self.arch = arch
+
+    def __repr__(self) -> str:
+        return f"{self.name} {self.version} {self.arch} ({self.path})"
+
+
+def parse_pkginfo(text: str) -> dict[str, list[str]]:
+    """
+    Parses the contents of a .PKGINFO file. The result maps each key to its values.
+    """
+    result: dict[str, list[str]] = {}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        key, sep, value = line.partition(" = ")
+        if sep:
+            result.setdefault(key.strip(), []).append(value.strip())
+    return result
+
+
+def _read_pkginfo(archive: tarfile.TarFile) -> typing.Optional[dict[str, list[str]]]:
+    for member in archive:
+        if member.name == ".PKGINFO":
+            file = archive.extractfile(member)
+            if file is None:
+                return None
+            return parse_pkginfo(file.read().decode("utf-8", errors="replace"))
+        if not member.name.startswith("."):
+            # Metadata files are stored first, so there's no .PKGINFO.
+            return None
+    return None
+
+
+def read_package_file(path: str) -> PackageFile:
+    """
+    Reads the name, version and architecture of a package file.
+
+    The archive is read as a stream and only up to the .PKGINFO member, which makepkg places
+    before the packaged files. Gzip, bzip2 and xz are handled by tarfile. Zstandard compressed
+    packages are decompressed using the zstd binary.
+
+    Raises OSError if the file isn't a valid package.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(4)
+
+    try:
+        if magic == _ZSTD_MAGIC:
+            zstd = shutil.which("zstd")
+            if zstd is None:
+                raise OSError(f"Reading '{path}' requires zstd, but it is not installed.")
+            with subprocess.Popen(
+                [zstd, "-dcq", path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            ) as process, tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+                try:
+                    pkginfo = _read_pkginfo(archive)
+                finally:
+                    # The rest of the archive isn't needed.
+                    process.kill()
+        else:
+            with tarfile.open(path, "r|*") as archive:
+                pkginfo = _read_pkginfo(archive)
+    except tarfile.TarError as error:
+        raise OSError(f"Failed to read package file '{path}': {error}") from error
+
+    if pkginfo is None or not pkginfo.get("pkgname") or not pkginfo.get("pkgver"):
+        raise OSError(f"Package file '{path}' has no valid .PKGINFO.")
+
+    return PackageFile(
+        path=path,
+        name=pkginfo["pkgname"][0],
+        version=pkginfo["pkgver"][0],
+        arch=pkginfo.get("arch", ["any"])[0],
+    )
@@ -0,0 +1,467 @@
+"""
+Module for getting package information from the AUR.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import requests
+import requests.adapters
+
+import decman.error as err
+import decman.lib as l
+from decman.lib import alpm
+
+_CACHE_FORMAT_VERSION = 1
+_SNAPSHOT_INDEX_FORMAT_VERSION = 1
+
+# SQLite limits the number of parameters in a single query.
+_SNAPSHOT_QUERY_BATCH_SIZE = 500
+# Packages of the metadata dump are read and inserted to the index this many at a time, so that
+# the whole dump is never held in memory.
+_SNAPSHOT_INSERT_BATCH_SIZE = 5000
+
+# Fields of AUR RPC results that decman uses. Other fields aren't cached.
+_CACHED_FIELDS = (
+    "Name",
+    "PackageBase",
+    "Version",
+    "Depends",
+    "MakeDepends",
+    "CheckDepends",
+    "Provides",
+)
+
+
+class AurMetadataCache:
+    """
+    Persistent cache of AUR RPC results.
+
+    Package information is keyed by package name and provider search results are keyed by the
+    provided name. Packages that don't exist in the AUR are cached as well. Entries older than the
+    TTL are ignored. When refresh is set, all existing entries are ignored, but fetched results
+    are still stored.
+    """
+
+    def __init__(self, path: str, ttl: int, refresh: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self._packages: dict[str, tuple[int, typing.Optional[dict[str, typing.Any]]]] = {}
+        self._providers: dict[str, tuple[int, list[str]]] = {}
+        self._loaded = False
+        self._changed = False
+
+    def is_enabled(self) -> bool:
+        """
+        Returns True if the cache is used.
+        """
+        return self.ttl > 0
+
+    def get_package(
+        self, pkgname: str
+    ) -> tuple[bool, typing.Optional[dict[str, typing.Any]]]:
+        """
+        Returns a tuple (found, result).
+
+        If found is False, the package isn't cached or the entry is stale. If found is True and
+        result is None, the package is known to not exist in the AUR.
+        """
+        self._load()
+        entry = self._packages.get(pkgname)
+        if entry is None or not self._is_fresh(entry[0]):
+            return (False, None)
+        return (True, entry[1])
+
+    def put_package(self, pkgname: str, result: typing.Optional[dict[str, typing.Any]]):
+        """
+        Caches an AUR RPC info result. Set result to None to cache that the package doesn't exist.
+        """
+        if not self.is_enabled():
+            return
+
+        self._load()
+        if result is not None:
+            result = {
+                field: result[field] for field in _CACHED_FIELDS if result.get(field)
+            }
+        self._packages[pkgname] = (int(time.time()), result)
+        self._changed = True
+
+    def get_providers(self, dep: str) -> typing.Optional[list[str]]:
+        """
+        Returns the names of the packages that provide the given name or None if the search result
+        isn't cached.
+        """
+        self._load()
+        entry = self._providers.get(dep)
+        if entry is None or not self._is_fresh(entry[0]):
+            return None
+        return list(entry[1])
+
+    def put_providers(self, dep: str, providers: list[str]):
+        """
+        Caches an AUR RPC provider search result.
+        """
+        if not self.is_enabled():
+            return
+
+        self._load()
+        self._providers[dep] = (int(time.time()), list(providers))
+        self._changed = True
+
+    def save(self):
+        """
+        Writes the cache to disk if it has changed. Expired entries are dropped.
+        """
+        if not self._changed or not self.is_enabled():
+            return
+
+        now = int(time.time())
+        d = {
+            "version": _CACHE_FORMAT_VERSION,
+            "packages": {
+                name: [fetched, result]
+                for name, (fetched, result) in self._packages.items()
+                if now - fetched < self.ttl
+            },
+            "providers": {
+                dep: [fetched, providers]
+                for dep, (fetched, providers) in self._providers.items()
+                if now - fetched < self.ttl
+            },
+        }
+
+        l.print_debug(f"Writing AUR metadata cache to '{self.path}'.")
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+                json.dump(d, file, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            self._changed = False
+        except OSError as e:
+            l.print_warning(f"Failed to save AUR metadata cache: {e}")
+
+    def _is_fresh(self, fetched: int) -> bool:
+        return not self.refresh and time.time() - fetched < self.ttl
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+
+        if not self.is_enabled() or self.refresh or not os.path.exists(self.path):
+            return
+
+        l.print_debug(f"Reading AUR metadata cache from '{self.path}'.")
+
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                d = json.load(file)
+
+            if d.get("version") != _CACHE_FORMAT_VERSION:
+                return
+
+            for name, (fetched, result) in d.get("packages", {}).items():
+                self._packages[name] = (fetched, result)
+            for dep, (fetched, providers) in d.get("providers", {}).items():
+                self._providers[dep] = (fetched, providers)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            # The cache can always be rebuilt, so a broken cache isn't an error.
+            l.print_warning(f"Ignoring unreadable AUR metadata cache: {e}")
+            self._packages = {}
+            self._providers = {}
+
+
+class AurRpcClient:
+    """
+    Makes AUR RPC requests using a single pooled HTTP session.
+
+    Connections are kept alive between requests, so consecutive requests don't need new TCP and
+    TLS handshakes. The number of requests, received bytes and time spent waiting for responses
+    are counted.
+    """
+
+    def __init__(self, pool_size: int, timeout: typing.Optional[int]):
+        self.timeout = timeout
+        self.requests_made = 0
+        self.bytes_received = 0
+        self.seconds_waited = 0.0
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(1, pool_size)
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def get_json(self, url: str) -> typing.Any:
+        """
+        Sends a GET request and returns the decoded JSON response.
+
+        Raises requests.RequestException if the request fails or the response is not JSON.
+        """
+        start = time.monotonic()
+        response = self._session.get(url, timeout=self.timeout)
+        content_length = len(response.content)
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            self.requests_made += 1
+            self.bytes_received += content_length
+            self.seconds_waited += elapsed
+
+        return response.json()
+
+    def print_statistics(self):
+        """
+        Prints how many requests were made.
+        """
+        if self.requests_made == 0:
+            return
+
+        l.print_info(
+            f"Made {self.requests_made} AUR RPC requests, received "
+            f"{self.bytes_received / 1024:.1f} KiB in {self.seconds_waited:.2f} seconds."
+        )
+
+
+class AurSnapshotIndex:
+    """
+    Local index of an AUR metadata dump (packages-meta-ext-v1.json.gz).
+
+    The dump is ingested into an SQLite database, which is rebuilt when the dump changes. Package
+    information and provider searches are then answered from the index without AUR RPC requests.
+    """
+
+    def __init__(self, dump_path: str, index_path: str):
+        self.dump_path = dump_path
+        self.index_path = index_path
+        self._db: typing.Optional[sqlite3.Connection] = None
+
+    def get_packages(self, pkgnames: list[str]) -> dict[str, dict[str, typing.Any]]:
+        """
+        Returns AUR RPC info style results of the given packages by package name.
+
+        Packages that don't exist in the dump are not included.
+        """
+        db = self._open()
+        results = {}
+        for batch in _batches(list(dict.fromkeys(pkgnames))):
+            placeholders = ",".join("?" * len(batch))
+            for name, result in db.execute(
+                f"SELECT name, result FROM packages WHERE name IN ({placeholders})",
+                batch,
+            ):
+                results[name] = json.loads(result)
+        return results
+
+    def find_providers(self, deps: list[str]) -> dict[str, list[str]]:
+        """
+        Returns the names of the packages that are named after or provide each of the given
+        dependencies. Matches the AUR RPC search with by=provides.
+        """
+        db = self._open()
+        results: dict[str, list[str]] = {dep: [] for dep in deps}
+        for batch in _batches(list(results)):
+            placeholders = ",".join("?" * len(batch))
+            for provided, name in db.execute(
+                f"SELECT provided, name FROM provides WHERE provided IN ({placeholders}) "
+                "ORDER BY provided, name",
+                batch,
+            ):
+                results[provided].append(name)
+        return results
+
+    def _open(self) -> sqlite3.Connection:
+        if self._db is not None:
+            return self._db
+
+        try:
+            stat = os.stat(self.dump_path)
+        except OSError as e:
+            raise err.UserFacingError(
+                f"Failed to read AUR metadata dump '{self.dump_path}'."
+            ) from e
+        dump_id = f"{_SNAPSHOT_INDEX_FORMAT_VERSION}:{stat.st_mtime_ns}:{stat.st_size}"
+
+        if os.path.exists(self.index_path):
+            try:
+                db = sqlite3.connect(self.index_path)
+                row = db.execute("SELECT value FROM meta WHERE key = 'dump'").fetchone()
+                if row is not None and row[0] == dump_id:
+                    self._db = db
+                    return db
+                db.close()
+            except sqlite3.Error as e:
+                l.print_debug(f"Rebuilding unreadable AUR snapshot index: {e}")
+
+        self._build(dump_id)
+        self._db = sqlite3.connect(self.index_path)
+        return self._db
+
+    def _build(self, dump_id: str):
+        l.print_info(f"Indexing AUR metadata dump '{self.dump_path}'.")
+
+        tmp_path = f"{self.index_path}.tmp"
+        count = 0
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+            db = sqlite3.connect(tmp_path)
+            try:
+                with db:
+                    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                    db.execute(
+                        "CREATE TABLE packages (name TEXT PRIMARY KEY, pkgbase TEXT, "
+                        "version TEXT, result TEXT)"
+                    )
+                    db.execute("CREATE TABLE provides (provided TEXT, name TEXT)")
+                    for batch in self._read_dump():
+                        _insert_snapshot_batch(db, batch)
+                        count += len(batch)
+                    db.execute("CREATE INDEX provides_provided ON provides (provided)")
+                    db.execute("INSERT INTO meta VALUES ('dump', ?)", (dump_id,))
+            finally:
+                db.close()
+            os.replace(tmp_path, self.index_path)
+        except (KeyError, TypeError) as e:
+            raise err.UserFacingError(
+                f"AUR metadata dump '{self.dump_path}' is malformed."
+            ) from e
+        except (OSError, sqlite3.Error) as e:
+            raise err.UserFacingError(
+                f"Failed to write AUR snapshot index '{self.index_path}'."
+            ) from e
+
+        l.print_debug(f"Indexed {count} AUR packages.")
+
+    def _read_dump(self) -> typing.Iterator[list[dict[str, typing.Any]]]:
+        """
+        Yields the packages of the dump in batches of _SNAPSHOT_INSERT_BATCH_SIZE.
+        """
+        try:
+            with gzip.open(self.dump_path, "rt", encoding="utf-8") as file:
+                batch = []
+                for result in _iter_json_array(file):
+                    batch.append(result)
+                    if len(batch) == _SNAPSHOT_INSERT_BATCH_SIZE:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+        except (OSError, EOFError, ValueError) as e:
+            raise err.UserFacingError(
+                f"Failed to read AUR metadata dump '{self.dump_path}'."
+            ) from e
+
+
+def _insert_snapshot_batch(db: sqlite3.Connection, batch: list[dict[str, typing.Any]]):
+    db.executemany(
+        "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)",
+        (
+            (
+                result["Name"],
+                result["PackageBase"],
+                result["Version"],
+                json.dumps(
+                    {f: result[f] for f in _CACHED_FIELDS if result.get(f)},
+                    separators=(",", ":"),
+                ),
+            )
+            for result in batch
+        ),
+    )
+    db.executemany(
+        "INSERT INTO provides VALUES (?, ?)",
+        (
+            (provided, result["Name"])
+            for result in batch
+            for provided in dict.fromkeys(
+                [result["Name"]]
+                + [alpm.parse_dep(p)[0] for p in result.get("Provides") or []]
+            )
+        ),
+    )
+
+
+def _iter_json_array(
+    file: typing.TextIO, chunk_size: int = 64 * 1024
+) -> typing.Iterator[typing.Any]:
+    """
+    Yields the elements of a JSON array one at a time while reading the file in chunks.
+
+    Only the element being decoded and one chunk are held in memory. Raises ValueError if the file
+    isn't a JSON array of objects.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def skip_whitespace() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos : pos + 1]
+
+    if skip_whitespace() != "[":
+        raise ValueError("Expected a JSON array.")
+    pos += 1
+
+    first = True
+    while True:
+        char = skip_whitespace()
+        if char == "]":
+            break
+        if not first:
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' at position {pos}.")
+            pos += 1
+            char = skip_whitespace()
+        if char != "{":
+            raise ValueError(f"Expected a JSON object at position {pos}.")
+
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                # The object may continue in the next chunk.
+                if not fill():
+                    raise
+        pos = end
+        first = False
+        yield element
+
+    pos += 1
+    if skip_whitespace():
+        raise ValueError("Unexpected data after the JSON array.")
+
+
+def _batches(items: list[str]) -> typing.Iterator[list[str]]:
+    for i in range(0, len(items), _SNAPSHOT_QUERY_BATCH_SIZE):
+        yield items[i : i + _SNAPSHOT_QUERY_BATCH_SIZE]
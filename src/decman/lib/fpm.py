@@ -11,10 +11,21 @@ Terminology:
 - all dependencies: normal dependencies and build dependencies combined
 """
 
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import json
 import os
 import re
 import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import typing
 
 import requests
@@ -23,6 +34,7 @@ import decman
 import decman.config as conf
 import decman.error as err
 import decman.lib as l
+from decman.lib import alpm, aur
 
 
 def strip_dependency(dep: str) -> str:
@@ -131,21 +143,72 @@ class PackageInfo:
         )
 
 
+class PackageNameTable:
+    """
+    Interns package names into small integer IDs, so that sets of packages can be stored as
+    integer bitsets where bit N is set when the package with ID N is in the set.
+    """
+
+    def __init__(self):
+        self._names: list[str] = []
+        self._ids: dict[str, int] = {}
+
+    def get_id(self, name: str) -> int:
+        """
+        Returns the ID of the package name, assigning a new ID if necessary.
+        """
+        pkg_id = self._ids.get(name)
+        if pkg_id is None:
+            pkg_id = len(self._names)
+            self._ids[name] = pkg_id
+            self._names.append(name)
+        return pkg_id
+
+    def to_bitset(self, names: typing.Iterable[str]) -> int:
+        """
+        Returns a bitset containing the given package names.
+        """
+        bitset = 0
+        for name in names:
+            bitset |= 1 << self.get_id(name)
+        return bitset
+
+    def iter_names(self, bitset: int) -> typing.Iterator[str]:
+        """
+        Yields the package names in the bitset in ID order.
+        """
+        bits = bin(bitset)
+        # bin() returns the most significant bit first after the '0b' prefix, so the string is
+        # scanned from the end to yield the lowest IDs first.
+        last = len(bits) - 1
+        i = bits.rfind("1", 2)
+        while i != -1:
+            yield self._names[last - i]
+            i = bits.rfind("1", 2, i)
+
+
 class ForeignPackage:
     """
     Class used to keep track of foreign recursive dependency packages of an foreign package.
+
+    The dependencies are stored as a bitset of package name IDs. Packages of the same DepGraph
+    share the name table, so their dependency sets can be merged with a single integer OR.
     """
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, names: typing.Optional[PackageNameTable] = None):
         self.name = name
-        self._all_recursive_foreign_deps = set()
+        self._names = names if names is not None else PackageNameTable()
+        self._id = self._names.get_id(name)
+        self._all_recursive_foreign_deps = 0
 
     def __eq__(self, value: object, /) -> bool:
         if isinstance(value, self.__class__):
-            return (
-                self.name == value.name
-                and self._all_recursive_foreign_deps
-                == value._all_recursive_foreign_deps
+            if self.name != value.name:
+                return False
+            if self._names is value._names:
+                return self._all_recursive_foreign_deps == value._all_recursive_foreign_deps
+            return set(self.iter_all_recursive_foreign_dep_pkgs()) == set(
+                value.iter_all_recursive_foreign_dep_pkgs()
             )
         return False
 
@@ -153,7 +216,7 @@ class ForeignPackage:
         return self.name.__hash__()
 
     def __repr__(self) -> str:
-        return f"{self.name}: {{{' '.join(self._all_recursive_foreign_deps)}}}"
+        return f"{self.name}: {{{' '.join(self.iter_all_recursive_foreign_dep_pkgs())}}}"
 
     def __str__(self) -> str:
         return f"{self.name}"
@@ -162,13 +225,32 @@ class ForeignPackage:
         """
         Adds dependencies to the package.
         """
-        self._all_recursive_foreign_deps.update(package_names)
+        self._all_recursive_foreign_deps |= self._names.to_bitset(package_names)
+
+    def add_foreign_dependency_package_and_deps(self, package: "ForeignPackage"):
+        """
+        Adds the given package and all of its dependencies to the dependencies of this package.
+        """
+        if package._names is not self._names:
+            self.add_foreign_dependency_packages(
+                [package.name, *package.iter_all_recursive_foreign_dep_pkgs()]
+            )
+            return
+        self._all_recursive_foreign_deps |= package._all_recursive_foreign_deps | (
+            1 << package._id
+        )
+
+    def iter_all_recursive_foreign_dep_pkgs(self) -> typing.Iterator[str]:
+        """
+        Yields all dependencies and sub-dependencies of the package without copying them.
+        """
+        return self._names.iter_names(self._all_recursive_foreign_deps)
 
     def get_all_recursive_foreign_dep_pkgs(self) -> set[str]:
         """
         Returns all dependencies and sub-dependencies of the package.
         """
-        return set(self._all_recursive_foreign_deps)
+        return set(self.iter_all_recursive_foreign_dep_pkgs())
 
 
 class DepNode:
@@ -181,14 +263,8 @@ class DepNode:
         self.children: dict[str, DepNode] = {}
         self.pkg = package
 
-    def is_pkgname_in_parents_recursive(self, pkgname: str) -> bool:
-        """
-        Returns True if the given package name is in the parents of this DepNode.
-        """
-        for name, parent in self.parents.items():
-            if name == pkgname or parent.is_pkgname_in_parents_recursive(pkgname):
-                return True
-        return False
+        # Position in a topological order of the graph, parents come before their children.
+        self.order = 0
 
 
 class DepGraph:
@@ -199,6 +275,9 @@ class DepGraph:
     def __init__(self):
         self.package_nodes: dict[str, DepNode] = {}
         self._childless_node_names = set()
+        self._min_order = 0
+        self._max_order = 0
+        self._names = PackageNameTable()
 
     def add_requirement(self, child_pkgname: str, parent_pkgname: typing.Optional[str]):
         """
@@ -206,10 +285,19 @@ class DepGraph:
 
         The parent is the package that requires the child package.
         """
-        child_node = self.package_nodes.get(
-            child_pkgname, DepNode(ForeignPackage(child_pkgname))
-        )
-        self.package_nodes[child_pkgname] = child_node
+        child_node = self.package_nodes.get(child_pkgname)
+        if child_node is None:
+            child_node = DepNode(ForeignPackage(child_pkgname, self._names))
+            # A new node has no edges yet, so it can be placed anywhere in the order. Required
+            # packages are placed last and root packages first, so adding the requirement doesn't
+            # require reordering.
+            if parent_pkgname is None:
+                self._min_order -= 1
+                child_node.order = self._min_order
+            else:
+                self._max_order += 1
+                child_node.order = self._max_order
+            self.package_nodes[child_pkgname] = child_node
 
         if len(child_node.children) == 0:
             self._childless_node_names.add(child_pkgname)
@@ -219,12 +307,8 @@ class DepGraph:
 
         parent_node = self.package_nodes[parent_pkgname]
 
-        if parent_node.is_pkgname_in_parents_recursive(child_pkgname):
-            raise err.UserFacingError(
-                f"Foreign package dependency cycle detected involving '{child_pkgname}' \
-and '{parent_pkgname}'. Foreign package dependencies are also required \
-during package building and therefore dependency cycles cannot be handled."
-            )
+        if child_pkgname not in parent_node.children:
+            self._reorder(parent_node, child_node)
 
         parent_node.children[child_pkgname] = child_node
         child_node.parents[parent_pkgname] = parent_node
@@ -232,6 +316,64 @@ during package building and therefore dependency cycles cannot be handled."
         if parent_pkgname in self._childless_node_names:
             self._childless_node_names.remove(parent_pkgname)
 
+    def _reorder(self, parent_node: DepNode, child_node: DepNode):
+        """
+        Keeps the topological order valid for a new edge from the parent to the child. Raises an
+        error if the edge would create a cycle.
+
+        This is the dynamic topological sort algorithm by Pearce and Kelly. Only the nodes between
+        the child and the parent in the current order are visited.
+        """
+        lower_bound = child_node.order
+        upper_bound = parent_node.order
+        if upper_bound < lower_bound:
+            return
+
+        # Nodes that the child depends on and that are placed before the parent.
+        previous: dict[str, typing.Optional[DepNode]] = {child_node.pkg.name: None}
+        forward = [child_node]
+        to_visit = [child_node]
+        while to_visit:
+            node = to_visit.pop()
+            if node is parent_node:
+                cycle = []
+                prev: typing.Optional[DepNode] = node
+                while prev is not None:
+                    cycle.append(prev.pkg.name)
+                    prev = previous[prev.pkg.name]
+                cycle.reverse()
+                cycle.append(child_node.pkg.name)
+                raise err.UserFacingError(
+                    f"Foreign package dependency cycle detected: {' -> '.join(cycle)}. \
+Foreign package dependencies are also required during package building and therefore \
+dependency cycles cannot be handled."
+                )
+
+            for name, child in node.children.items():
+                if name not in previous and child.order <= upper_bound:
+                    previous[name] = node
+                    forward.append(child)
+                    to_visit.append(child)
+
+        # Nodes that depend on the parent and that are placed after the child.
+        seen = {parent_node.pkg.name}
+        backward = [parent_node]
+        to_visit = [parent_node]
+        while to_visit:
+            node = to_visit.pop()
+            for name, parent in node.parents.items():
+                if name not in seen and parent.order > lower_bound:
+                    seen.add(name)
+                    backward.append(parent)
+                    to_visit.append(parent)
+
+        forward.sort(key=lambda n: n.order)
+        backward.sort(key=lambda n: n.order)
+        nodes = backward + forward
+        orders = sorted(n.order for n in nodes)
+        for node, order in zip(nodes, orders):
+            node.order = order
+
     def get_and_remove_outer_dep_pkgs(self) -> list[ForeignPackage]:
         """
         Returns all childless nodes of the dependency package graph and removes them.
@@ -242,9 +384,7 @@ during package building and therefore dependency cycles cannot be handled."
             childless_node = self.package_nodes[childless_node_name]
 
             for parent in childless_node.parents.values():
-                new_deps = childless_node.pkg.get_all_recursive_foreign_dep_pkgs()
-                new_deps.add(childless_node.pkg.name)
-                parent.pkg.add_foreign_dependency_packages(new_deps)
+                parent.pkg.add_foreign_dependency_package_and_deps(childless_node.pkg)
                 del parent.children[childless_node_name]
                 if len(parent.children) == 0:
                     new_childless_node_names.add(parent.pkg.name)
@@ -261,12 +401,26 @@ class ExtendedPackageSearch:
     Results are cached and user defined packages are preferred.
     """
 
-    def __init__(self, pacman: l.Pacman):
+    def __init__(self, pacman: l.Pacman, refresh_cache: bool = False):
         self._pacman = pacman
         self._package_info_cache: dict[str, PackageInfo] = {}
         self._dep_provider_cache: dict[str, PackageInfo] = {}
         self._known_providers_cache: dict[str, list[str]] = {}
+        self._provider_search_cache: dict[str, list[str]] = {}
+        self._missing_packages: set[str] = set()
         self._user_packages: list[PackageInfo] = []
+        self._metadata_cache = aur.AurMetadataCache(
+            os.path.join(conf.pkg_cache_dir, "aur-metadata.json.gz"),
+            conf.aur_cache_ttl,
+            refresh_cache,
+        )
+        self._rpc = aur.AurRpcClient(conf.aur_rpc_pool_size, conf.aur_rpc_timeout)
+        self._snapshot: typing.Optional[aur.AurSnapshotIndex] = None
+        if conf.aur_metadata_dump is not None:
+            self._snapshot = aur.AurSnapshotIndex(
+                conf.aur_metadata_dump,
+                os.path.join(conf.pkg_cache_dir, "aur-snapshot.sqlite3"),
+            )
 
     def add_user_pkg(self, user_pkg: PackageInfo):
         """
@@ -275,6 +429,18 @@ class ExtendedPackageSearch:
         self._user_packages.append(user_pkg)
         self._cache_pkg(user_pkg)
 
+    def save_cache(self):
+        """
+        Writes fetched AUR package information to the persistent cache.
+        """
+        self._metadata_cache.save()
+
+    def print_rpc_statistics(self):
+        """
+        Prints statistics about AUR RPC requests made so far.
+        """
+        self._rpc.print_statistics()
+
     def _cache_pkg(self, pkg: PackageInfo):
         for provided_pkg in pkg.provides:
             self._known_providers_cache[provided_pkg] = self._known_providers_cache.get(
@@ -283,6 +449,70 @@ class ExtendedPackageSearch:
             self._known_providers_cache[provided_pkg].append(pkg.pkgname)
         self._package_info_cache[pkg.pkgname] = pkg
 
+    def _cache_rpc_result(self, result: dict[str, typing.Any]) -> PackageInfo:
+        pkgname = result["Name"]
+
+        for user_package in self._user_packages:
+            if user_package.pkgname == pkgname:
+                l.print_debug(f"'{pkgname}' found in user packages.")
+                self._cache_pkg(user_package)
+                return user_package
+
+        info = PackageInfo(
+            pkgname=pkgname,
+            pkgbase=result["PackageBase"],
+            version=result["Version"],
+            dependencies=result.get("Depends", []),
+            make_dependencies=result.get("MakeDepends", []),
+            check_dependencies=result.get("CheckDepends", []),
+            provides=result.get("Provides", []),
+            git_url=f"https://aur.archlinux.org/{result['PackageBase']}.git",
+            pacman=self._pacman,
+        )
+        self._cache_pkg(info)
+        return info
+
+    def _try_cached_metadata(self, package: str) -> bool:
+        """
+        Caches the package using the persistent cache. Returns True if the persistent cache knows
+        about the package, even if it doesn't exist.
+
+        When an AUR metadata dump is used, it is the only source of package information.
+        """
+        if self._snapshot is not None:
+            self._cache_snapshot_packages([package])
+            return True
+
+        found, result = self._metadata_cache.get_package(package)
+        if found and result is not None:
+            self._cache_rpc_result(result)
+        elif found:
+            self._missing_packages.add(package)
+        return found
+
+    def _cache_snapshot_packages(self, packages: list[str]):
+        assert self._snapshot is not None
+        results = self._snapshot.get_packages(packages)
+        for pkgname in packages:
+            result = results.get(pkgname)
+            if result is None:
+                self._missing_packages.add(pkgname)
+            elif pkgname not in self._package_info_cache:
+                self._cache_rpc_result(result)
+
+    def _get_json_concurrently(self, urls: list[str]) -> list[typing.Any]:
+        """
+        Requests the given URLs concurrently using at most conf.aur_rpc_pool_size threads.
+
+        Returns the responses in the same order as the URLs.
+        """
+        if len(urls) <= 1:
+            return [self._rpc.get_json(url) for url in urls]
+
+        max_workers = max(1, min(conf.aur_rpc_pool_size, len(urls)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self._rpc.get_json, urls))
+
     def try_caching_packages(self, packages: list[str]):
         """
         Tried caching the given packages. Virtual packages may not be cached.
@@ -291,7 +521,19 @@ class ExtendedPackageSearch:
         times, because then those methods don't have to make new AUR RPC requests.
         """
 
-        packages = list(filter(lambda p: p not in self._package_info_cache, packages))
+        packages = list(
+            filter(
+                lambda p: p not in self._package_info_cache
+                and p not in self._missing_packages,
+                dict.fromkeys(packages),
+            )
+        )
+
+        if self._snapshot is not None:
+            self._cache_snapshot_packages(packages)
+            return
+
+        packages = list(filter(lambda p: not self._try_cached_metadata(p), packages))
 
         if len(packages) == 0:
             return
@@ -300,51 +542,97 @@ class ExtendedPackageSearch:
 
         max_pkgs_per_request = 200
 
+        batches = []
         while packages:
-            to_request = map(lambda p: f"arg[]={p}", packages[:max_pkgs_per_request])
+            batches.append(packages[:max_pkgs_per_request])
             packages = packages[max_pkgs_per_request:]
 
+        urls = []
+        for batch in batches:
+            to_request = map(lambda p: f"arg[]={p}", batch)
             url = f"https://aur.archlinux.org/rpc/v5/info?{'&'.join(to_request)}"
             l.print_debug(f"Request URL = {url}")
+            urls.append(url)
 
-            try:
-                request = requests.get(url, timeout=conf.aur_rpc_timeout)
-                d = request.json()
+        try:
+            responses = self._get_json_concurrently(urls)
 
+            for requested, d in zip(batches, responses):
                 if d["type"] == "error":
                     raise err.UserFacingError(f"AUR RPC returned error: {d['error']}")
 
                 for result in d["results"]:
                     pkgname = result["Name"]
+                    self._metadata_cache.put_package(pkgname, result)
 
                     if pkgname in self._package_info_cache:
                         continue
 
-                    for user_package in self._user_packages:
-                        if user_package.pkgname == pkgname:
-                            l.print_debug(f"'{pkgname}' found in user packages.")
-                            self._cache_pkg(user_package)
-                            break
-                    else:  # if not in user_packages then:
-                        info = PackageInfo(
-                            pkgname=result["Name"],
-                            pkgbase=result["PackageBase"],
-                            version=result["Version"],
-                            dependencies=result.get("Depends", []),
-                            make_dependencies=result.get("MakeDepends", []),
-                            check_dependencies=result.get("CheckDepends", []),
-                            provides=result.get("Provides", []),
-                            git_url=f"https://aur.archlinux.org/{result['PackageBase']}.git",
-                            pacman=self._pacman,
-                        )
-                        self._cache_pkg(info)
+                    self._cache_rpc_result(result)
 
-                l.print_debug("Request completed.")
-            except (requests.RequestException, KeyError) as e:
-                l.print_error(f"{e}")
-                raise err.UserFacingError(
-                    f"Failed to fetch package information for {packages} from AUR RPC."
-                ) from e
+                found = set(map(lambda r: r["Name"], d["results"]))
+                for pkgname in requested:
+                    if pkgname not in found:
+                        self._missing_packages.add(pkgname)
+                        self._metadata_cache.put_package(pkgname, None)
+
+            l.print_debug(f"{len(urls)} requests completed.")
+        except (requests.RequestException, KeyError) as e:
+            l.print_error(f"{e}")
+            raise err.UserFacingError(
+                f"Failed to fetch package information for {[p for b in batches for p in b]} from AUR RPC."
+            ) from e
+
+    def prefetch_providers(self, stripped_dependencies: list[str]):
+        """
+        Caches the given dependencies and concurrently searches for providers of the ones that
+        aren't AUR packages.
+
+        This can be used before calling find_provider multiple individual times, because then
+        find_provider doesn't have to make new AUR RPC requests one at a time.
+        """
+        self.try_caching_packages(stripped_dependencies)
+
+        to_search = []
+        for dep in dict.fromkeys(stripped_dependencies):
+            if (
+                dep in self._package_info_cache
+                or dep in self._dep_provider_cache
+                or dep in self._known_providers_cache
+                or dep in self._provider_search_cache
+                or (
+                    self._snapshot is None
+                    and self._metadata_cache.get_providers(dep) is not None
+                )
+            ):
+                continue
+            to_search.append(dep)
+
+        if len(to_search) == 0:
+            return
+
+        l.print_debug(f"Searching for providers of {to_search}.")
+
+        if self._snapshot is not None:
+            found = self._snapshot.find_providers(to_search)
+            self._provider_search_cache.update(found)
+            self.try_caching_packages([p for providers in found.values() for p in providers])
+            return
+
+        try:
+            responses = self._get_json_concurrently(
+                list(map(self._provider_search_url, to_search))
+            )
+            providers = []
+            for dep, d in zip(to_search, responses):
+                providers += self._store_provider_search_result(dep, d)
+        except (requests.RequestException, KeyError) as e:
+            l.print_error(f"{e}")
+            raise err.UserFacingError(
+                f"Failed to search for {to_search} from AUR RPC."
+            ) from e
+
+        self.try_caching_packages(providers)
 
     def get_package_info(self, package: str) -> typing.Optional[PackageInfo]:
         """
@@ -359,43 +647,39 @@ class ExtendedPackageSearch:
             l.print_debug(f"'{package}' found in cache.")
             return self._package_info_cache[package]
 
+        if package in self._missing_packages:
+            l.print_debug(f"'{package}' is known to not exist.")
+            return None
+
         for user_package in self._user_packages:
             if user_package.pkgname == package:
                 l.print_debug(f"'{package}' found in user packages.")
                 self._cache_pkg(user_package)
                 return user_package
 
+        if self._try_cached_metadata(package):
+            l.print_debug(f"'{package}' found in the persistent cache.")
+            return self._package_info_cache.get(package)
+
         url = f"https://aur.archlinux.org/rpc/v5/info/{package}"
         l.print_debug(f"Requesting info for '{package}' from AUR. URL = {url}")
         try:
-            request = requests.get(url, timeout=conf.aur_rpc_timeout)
-            d = request.json()
+            d = self._rpc.get_json(url)
 
             if d["type"] == "error":
                 raise err.UserFacingError(f"AUR RPC returned error: {d['error']}")
 
             if d["resultcount"] == 0:
                 l.print_debug(f"'{package}' not found.")
+                self._missing_packages.add(package)
+                self._metadata_cache.put_package(package, None)
                 return None
 
             l.print_debug(f"'{package}' found from AUR.")
 
             result = d["results"][0]
-            info = PackageInfo(
-                pkgname=result["Name"],
-                pkgbase=result["PackageBase"],
-                version=result["Version"],
-                dependencies=result.get("Depends", []),
-                make_dependencies=result.get("MakeDepends", []),
-                check_dependencies=result.get("CheckDepends", []),
-                provides=result.get("Provides", []),
-                git_url=f"https://aur.archlinux.org/{result['PackageBase']}.git",
-                pacman=self._pacman,
-            )
-
-            self._cache_pkg(info)
-
-            return info
+            self._metadata_cache.put_package(result["Name"], result)
+            return self._cache_rpc_result(result)
         except (requests.RequestException, KeyError) as e:
             l.print_error(f"{e}")
             raise err.UserFacingError(
@@ -447,34 +731,59 @@ class ExtendedPackageSearch:
                 stripped_dependency, known_pkg_results, "user packages"
             )
 
-        url = (
+        results = self._provider_search_cache.get(stripped_dependency)
+        if results is None and self._snapshot is None:
+            results = self._metadata_cache.get_providers(stripped_dependency)
+        if results is not None:
+            l.print_debug(f"Providers for '{stripped_dependency}' found in cache.")
+        else:
+            results = self._search_providers(stripped_dependency)
+
+        if len(results) == 0:
+            l.print_debug(f"'{stripped_dependency}' not found.")
+            return None
+
+        if len(results) == 1:
+            pkgname = results[0]
+            l.print_debug(
+                f"Single provider for '{stripped_dependency}' found from AUR: '{pkgname}'"
+            )
+            info = self.get_package_info(pkgname)
+            return info
+
+        return self._choose_provider(stripped_dependency, results, "AUR")
+
+    def _provider_search_url(self, stripped_dependency: str) -> str:
+        return (
             f"https://aur.archlinux.org/rpc/v5/search/{stripped_dependency}?by=provides"
         )
+
+    def _store_provider_search_result(
+        self, stripped_dependency: str, d: dict[str, typing.Any]
+    ) -> list[str]:
+        if d["type"] == "error":
+            raise err.UserFacingError(f"AUR RPC returned error: {d['error']}")
+
+        results = list(map(lambda r: r["Name"], d["results"]))
+        self._provider_search_cache[stripped_dependency] = results
+        self._metadata_cache.put_providers(stripped_dependency, results)
+        return results
+
+    def _search_providers(self, stripped_dependency: str) -> list[str]:
+        if self._snapshot is not None:
+            results = self._snapshot.find_providers([stripped_dependency])[
+                stripped_dependency
+            ]
+            self._provider_search_cache[stripped_dependency] = results
+            return results
+
+        url = self._provider_search_url(stripped_dependency)
         l.print_debug(
             f"Requesting providers for '{stripped_dependency}' from AUR. URL = {url}"
         )
         try:
-            request = requests.get(url, timeout=conf.aur_rpc_timeout)
-            d = request.json()
-
-            if d["type"] == "error":
-                raise err.UserFacingError(f"AUR RPC returned error: {d['error']}")
-
-            if d["resultcount"] == 0:
-                l.print_debug(f"'{stripped_dependency}' not found.")
-                return None
-
-            results = list(map(lambda r: r["Name"], d["results"]))
-
-            if len(results) == 1:
-                pkgname = results[0]
-                l.print_debug(
-                    f"Single provider for '{stripped_dependency}' found from AUR: '{pkgname}'"
-                )
-                info = self.get_package_info(pkgname)
-                return info
-
-            return self._choose_provider(stripped_dependency, results, "AUR")
+            d = self._rpc.get_json(url)
+            return self._store_provider_search_result(stripped_dependency, d)
         except (requests.RequestException, KeyError) as e:
             l.print_error(f"{e}")
             raise err.UserFacingError(
@@ -558,15 +867,177 @@ class ResolvedDependencies:
         return list(self._pkgbases_to_pkgs[pkgbase])[0]
 
 
+class BuildScheduler:
+    """
+    Schedules builds of package bases so that independent package bases are built at the same
+    time.
+
+    A package base can be built once all package bases it depends on have been built. Of the
+    package bases that can be built, the ones on the longest chain of dependent package bases are
+    built first.
+    """
+
+    def __init__(self, resolved_deps: ResolvedDependencies):
+        self.pkgbases: list[str] = []
+        self.packages: dict[str, list[ForeignPackage]] = {}
+        self.dependencies: dict[str, set[str]] = {}
+        self.dependents: dict[str, set[str]] = {}
+
+        for pkgname in resolved_deps.build_order:
+            pkgbase = resolved_deps.get_pkgbase(pkgname)
+            if pkgbase in self.packages:
+                continue
+            self.pkgbases.append(pkgbase)
+            self.packages[pkgbase] = [
+                resolved_deps.packages[name]
+                for name in sorted(resolved_deps.get_pkgs_with_common_pkgbase(pkgname))
+            ]
+            self.dependents[pkgbase] = set()
+
+        for pkgbase in self.pkgbases:
+            deps = set()
+            for pkg in self.packages[pkgbase]:
+                for dep in pkg.iter_all_recursive_foreign_dep_pkgs():
+                    deps.add(resolved_deps.get_pkgbase(dep))
+            deps.discard(pkgbase)
+            self.dependencies[pkgbase] = deps
+            for dep in deps:
+                self.dependents[dep].add(pkgbase)
+
+        # Length of the longest chain of package bases that depend on each package base.
+        # Package bases are visited after all of their dependents.
+        self.priorities: dict[str, int] = {}
+        pending = {pkgbase: len(self.dependents[pkgbase]) for pkgbase in self.pkgbases}
+        to_visit = [pkgbase for pkgbase, count in pending.items() if count == 0]
+        while to_visit:
+            pkgbase = to_visit.pop()
+            self.priorities[pkgbase] = 1 + max(
+                (self.priorities[d] for d in self.dependents[pkgbase]), default=0
+            )
+            for dep in self.dependencies[pkgbase]:
+                pending[dep] -= 1
+                if pending[dep] == 0:
+                    to_visit.append(dep)
+
+    def is_acyclic(self) -> bool:
+        """
+        Returns False if package bases depend on each other through their packages. Such package
+        bases can only be built in the original build order.
+        """
+        return len(self.priorities) == len(self.pkgbases)
+
+    def group_by_build_deps(self, build_deps: dict[str, set[str]]) -> list[str]:
+        """
+        Returns a build order for building package bases one at a time in the same chroot.
+
+        build_deps maps the package bases that will be built to their build dependencies. Of the
+        package bases that can be built next, the one whose build dependencies differ the least
+        from the previous build is chosen, so that the fewest packages have to be installed to
+        and removed from the chroot. Package bases that won't be built are chosen first.
+        """
+        remaining = {pkgbase: len(deps) for pkgbase, deps in self.dependencies.items()}
+        order = {pkgbase: i for i, pkgbase in enumerate(self.pkgbases)}
+        ready = [pkgbase for pkgbase in self.pkgbases if remaining[pkgbase] == 0]
+        in_chroot: set[str] = set()
+        result = []
+
+        def cost(pkgbase: str) -> tuple[int, int]:
+            deps = build_deps.get(pkgbase)
+            if deps is None:
+                return (-1, order[pkgbase])
+            return (len(deps ^ in_chroot), order[pkgbase])
+
+        while ready:
+            pkgbase = min(ready, key=cost)
+            ready.remove(pkgbase)
+            result.append(pkgbase)
+            in_chroot = build_deps.get(pkgbase, in_chroot)
+
+            for dependent in self.dependents[pkgbase]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+
+        return result
+
+    def run(self, builder: "PackageBuilder", force: bool, max_parallel_builds: int):
+        """
+        Builds all package bases using at most max_parallel_builds chroot copies at the same time.
+        """
+        remaining = {pkgbase: len(deps) for pkgbase, deps in self.dependencies.items()}
+        ready: list[tuple[int, int, str]] = []
+        order = {pkgbase: i for i, pkgbase in enumerate(self.pkgbases)}
+
+        def make_ready(pkgbase: str):
+            heapq.heappush(ready, (-self.priorities[pkgbase], order[pkgbase], pkgbase))
+
+        for pkgbase, count in remaining.items():
+            if count == 0:
+                make_ready(pkgbase)
+
+        free_copies = [f"decman-{i}" for i in reversed(range(max_parallel_builds))]
+        running: dict[concurrent.futures.Future, tuple[str, str]] = {}
+        failure: typing.Optional[BaseException] = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_parallel_builds
+        ) as executor:
+            while ready or running:
+                while ready and free_copies and failure is None:
+                    _, _, pkgbase = heapq.heappop(ready)
+                    copy = free_copies.pop()
+                    future = executor.submit(
+                        builder.build_packages,
+                        pkgbase,
+                        self.packages[pkgbase],
+                        force,
+                        working_copy=copy,
+                    )
+                    running[future] = (pkgbase, copy)
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    pkgbase, copy = running.pop(future)
+                    free_copies.append(copy)
+
+                    error = future.exception()
+                    if error is not None:
+                        l.print_error(f"Failed to build '{pkgbase}'.")
+                        if failure is None:
+                            failure = error
+                        continue
+
+                    for dependent in self.dependents[pkgbase]:
+                        remaining[dependent] -= 1
+                        if remaining[dependent] == 0:
+                            make_ready(dependent)
+
+        if failure is not None:
+            raise failure
+
+
 class ForeignPackageManager:
     """
     Class for dealing with foreign packages.
     """
 
-    def __init__(self, store: l.Store, pacman: l.Pacman, search: ExtendedPackageSearch):
+    def __init__(
+        self,
+        store: l.Store,
+        pacman: l.Pacman,
+        search: ExtendedPackageSearch,
+        resume: bool = False,
+    ):
         self._store = store
         self._pacman = pacman
         self._search = search
+        self._devel_tracker = DevelUpstreamTracker(store)
+        self._resume = resume
 
     def upgrade(
         self,
@@ -600,6 +1071,15 @@ class ForeignPackageManager:
                     f"Failed to find '{pkg}' from AUR or user provided packages."
                 )
 
+            if (
+                upgrade_devel
+                and is_devel(pkg)
+                and alpm.vercmp(ver, info.version) >= 0
+                and not self._devel_tracker.has_upstream_changed(info.pkgbase)
+            ):
+                l.print_info(f"Skipping '{pkg}'. Upstream hasn't changed.")
+                continue
+
             if self.should_upgrade_package(pkg, ver, info.version, upgrade_devel):
                 if pkg in all_explicit_pkgs:
                     as_explicit.append(pkg)
@@ -650,32 +1130,83 @@ class ForeignPackageManager:
             level=l.SUMMARY,
         )
 
+        checkpoint = BuildCheckpoint(self._store, self._search, resolved_dependencies)
+        checkpoint.load(self._resume)
+
+        builder = PackageBuilder(
+            self._search,
+            self._store,
+            resolved_dependencies,
+            self._devel_tracker,
+            self._pacman,
+            checkpoint,
+        )
+        pkgbases_to_build = builder.plan_builds(force)
+
+        pkgs_to_build = []
+        for pkgname in resolved_dependencies.build_order:
+            if resolved_dependencies.get_pkgbase(pkgname) in pkgbases_to_build:
+                pkgs_to_build.append(pkgname)
+            else:
+                l.print_debug(f"'{pkgname}' is already built and cached.")
+
+        l.print_list(
+            "The following foreign packages need to be built:",
+            pkgs_to_build,
+            level=l.SUMMARY,
+        )
+
+        l.print_list(
+            "The following foreign packages are already built and will be used from the cache:",
+            [p for p in resolved_dependencies.build_order if p not in pkgs_to_build],
+            level=l.SUMMARY,
+        )
+
         if not l.prompt_confirm("Proceed?", default=True):
             raise err.UserFacingError("Installing aborted.")
 
+        # Checkpoints of earlier installs are only discarded once this install is confirmed.
+        checkpoint.start()
+
         l.print_summary("Installing foreign package dependencies from pacman.")
         self._pacman.install_dependencies(list(resolved_dependencies.pacman_deps))
 
         try:
-            with PackageBuilder(
-                self._search, self._store, resolved_dependencies
-            ) as builder:
-                while resolved_dependencies.build_order:
-                    to_build = resolved_dependencies.build_order.pop(0)
-
-                    pkgbase = resolved_dependencies.get_pkgbase(to_build)
-                    package_names = resolved_dependencies.get_pkgs_with_common_pkgbase(
-                        to_build
-                    )
+            with builder:
+                # The build environment is only created when something has to be built.
+                if pkgbases_to_build:
+                    builder.ensure_build_environment()
+
+                scheduler = BuildScheduler(resolved_dependencies)
+                if conf.max_parallel_builds > 1 and scheduler.is_acyclic():
+                    scheduler.run(builder, force, conf.max_parallel_builds)
+                elif scheduler.is_acyclic():
+                    build_deps = {
+                        pkgbase: builder.get_pacman_build_deps(scheduler.packages[pkgbase])
+                        for pkgbase in pkgbases_to_build
+                    }
+                    for pkgbase in scheduler.group_by_build_deps(build_deps):
+                        builder.build_packages(pkgbase, scheduler.packages[pkgbase], force)
+                else:
+                    while resolved_dependencies.build_order:
+                        to_build = resolved_dependencies.build_order.pop(0)
+
+                        pkgbase = resolved_dependencies.get_pkgbase(to_build)
+                        package_names = (
+                            resolved_dependencies.get_pkgs_with_common_pkgbase(to_build)
+                        )
 
-                    packages = [
-                        resolved_dependencies.packages[pkgname]
-                        for pkgname in package_names
-                    ]
+                        packages = [
+                            resolved_dependencies.packages[pkgname]
+                            for pkgname in package_names
+                        ]
 
-                    builder.build_packages(pkgbase, packages, force)
+                        builder.build_packages(pkgbase, packages, force)
         except (subprocess.CalledProcessError, OSError) as e:
             l.print_error(f"{e}")
+            l.print_info(
+                "Run decman with '--resume' to continue from the first unfinished build."
+            )
             raise err.UserFacingError("Failed to build packages.") from e
 
         packages_to_install = list(resolved_dependencies.foreign_pkgs)
@@ -697,6 +1228,8 @@ class ForeignPackageManager:
         else:
             l.print_summary("No packages to install.")
 
+        checkpoint.finish()
+
     def resolve_dependencies(
         self,
         foreign_pkgs: list[str],
@@ -722,12 +1255,12 @@ class ForeignPackageManager:
             graph.add_requirement(name, None)
 
         seen_packages = set(foreign_pkgs + foreign_dep_pkgs)
-        to_process = foreign_pkgs + foreign_dep_pkgs
+        frontier = list(dict.fromkeys(foreign_pkgs + foreign_dep_pkgs))
         total_processed = 0
 
-        self._search.try_caching_packages(to_process)
-
-        def process_dep(pkgname: str, depname: str, add_to: set[str]):
+        def process_dep(
+            pkgname: str, depname: str, add_to: set[str], next_frontier: list[str]
+        ):
             dep_info = self._search.find_provider(depname)
 
             if dep_info is None:
@@ -740,38 +1273,54 @@ class ForeignPackageManager:
             l.print_debug(f"Adding dependency {dep_info.pkgname} to package {pkgname}.")
             graph.add_requirement(dep_info.pkgname, pkgname)
             if dep_info.pkgname not in seen_packages:
-                to_process.append(dep_info.pkgname)
+                next_frontier.append(dep_info.pkgname)
                 seen_packages.add(dep_info.pkgname)
 
-        while to_process:
-            pkgname = to_process.pop()
-
-            info = self._search.get_package_info(pkgname)
-            if info is None:
-                raise err.UserFacingError(
-                    f"Failed to find '{pkgname}' from AUR or user provided packages."
+        # The dependency graph is processed one level at a time, so that all packages and
+        # dependencies of a level can be fetched from the AUR with concurrent requests.
+        while frontier:
+            self._search.try_caching_packages(frontier)
+
+            infos = []
+            for pkgname in frontier:
+                info = self._search.get_package_info(pkgname)
+                if info is None:
+                    raise err.UserFacingError(
+                        f"Failed to find '{pkgname}' from AUR or user provided packages."
+                    )
+                infos.append(info)
+
+            level_deps = []
+            for info in infos:
+                level_deps += info.foreign_dependencies_stripped
+                level_deps += info.foreign_make_dependencies_stripped
+                level_deps += info.foreign_check_dependencies_stripped
+            self._search.prefetch_providers(level_deps)
+
+            next_frontier: list[str] = []
+            for pkgname, info in zip(frontier, infos):
+                result.pacman_deps.update(info.pacman_dependencies)
+                result.add_pkgbase_info(pkgname, info.pkgbase)
+
+                build_deps = (
+                    info.foreign_make_dependencies_stripped
+                    + info.foreign_check_dependencies_stripped
                 )
 
-            result.pacman_deps.update(info.pacman_dependencies)
-            result.add_pkgbase_info(pkgname, info.pkgbase)
-
-            build_deps = (
-                info.foreign_make_dependencies_stripped
-                + info.foreign_check_dependencies_stripped
-            )
-
-            self._search.try_caching_packages(
-                info.foreign_dependencies_stripped + build_deps
-            )
+                for depname in info.foreign_dependencies_stripped:
+                    process_dep(
+                        pkgname, depname, result.foreign_dep_pkgs, next_frontier
+                    )
 
-            for depname in info.foreign_dependencies_stripped:
-                process_dep(pkgname, depname, result.foreign_dep_pkgs)
+                for depname in build_deps:
+                    process_dep(
+                        pkgname, depname, result.foreign_build_dep_pkgs, next_frontier
+                    )
 
-            for depname in build_deps:
-                process_dep(pkgname, depname, result.foreign_build_dep_pkgs)
+                total_processed += 1
 
-            total_processed += 1
             l.print_info(f"Progress: {total_processed}/{len(seen_packages)}.")
+            frontier = next_frontier
 
         l.print_info("Determining build order.")
 
@@ -804,90 +1353,1319 @@ class ForeignPackageManager:
             l.print_debug(f"Package {package} is devel package. It should be upgraded.")
             return True
 
-        try:
-            result = int(
-                subprocess.run(
-                    conf.commands.compare_versions(installed_version, fetched_version),
-                    check=True,
-                    stdout=subprocess.PIPE,
-                ).stdout.decode()
-            )
-            should_upgrade = result < 0
-            l.print_debug(
-                f"Installed version is: {installed_version}. Available version is {fetched_version}. Should upgrade: {should_upgrade}"
-            )
-            return should_upgrade
-        except (ValueError, subprocess.CalledProcessError) as error:
-            l.print_error(f"{error}")
-            raise err.UserFacingError(
-                "Failed to compare versions using vercmp."
-            ) from error
+        should_upgrade = alpm.vercmp(installed_version, fetched_version) < 0
+        l.print_debug(
+            f"Installed version is: {installed_version}. Available version is {fetched_version}. Should upgrade: {should_upgrade}"
+        )
+        return should_upgrade
 
 
-class PackageBuilder:
+class BuildChroot:
     """
-    Used for building packages in a chroot.
+    Persistent master chroot that is reused between runs.
+
+    The chroot is refreshed with 'pacman -Syu' before use. It is recreated only when its base
+    package set, pacman.conf or makepkg.conf has changed, or when a previous run didn't leave it
+    in a clean state. The fingerprint and health state are stored in a JSON file next to the
+    chroot.
     """
 
-    # Include a minimal base system in the chroot to avoid pacstrap failures.
-    always_included_packages = ["base", "base-devel", "git"]
+    _STATE_FORMAT_VERSION = 1
+    _IN_USE = "in-use"
+    _CLEAN = "clean"
 
     def __init__(
         self,
-        search: ExtendedPackageSearch,
-        store: l.Store,
-        resolved_deps: ResolvedDependencies,
+        chroot_wd_dir: str,
+        packages: list[str],
+        bind_mounts: typing.Optional[list[str]] = None,
     ):
-        self._search = search
-        self._store = store
-        self._resolved_deps = resolved_deps
-        self.chroot_wd_dir = os.path.join(conf.build_dir, "chroot")
-        self.chroot_dir = os.path.join(self.chroot_wd_dir, "root")
-        self.pkgbase_dir_map = {}
-        self.original_wd = ""
-        self._pkgs_in_chroot = set(PackageBuilder.always_included_packages)
-        self._pkgs_in_chroot.update(resolved_deps.pacman_deps)
-
-    def __enter__(self):
-        self.store_wd()
-        self.create_build_environment()
-
-        return self
+        self.chroot_wd_dir = chroot_wd_dir
+        self.chroot_dir = os.path.join(chroot_wd_dir, "root")
+        self.packages = sorted(set(packages))
+        self.bind_mounts = bind_mounts or []
+        self._state_file = os.path.join(chroot_wd_dir, "decman-chroot.json")
+        self._resolved_names: dict[str, str] = {}
+        self._sync_index: typing.Optional[alpm.SyncDbIndex] = None
+        self._sync_index_read = False
+
+    def fingerprint(self) -> dict[str, typing.Any]:
+        """
+        Returns the fingerprint of the configuration the chroot should be created with.
+        """
+        return {
+            "version": BuildChroot._STATE_FORMAT_VERSION,
+            "packages": self.packages,
+            "pacman_conf": _hash_file(conf.pacman_config_file),
+            "makepkg_conf": _hash_file(conf.makepkg_config_file),
+        }
+
+    def prepare(self):
+        """
+        Makes sure that the chroot exists and is up to date and marks it as being in use.
+        """
+        state = self._read_state()
+        fingerprint = self.fingerprint()
+
+        # Upgrading or recreating the chroot may change what package specs resolve to.
+        self._resolved_names = {}
+        self._sync_index = None
+        self._sync_index_read = False
+
+        reason = None
+        if state is None or not os.path.isdir(self.chroot_dir):
+            reason = "No existing chroot found."
+        elif state.get("fingerprint") != fingerprint:
+            reason = "Chroot packages or configuration have changed."
+        elif state.get("health") != BuildChroot._CLEAN:
+            reason = "Chroot wasn't cleaned up after the previous run."
+
+        if reason is None:
+            l.print_info("Updating the existing chroot.")
+            try:
+                l.run_command(
+                    conf.commands.upgrade_chroot(self.chroot_dir, self.bind_mounts),
+                    check=True,
+                    capture_output=conf.suppress_command_output,
+                )
+                self._write_state(fingerprint, BuildChroot._IN_USE, state.get("created"))
+                return
+            except subprocess.CalledProcessError:
+                reason = "Updating the chroot failed."
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.restore_wd()
-        self.remove_build_environment()
+        l.print_info(f"{reason} Creating a new chroot.")
+        self._create()
+        self._write_state(fingerprint, BuildChroot._IN_USE, int(time.time()))
 
-    def store_wd(self):
+    def mark_clean(self):
         """
-        Remembers the current working directory as the original working directory.
+        Records that the chroot contains only its base package set and can be reused.
         """
-        self.original_wd = os.getcwd()
+        state = self._read_state()
+        if state is not None:
+            self._write_state(state["fingerprint"], BuildChroot._CLEAN, state.get("created"))
 
-    def restore_wd(self):
+    def installed_packages(self) -> set[str]:
         """
-        Returns to the original working directory.
+        Returns the names of the packages installed in the chroot.
         """
-        os.chdir(self.original_wd)
+        db = alpm.LocalDb.load(os.path.join(self.chroot_dir, "var/lib/pacman"))
+        return set(db.packages)
 
-    def create_build_environment(self):
+    def resolve_package_names(self, specs: list[str]) -> dict[str, str]:
         """
-        Creates a new chroot and clones all PKGBUILDS.
+        Resolves package specs, like virtual packages or sonames, to the names of the packages
+        that pacman in the chroot would install. Specs that can't be resolved map to themselves.
+
+        Specs are looked up from the sync databases of the chroot. The rest are resolved by
+        running pacman in the chroot once. Results are remembered until the chroot is prepared
+        again.
         """
-        l.print_info("Creating a build environment..")
+        unresolved = [spec for spec in dict.fromkeys(specs) if spec not in self._resolved_names]
 
-        if os.path.exists(conf.build_dir):
-            l.print_info("Removing previous build directory.")
-            self.remove_build_environment()
+        index = self._get_sync_index()
+        if index is not None:
+            for spec in unresolved:
+                pkg = index.find_satisfier(spec)
+                if pkg is not None:
+                    self._resolved_names[spec] = pkg.name
+            unresolved = [spec for spec in unresolved if spec not in self._resolved_names]
+
+        if unresolved:
+            self._resolved_names.update(self._resolve_with_pacman(unresolved))
+
+        return {spec: self._resolved_names[spec] for spec in specs}
+
+    def _get_sync_index(self) -> typing.Optional[alpm.SyncDbIndex]:
+        if not conf.read_pacman_databases:
+            return None
+
+        if not self._sync_index_read:
+            self._sync_index_read = True
+            try:
+                self._sync_index = alpm.SyncDbIndex.load(
+                    os.path.join(self.chroot_dir, "etc/pacman.conf"),
+                    os.path.join(self.chroot_dir, "var/lib/pacman"),
+                )
+            except OSError as e:
+                l.print_debug(f"Failed to read chroot sync databases: {e}")
+
+        return self._sync_index
+
+    def _resolve_with_pacman(self, specs: list[str]) -> dict[str, str]:
+        resolved = {spec: spec for spec in specs}
+        try:
+            output = l.run_command(
+                conf.commands.resolve_real_names(self.chroot_dir, specs),
+                check=True,
+                capture_output=True,
+            ).stdout.decode()
+        except (subprocess.CalledProcessError, OSError) as e:
+            l.print_debug(f"Failed to resolve package names in chroot: {e}")
+            return resolved
+
+        for line in output.splitlines():
+            spec, _, name = line.partition("\t")
+            if spec in resolved and name:
+                resolved[spec] = name
+        return resolved
+
+    def _create(self):
+        if os.path.exists(self.chroot_wd_dir):
+            shutil.rmtree(self.chroot_wd_dir)
+        os.makedirs(self.chroot_wd_dir)
+
+        # Remove GNUPGHOME from mkarchroot environment variables since it may interfere with
+        # the chroot creation
+        mkarchroot_env_vars = os.environ.copy()
+        try:
+            del mkarchroot_env_vars["GNUPGHOME"]
+            l.print_debug("Removed GNUPGHOME variable from mkarchroot environment.")
+        except KeyError:
+            pass
+
+        # Ensure decman's pacman/yay/paru guard wrappers do not block mkarchroot
+        # which legitimately needs to invoke pacman on the host.
+        mkarchroot_env_vars["DECMAN_ALLOW"] = "1"
+
+        try:
+            l.run_command(
+                conf.commands.make_chroot(self.chroot_dir, self.packages),
+                env=mkarchroot_env_vars,
+                check=True,
+                capture_output=conf.suppress_command_output,
+            )
+        except subprocess.CalledProcessError as e:
+            # Surface mkarchroot stderr/stdout to help diagnose exit 255 issues
+            try:
+                err_out = (e.stderr or b"").decode(errors="ignore").strip()
+                out = (e.stdout or b"").decode(errors="ignore").strip()
+            except Exception:
+                err_out, out = "", ""
+            l.print_error(
+                f"mkarchroot failed (exit {e.returncode}). Packages: {self.packages}"
+            )
+            if out:
+                l.print_warning("mkarchroot stdout:")
+                l.print_continuation(out)
+            if err_out:
+                l.print_warning("mkarchroot stderr:")
+                l.print_continuation(err_out)
+            raise
+
+    def _read_state(self) -> typing.Optional[dict[str, typing.Any]]:
+        try:
+            with open(self._state_file, "rt", encoding="utf-8") as file:
+                state = json.load(file)
+            if isinstance(state, dict):
+                return state
+        except (OSError, ValueError) as e:
+            l.print_debug(f"Failed to read chroot state: {e}")
+        return None
+
+    def _write_state(
+        self, fingerprint: dict[str, typing.Any], health: str, created: typing.Optional[int]
+    ):
+        state = {
+            "fingerprint": fingerprint,
+            "health": health,
+            "created": created,
+            "updated": int(time.time()),
+        }
+        tmp_path = f"{self._state_file}.tmp"
+        with open(tmp_path, "wt", encoding="utf-8") as file:
+            json.dump(state, file, indent=2)
+        os.replace(tmp_path, self._state_file)
+
+
+def _hash_file(path: str) -> typing.Optional[str]:
+    try:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            while chunk := file.read(1024**2):
+                digest.update(chunk)
+        return digest.hexdigest()
+    except OSError:
+        return None
+
+
+def _get_remote_commit(url: str, ref: str) -> typing.Optional[str]:
+    """
+    Returns the commit a ref points to in a remote git repository or None if it can't be queried.
+    """
+    commit = None
+    try:
+        output = l.run_command(
+            conf.commands.git_ls_remote(url, ref),
+            check=True,
+            capture_output=True,
+            timeout=conf.aur_rpc_timeout,
+        ).stdout.decode()
+        for line in output.splitlines():
+            sha, _, name = line.partition("\t")
+            # Annotated tags are listed twice, prefer the peeled commit.
+            if name == f"{ref}^{{}}" or (name == ref and commit is None):
+                commit = sha
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        l.print_debug(f"Failed to query '{ref}' of '{url}': {e}")
+    return commit
+
+
+class PackageFileIndex:
+    """
+    Index of the package files in a directory.
+
+    Package files are identified by the name, version and architecture in their .PKGINFO instead
+    of their file names. When index_file is given, the index is stored there between runs and
+    only new or changed files are read again.
+    """
+
+    _FORMAT_VERSION = 1
+
+    def __init__(self, directory: str, index_file: typing.Optional[str] = None):
+        self.directory = directory
+        self.index_file = index_file
+        # Indexed files by file name as tuples (mtime_ns, size, package file).
+        self._files: dict[str, tuple[int, int, alpm.PackageFile]] = {}
+        self._loaded = False
+        self._changed = False
+
+    def refresh(self):
+        """
+        Reads the package files in the directory that are new or have changed since they were
+        indexed and forgets removed files.
+        """
+        self._load()
+
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not any(
+                    entry.name.endswith(ext) for ext in conf.valid_pkgexts
+                ):
+                    continue
+
+                seen.add(entry.name)
+                stat = entry.stat()
+                known = self._files.get(entry.name)
+                if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+
+                try:
+                    pkg = alpm.read_package_file(entry.path)
+                except OSError as e:
+                    l.print_debug(f"Ignoring '{entry.path}': {e}")
+                    continue
+                self._files[entry.name] = (stat.st_mtime_ns, stat.st_size, pkg)
+                self._changed = True
+
+        for name in set(self._files) - seen:
+            del self._files[name]
+            self._changed = True
+
+    def add(self, pkg: alpm.PackageFile):
+        """
+        Adds a package file in the directory to the index without reading it again.
+        """
+        self._load()
+        stat = os.stat(pkg.path)
+        self._files[os.path.basename(pkg.path)] = (stat.st_mtime_ns, stat.st_size, pkg)
+        self._changed = True
+
+    def get(self, path: str) -> typing.Optional[alpm.PackageFile]:
+        """
+        Returns the indexed package file at the given path or None if it isn't indexed.
+        """
+        self._load()
+        entry = self._files.get(os.path.basename(path))
+        return entry[2] if entry is not None else None
+
+    def find(self, pkgname: str) -> list[alpm.PackageFile]:
+        """
+        Returns the indexed package files of the given package.
+        """
+        self._load()
+        return sorted(
+            (pkg for _, _, pkg in self._files.values() if pkg.name == pkgname),
+            key=lambda pkg: pkg.path,
+        )
+
+    def save(self):
+        """
+        Writes the index to the index file if it has changed.
+        """
+        if self.index_file is None or not self._changed:
+            return
+
+        d = {
+            "version": PackageFileIndex._FORMAT_VERSION,
+            "files": {
+                name: [mtime, size, pkg.name, pkg.version, pkg.arch]
+                for name, (mtime, size, pkg) in self._files.items()
+            },
+        }
+        try:
+            tmp_path = f"{self.index_file}.tmp"
+            with open(tmp_path, "wt", encoding="utf-8") as file:
+                json.dump(d, file)
+            os.replace(tmp_path, self.index_file)
+            self._changed = False
+        except OSError as e:
+            l.print_warning(f"Failed to save the package file index: {e}")
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+
+        if self.index_file is None or not os.path.exists(self.index_file):
+            return
+
+        try:
+            with open(self.index_file, "rt", encoding="utf-8") as file:
+                d = json.load(file)
+            if d.get("version") != PackageFileIndex._FORMAT_VERSION:
+                return
+            for name, (mtime, size, pkgname, version, arch) in d["files"].items():
+                path = os.path.join(self.directory, name)
+                self._files[name] = (
+                    mtime,
+                    size,
+                    alpm.PackageFile(path, pkgname, version, arch),
+                )
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            # The index can always be rebuilt.
+            l.print_debug(f"Ignoring unreadable package file index: {e}")
+            self._files = {}
+
+
+class LocalRepository:
+    """
+    Pacman repository of the built foreign packages in the package cache.
+
+    The repository is added to the pacman.conf of the master chroot and its directory is mounted
+    to chroot builds, so makepkg installs foreign build dependencies from it like packages from
+    any other repository.
+    """
+
+    _SECTION_MARKER = "# Local repository of decman."
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.db_path = os.path.join(directory, f"{name}.db.tar.gz")
+
+    @staticmethod
+    def from_config() -> typing.Optional["LocalRepository"]:
+        """
+        Returns the configured local repository or None if it is disabled.
+        """
+        if conf.local_repo_name is None:
+            return None
+        return LocalRepository(conf.pkg_cache_dir, conf.local_repo_name)
+
+    @staticmethod
+    def configure_chroot(repo: typing.Optional["LocalRepository"], chroot_dir: str):
+        """
+        Adds the repository to the pacman.conf of the chroot or removes it when the repository
+        is disabled.
+        """
+        pacman_conf = os.path.join(chroot_dir, "etc/pacman.conf")
+        with open(pacman_conf, "rt", encoding="utf-8") as file:
+            content = file.read()
+
+        # The section is always the last one in the file.
+        content = content.split(f"\n{LocalRepository._SECTION_MARKER}\n", 1)[0]
+        if repo is not None:
+            content += (
+                f"\n{LocalRepository._SECTION_MARKER}\n"
+                f"[{repo.name}]\n"
+                "SigLevel = Optional TrustAll\n"
+                f"Server = file://{repo.directory}\n"
+            )
+
+        with open(pacman_conf, "wt", encoding="utf-8") as file:
+            file.write(content)
+
+    def ensure_database(self):
+        """
+        Creates an empty repository database if it doesn't exist yet, so that pacman can sync
+        the repository before any packages have been added to it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.db_path):
+            l.print_debug(f"Creating an empty local repository database '{self.db_path}'.")
+            tmp_path = f"{self.db_path}.tmp"
+            with tarfile.open(tmp_path, "w:gz"):
+                pass
+            os.replace(tmp_path, self.db_path)
+
+        # pacman downloads <name>.db from the server, repo-add creates the same link.
+        link = os.path.join(self.directory, f"{self.name}.db")
+        if not os.path.lexists(link):
+            os.symlink(os.path.basename(self.db_path), link)
+
+    def add(self, pkg_files: list[str]):
+        """
+        Adds package files to the repository. Older versions of the packages are replaced.
+        """
+        if not pkg_files:
+            return
+
+        l.print_debug(f"Adding {pkg_files} to the local repository.")
+        l.run_command(
+            conf.commands.repo_add(self.db_path, pkg_files),
+            check=True,
+            capture_output=conf.suppress_command_output,
+        )
+
+    def add_missing(self, cached: list[tuple[str, str, str]]):
+        """
+        Adds the cached packages that aren't in the repository. cached contains tuples
+        (pkgname, version, path).
+        """
+        index = alpm.SyncDbIndex()
+        if os.path.exists(self.db_path):
+            index.add_db(self.name, self.db_path)
+
+        missing = []
+        for pkgname, version, path in cached:
+            pkg = index.packages.get(pkgname)
+            if pkg is None or pkg.version != version:
+                missing.append(path)
+        self.add(missing)
+
+    def sync_chroot(self, chroot_dir: str):
+        """
+        Copies the repository database to the sync databases of the chroot like 'pacman -Sy'
+        would do. Chroot copies made after this see the current packages of the repository.
+
+        Parallel builds may sync the same chroot at the same time, so every copy is written to a
+        temporary file of its own and then moved in place.
+        """
+        if not os.path.exists(self.db_path):
+            return
+
+        sync_dir = os.path.join(chroot_dir, "var/lib/pacman/sync")
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{self.name}.db.", dir=sync_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file, open(self.db_path, "rb") as db_file:
+                shutil.copyfileobj(db_file, tmp_file)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, os.path.join(sync_dir, f"{self.name}.db"))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class CompilerCache:
+    """
+    Persistent compiler cache shared by all chroot builds.
+
+    The cache directory is mounted to the chroot during builds and a makepkg.conf.d drop-in in the
+    master chroot enables the cache. ccache is enabled with makepkg's BUILDENV option. sccache is
+    used as the Rust compiler wrapper.
+    """
+
+    SUPPORTED = ("ccache", "sccache")
+    _MAKEPKG_DROP_IN = "etc/makepkg.conf.d/decman-compiler-cache.conf"
+
+    def __init__(self, kind: str, cache_dir: str):
+        if kind not in CompilerCache.SUPPORTED:
+            raise err.UserFacingError(
+                f"Unsupported compiler cache '{kind}'. Supported: {', '.join(CompilerCache.SUPPORTED)}."
+            )
+        self.kind = kind
+        self.cache_dir = cache_dir
+        self.builds = 0
+
+    @staticmethod
+    def from_config() -> typing.Optional["CompilerCache"]:
+        """
+        Returns the configured compiler cache or None if it is disabled.
+        """
+        if conf.compiler_cache is None:
+            return None
+        return CompilerCache(conf.compiler_cache, conf.compiler_cache_dir)
+
+    @staticmethod
+    def configure_chroot(cache: typing.Optional["CompilerCache"], chroot_dir: str):
+        """
+        Writes the makepkg configuration of the cache to the chroot or removes it when the cache
+        is disabled.
+        """
+        drop_in = os.path.join(chroot_dir, CompilerCache._MAKEPKG_DROP_IN)
+        if cache is None:
+            if os.path.exists(drop_in):
+                os.remove(drop_in)
+            return
+
+        os.makedirs(cache.cache_dir, exist_ok=True)
+        shutil.chown(cache.cache_dir, user=conf.makepkg_user)
+
+        if cache.kind == "ccache":
+            lines = ["BUILDENV+=(ccache)", f"export CCACHE_DIR='{cache.cache_dir}'"]
+        else:
+            lines = [
+                "export RUSTC_WRAPPER=/usr/bin/sccache",
+                f"export SCCACHE_DIR='{cache.cache_dir}'",
+            ]
+
+        os.makedirs(os.path.dirname(drop_in), exist_ok=True)
+        with open(drop_in, "wt", encoding="utf-8") as file:
+            file.write("# Generated by decman.\n" + "\n".join(lines) + "\n")
+
+    def chroot_packages(self) -> list[str]:
+        """
+        Returns packages that need to be installed in the chroot.
+        """
+        return [self.kind]
+
+    def get_statistics(self) -> dict[str, int]:
+        """
+        Returns the current statistics of the cache. ccache statistics are read with ccache on the
+        host, if it's available. No statistics are known for sccache.
+        """
+        stats: dict[str, int] = {}
+        if self.kind != "ccache" or shutil.which("ccache") is None:
+            return stats
+
+        try:
+            output = l.run_command(
+                conf.commands.ccache_stats(),
+                env=dict(os.environ, CCACHE_DIR=self.cache_dir),
+                check=True,
+                capture_output=True,
+            ).stdout.decode()
+        except (subprocess.CalledProcessError, OSError) as e:
+            l.print_debug(f"Failed to read ccache statistics: {e}")
+            return stats
+
+        for line in output.splitlines():
+            key, _, value = line.partition("\t")
+            if value.strip().isdigit():
+                stats[key] = int(value)
+        return stats
+
+    def print_statistics(self, package_names: list[str], before: dict[str, int]):
+        """
+        Prints how the cache was used since the before statistics were taken.
+
+        When packages are built in parallel, the statistics include other builds as well.
+        """
+        self.builds += 1
+        after = self.get_statistics()
+        if "cache_miss" not in after:
+            return
+
+        def delta(*keys: str) -> int:
+            return sum(after.get(key, 0) - before.get(key, 0) for key in keys)
+
+        hits = delta("direct_cache_hit", "preprocessed_cache_hit")
+        misses = delta("cache_miss")
+        size = delta("cache_size_kibibyte") / 1024
+        l.print_info(
+            f"{self.kind} for '{' '.join(package_names)}': {hits} hits, {misses} misses, "
+            f"cache size changed by {size:.1f} MiB."
+        )
+
+    def print_size(self):
+        """
+        Prints the size of an sccache cache if packages were built during this run. sccache has
+        no statistics of its own cache directory, so the directory is measured once per run.
+        """
+        if self.kind != "sccache" or self.builds == 0:
+            return
+        size = _directory_size(self.cache_dir) / (1024 * 1024)
+        l.print_info(f"{self.kind} cache size is {size:.1f} MiB.")
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class SourceCache:
+    """
+    Persistent download cache of PKGBUILD sources, used as makepkg's SRCDEST and SRCPKGDEST.
+
+    Sources listed in the .SRCINFO of a built package are marked as used by updating their
+    modification times. When the cache grows too large, the least recently used sources are
+    removed.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.srcdest = os.path.join(cache_dir, "src")
+        self.srcpkgdest = os.path.join(cache_dir, "srcpkg")
+
+    @staticmethod
+    def from_config() -> typing.Optional["SourceCache"]:
+        """
+        Returns the configured source cache or None if it is disabled.
+        """
+        if conf.source_cache_dir is None:
+            return None
+        return SourceCache(conf.source_cache_dir, conf.source_cache_max_size)
+
+    def prepare(self):
+        """
+        Creates the cache directories and makes them writable by the makepkg user.
+        """
+        for directory in (self.srcdest, self.srcpkgdest):
+            os.makedirs(directory, exist_ok=True)
+            shutil.chown(directory, user=conf.makepkg_user)
+
+    def environment(self) -> dict[str, str]:
+        """
+        Returns environment variables that make makepkg use the cache.
+        """
+        return {"SRCDEST": self.srcdest, "SRCPKGDEST": self.srcpkgdest}
+
+    def mark_used(self, pkgbuild_dir: str):
+        """
+        Marks the sources of the PKGBUILD in the given directory as recently used.
+        """
+        try:
+            with open(
+                os.path.join(pkgbuild_dir, ".SRCINFO"), "rt", encoding="utf-8"
+            ) as file:
+                srcinfo = file.read()
+        except OSError as e:
+            l.print_debug(f"Failed to read .SRCINFO in '{pkgbuild_dir}': {e}")
+            return
+
+        now = time.time()
+        for filename in _srcinfo_source_filenames(srcinfo):
+            path = os.path.join(self.srcdest, filename)
+            try:
+                os.utime(path, (now, now), follow_symlinks=False)
+            except OSError:
+                pass
+
+    def prune(self, max_size: typing.Optional[int] = None) -> tuple[int, int]:
+        """
+        Removes the least recently used sources until the cache is at most max_size bytes. Uses
+        the configured limit by default, which may be 0 for no limit. Returns the number of
+        removed sources and freed bytes.
+        """
+        if max_size is None:
+            if self.max_size <= 0:
+                return (0, 0)
+            max_size = self.max_size
+
+        entries = []
+        total = 0
+        for directory in (self.srcdest, self.srcpkgdest):
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    size = _directory_size(entry.path)
+                else:
+                    size = entry.stat(follow_symlinks=False).st_size
+                entries.append((entry.stat(follow_symlinks=False).st_mtime, size, entry))
+                total += size
+
+        entries.sort(key=lambda e: e[0])
+
+        removed = 0
+        freed = 0
+        for _, size, entry in entries:
+            if total - freed <= max_size:
+                break
+            l.print_debug(f"Removing cached source '{entry.path}'.")
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+            freed += size
+
+        return (removed, freed)
+
+
+def _srcinfo_sources(srcinfo: str) -> list[str]:
+    """
+    Returns the sources of all architectures listed in a .SRCINFO.
+    """
+    sources = []
+    for line in srcinfo.splitlines():
+        key, sep, value = line.strip().partition(" = ")
+        if sep and (key == "source" or key.startswith("source_")):
+            sources.append(value)
+    return sources
+
+
+def _source_protocol(source: str) -> typing.Optional[str]:
+    """
+    Returns the download protocol of a source like makepkg, or None for local files.
+    """
+    url = source.split("::", 1)[-1]
+    if url.startswith("lp:"):
+        return "bzr"
+    if "://" not in url:
+        return None
+    return url.split("://", 1)[0].split("+", 1)[0]
+
+
+def _srcinfo_source_filenames(srcinfo: str) -> list[str]:
+    """
+    Returns the names of the files makepkg downloads to SRCDEST for the sources in a .SRCINFO.
+    """
+    filenames = []
+    for value in _srcinfo_sources(srcinfo):
+        if "::" in value:
+            filenames.append(value.split("::", 1)[0])
+            continue
+
+        protocol = _source_protocol(value)
+        if protocol is None:
+            # Local files are in the PKGBUILD repository.
+            continue
+
+        if protocol in ("bzr", "git", "hg", "fossil", "svn"):
+            filename = value.split("#", 1)[0].split("?", 1)[0].rstrip("/")
+            filename = filename.rsplit("/", 1)[-1]
+            if protocol == "bzr":
+                filename = filename.split("lp:", 1)[-1]
+            elif protocol == "fossil":
+                filename = f"{filename}.fossil"
+            elif protocol == "git":
+                filename = filename.split(".git", 1)[0]
+        else:
+            filename = value.rsplit("/", 1)[-1]
+
+        if filename:
+            filenames.append(filename)
+    return filenames
+
+
+class DevelUpstreamTracker:
+    """
+    Keeps track of the upstream commits that devel packages were built from.
+
+    Only git sources can be checked. Packages with other VCS sources are always considered
+    changed. Remote refs are queried with 'git ls-remote' at most once per run.
+    """
+
+    _VCS_PROTOCOLS = ("bzr", "git", "hg", "fossil", "svn")
+
+    def __init__(self, store: l.Store):
+        self._store = store
+        self._remote_commits: dict[str, typing.Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def has_upstream_changed(self, pkgbase: str) -> bool:
+        """
+        Returns True if any upstream commit has changed since the latest build of the pkgbase or
+        if it's unknown.
+        """
+        recorded = self._store.devel_upstream_commits.get(pkgbase)
+        if not recorded:
+            return True
+
+        for source, commit in recorded.items():
+            url, _, ref = source.rpartition("#")
+            current = self._get_remote_commit(url, ref)
+            if current is None or current != commit:
+                l.print_debug(f"Upstream of '{pkgbase}' has changed: {source}.")
+                return True
+
+        l.print_debug(f"Upstream of '{pkgbase}' hasn't changed.")
+        return False
+
+    def get_upstream_commits(self, pkgbuild_dir: str) -> typing.Optional[dict[str, str]]:
+        """
+        Returns the current upstream commits of the VCS sources of the PKGBUILD in the directory
+        or None if they can't all be determined.
+        """
+        try:
+            with open(
+                os.path.join(pkgbuild_dir, ".SRCINFO"), "rt", encoding="utf-8"
+            ) as file:
+                srcinfo = file.read()
+        except OSError as e:
+            l.print_debug(f"Failed to read .SRCINFO in '{pkgbuild_dir}': {e}")
+            return None
+
+        commits = {}
+        for source in _srcinfo_sources(srcinfo):
+            protocol = _source_protocol(source)
+            if protocol not in DevelUpstreamTracker._VCS_PROTOCOLS:
+                continue
+            if protocol != "git":
+                return None
+
+            url = source.split("::", 1)[-1]
+            url, _, fragment = url.partition("#")
+            url = url.split("?", 1)[0].removeprefix("git+")
+
+            kind, _, value = fragment.partition("=")
+            if kind == "commit":
+                # Pinned commits only change when the PKGBUILD changes.
+                continue
+            if kind == "branch":
+                ref = f"refs/heads/{value}"
+            elif kind == "tag":
+                ref = f"refs/tags/{value}"
+            else:
+                ref = "HEAD"
+
+            commit = self._get_remote_commit(url, ref)
+            if commit is None:
+                return None
+            commits[f"{url}#{ref}"] = commit
+        return commits
+
+    def record(self, pkgbase: str, commits: typing.Optional[dict[str, str]]):
+        """
+        Stores the upstream commits of a built pkgbase.
+        """
+        if commits:
+            self._store.devel_upstream_commits[pkgbase] = commits
+        else:
+            self._store.devel_upstream_commits.pop(pkgbase, None)
+
+    def _get_remote_commit(self, url: str, ref: str) -> typing.Optional[str]:
+        key = f"{url}#{ref}"
+        with self._lock:
+            if key in self._remote_commits:
+                return self._remote_commits[key]
+
+        commit = _get_remote_commit(url, ref)
+
+        with self._lock:
+            self._remote_commits[key] = commit
+        return commit
+
+
+class BuildCheckpoint:
+    """
+    Progress of a foreign package install stored in the Store after every build.
+
+    The checkpoint identifies the install by the resolved packages, their versions and the build
+    order. When a failed install is resumed with the same resolution, package bases that were
+    built are not built again and PKGBUILDs that were reviewed are not reviewed again.
+    """
+
+    def __init__(
+        self,
+        store: l.Store,
+        search: ExtendedPackageSearch,
+        resolved_deps: ResolvedDependencies,
+    ):
+        self._store = store
+        plan = hashlib.sha256()
+        for label, names in [
+            ("explicit", sorted(resolved_deps.foreign_pkgs)),
+            ("dependency", sorted(resolved_deps.foreign_dep_pkgs)),
+            ("build", resolved_deps.build_order),
+        ]:
+            for name in names:
+                info = search.get_package_info(name)
+                version = info.version if info is not None else ""
+                plan.update(f"{label} {name} {version}\n".encode())
+        self.plan = plan.hexdigest()
+        self.resumed = False
+        self._resume = False
+
+    def load(self, resume: bool):
+        """
+        Continues a stored checkpoint with the same plan when resume is set. The Store isn't
+        changed until start is called.
+        """
+        self._resume = resume
+        built = self._store.build_checkpoints.get(self.plan)
+        if resume and built is not None:
+            l.print_summary(
+                f"Resuming a previous install. {len(built)} package bases have been built."
+            )
+            self.resumed = True
+        elif resume:
+            l.print_debug("No unfinished install with the same packages to resume.")
+
+    def start(self):
+        """
+        Starts recording the progress of the install. Other checkpoints are discarded unless
+        resume was set.
+        """
+        if self.resumed:
+            return
+        if not self._resume:
+            self._store.build_checkpoints.clear()
+        self._store.build_checkpoints[self.plan] = {}
+
+    def is_built(self, pkgbase: str) -> bool:
+        """
+        Returns True if the package base was built by the resumed install and its files are still
+        in the package cache.
+        """
+        if not self.resumed:
+            return False
+        files = self._store.build_checkpoints[self.plan].get(pkgbase)
+        return files is not None and all(map(os.path.exists, files))
+
+    def was_reviewed(self, pkgbase: str, commit: str) -> bool:
+        """
+        Returns True if the PKGBUILD at the given commit was reviewed by the resumed install.
+        """
+        return (
+            self.resumed
+            and self._store.pkgbuild_latest_reviewed_commits.get(pkgbase) == commit
+        )
+
+    def mark_built(self, pkgbase: str, files: list[str]):
+        """
+        Records that a package base was built and saves the Store.
+        """
+        self._store.build_checkpoints.setdefault(self.plan, {})[pkgbase] = files
+        try:
+            self._store.save()
+        except err.UserFacingError as error:
+            l.print_warning(f"Failed to save the build checkpoint: {error.user_facing_msg}")
+
+    def finish(self):
+        """
+        Removes the checkpoint after the install has finished.
+        """
+        self._store.build_checkpoints.pop(self.plan, None)
+
+
+class BuildLog:
+    """
+    Log of a single package base build.
+
+    Output of the build is streamed line by line to a log file in a directory of the package base,
+    so memory use doesn't depend on the length of the output. Only the last lines are kept in
+    memory and printed when the build fails. Old log files are removed so that at most
+    conf.build_logs_kept logs are kept for each package base.
+    """
+
+    def __init__(self, log_dir: typing.Optional[str], pkgbase: str, tail_lines: int = 50):
+        self.path = None
+        if log_dir is not None:
+            # Nanoseconds keep the names of builds started in the same second apart.
+            now = time.time_ns()
+            name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now // 10**9))
+            self.path = os.path.join(log_dir, pkgbase, f"{name}.{now % 10**9:09d}.log")
+        self.tail: collections.deque[bytes] = collections.deque(maxlen=tail_lines)
+
+    def run(
+        self,
+        command: list[str],
+        cwd: typing.Optional[str] = None,
+        env: typing.Optional[dict[str, str]] = None,
+        echo: bool = False,
+    ):
+        """
+        Runs the command writing its stdout and stderr to the log file. The output is also written
+        to stdout when echo is set.
+
+        Raises:
+            subprocess.CalledProcessError
+                If the command exits with a non-zero status. The output of the error is the tail of
+                the log.
+        """
+        started = time.monotonic()
+        with contextlib.ExitStack() as stack:
+            log_file = None
+            if self.path is not None:
+                self._rotate()
+                log_file = stack.enter_context(open(self.path, "wb"))
+
+            process = stack.enter_context(
+                subprocess.Popen(
+                    command,
+                    cwd=cwd,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+            )
+            assert process.stdout is not None
+            # Lines are read in bounded pieces, so a single huge line isn't buffered either.
+            for line in iter(lambda: process.stdout.readline(64 * 1024), b""):
+                self.tail.append(line)
+                if log_file is not None:
+                    log_file.write(line)
+                if echo:
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.buffer.flush()
+            # The process is reaped here, so Popen doesn't wait for it again.
+            process.returncode = l.reap_child(process.pid, command, started)
+            returncode = process.returncode
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=self.tail_text())
+
+    def tail_text(self) -> str:
+        """
+        Returns the last lines of the output.
+        """
+        return b"".join(self.tail).decode(errors="replace")
+
+    def _rotate(self):
+        assert self.path is not None
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        logs = sorted(f for f in os.listdir(directory) if f.endswith(".log"))
+        for name in logs[: max(0, len(logs) - conf.build_logs_kept + 1)]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError as e:
+                l.print_debug(f"Failed to remove old build log '{name}': {e}")
+
+
+class PackageBuilder:
+    """
+    Used for building packages in a chroot.
+    """
+
+    # Include a minimal base system in the chroot to avoid pacstrap failures.
+    always_included_packages = ["base", "base-devel", "git"]
+
+    def __init__(
+        self,
+        search: ExtendedPackageSearch,
+        store: l.Store,
+        resolved_deps: ResolvedDependencies,
+        devel_tracker: typing.Optional[DevelUpstreamTracker] = None,
+        pacman: typing.Optional[l.Pacman] = None,
+        checkpoint: typing.Optional[BuildCheckpoint] = None,
+    ):
+        self._search = search
+        self._store = store
+        self._resolved_deps = resolved_deps
+        self._devel_tracker = devel_tracker
+        self._pacman = pacman
+        self._checkpoint = checkpoint
+        self._pkgbuild_commits: dict[str, typing.Optional[str]] = {}
+        self.compiler_cache = CompilerCache.from_config()
+        self.source_cache = SourceCache.from_config()
+        self.local_repo = LocalRepository.from_config()
+        self.cache_index = PackageFileIndex(
+            conf.pkg_cache_dir, os.path.join(conf.pkg_cache_dir, "decman-files.json")
+        )
+        chroot_packages = list(PackageBuilder.always_included_packages)
+        if self.compiler_cache is not None:
+            chroot_packages += self.compiler_cache.chroot_packages()
+        self.chroot = BuildChroot(
+            conf.build_chroot_dir,
+            chroot_packages,
+            [self.local_repo.directory] if self.local_repo is not None else None,
+        )
+        self.chroot_wd_dir = self.chroot.chroot_wd_dir
+        self.chroot_dir = self.chroot.chroot_dir
+        self._pkgs_in_chroot_before_run: typing.Optional[set[str]] = None
+        self._store_lock = threading.Lock()
+        self._environment_lock = threading.Lock()
+        self._environment_created = False
+        self._pkgbases_to_build: typing.Optional[set[str]] = None
+        self._chroot_build_deps: set[str] = set()
+        self.reused_build_deps = 0
+        self.pkgbase_dir_map = {}
+        self.original_wd = ""
+        self._pkgs_in_chroot = set(PackageBuilder.always_included_packages)
+        self._pkgs_in_chroot.update(resolved_deps.pacman_deps)
+
+    def __enter__(self):
+        self.store_wd()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.restore_wd()
+        if self._environment_created:
+            self.remove_build_environment()
+
+    def plan_builds(self, force: bool) -> list[str]:
+        """
+        Returns the package bases that have to be built in build order. Package bases whose
+        packages are all cached are not built unless force is set.
+
+        Package bases that depend on a package base that is built are built as well.
+        """
+        packages_by_pkgbase: dict[str, list[ForeignPackage]] = {}
+        for pkgname in self._resolved_deps.build_order:
+            pkgbase = self._resolved_deps.get_pkgbase(pkgname)
+            if pkgbase not in packages_by_pkgbase:
+                packages_by_pkgbase[pkgbase] = [
+                    self._resolved_deps.packages[name]
+                    for name in self._resolved_deps.get_pkgs_with_common_pkgbase(pkgname)
+                ]
+
+        if not force:
+            self._fetch_pkgbuild_commits(
+                [
+                    pkgbase
+                    for pkgbase, packages in packages_by_pkgbase.items()
+                    if all(self._store.get_build_key(p.name) for p in packages)
+                ]
+            )
+
+        pkgbases: list[str] = []
+        for pkgbase, packages in packages_by_pkgbase.items():
+            if self._checkpoint is not None and self._checkpoint.is_built(pkgbase):
+                l.print_debug(f"'{pkgbase}' was built by the resumed install.")
+                continue
+            if force or not self._is_build_cached(pkgbase, packages, set(pkgbases)):
+                pkgbases.append(pkgbase)
+
+        self._pkgbases_to_build = set(pkgbases)
+        return pkgbases
+
+    def _fetch_pkgbuild_commits(self, pkgbases: list[str]):
+        """
+        Looks up the latest commits of the PKGBUILD repositories of the given package bases.
+        """
+        git_urls = {}
+        for pkgbase in pkgbases:
+            info = self._search.get_package_info(
+                self._resolved_deps.get_some_pkgname(pkgbase)
+            )
+            assert info is not None
+            git_urls[pkgbase] = info.git_url
+
+        if not git_urls:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, conf.max_parallel_clones)
+        ) as executor:
+            commits = executor.map(
+                lambda url: _get_remote_commit(url, "HEAD"), git_urls.values()
+            )
+            self._pkgbuild_commits.update(zip(git_urls, commits))
+
+    def _is_build_cached(
+        self, pkgbase: str, packages: list[ForeignPackage], rebuilt_pkgbases: set[str]
+    ) -> bool:
+        """
+        Returns True if the cached packages of the package base were built from the same
+        inputs that a new build would use.
+
+        Packages cached without a build key are compared by version.
+        """
+        for pkg in packages:
+            for dep in pkg.iter_all_recursive_foreign_dep_pkgs():
+                if self._resolved_deps.get_pkgbase(dep) in rebuilt_pkgbases:
+                    l.print_debug(f"'{pkgbase}' depends on '{dep}', which is rebuilt.")
+                    return False
+
+        records = [self._store.get_build_key(pkg.name) for pkg in packages]
+        key = None
+        if all(records):
+            key = self._get_build_key(packages, self._pkgbuild_commits.get(pkgbase))
+
+        if key is None:
+            return self._are_all_pkgs_cached(packages)
+
+        for record in records:
+            assert record is not None
+            if record[0] != key:
+                l.print_debug(f"Build inputs of '{pkgbase}' have changed.")
+                return False
+
+        return not self._has_devel_upstream_changed(packages)
+
+    def _get_build_key(
+        self, packages: list[ForeignPackage], pkgbuild_commit: typing.Optional[str]
+    ) -> typing.Optional[str]:
+        """
+        Returns a hash of the inputs of a build: the PKGBUILD commit, the versions of the pacman
+        packages satisfying the dependencies and the hashes of the cached foreign dependencies.
+
+        Returns None if any of them can't be determined.
+        """
+        if pkgbuild_commit is None or self._pacman is None:
+            return None
+
+        pacman_deps = set()
+        foreign_deps = set()
+        for pkg in packages:
+            info = self._search.get_package_info(pkg.name)
+            assert info is not None
+            pacman_deps.update(info.pacman_dependencies)
+            pacman_deps.update(info.pacman_make_dependencies)
+            pacman_deps.update(info.pacman_check_dependencies)
+            foreign_deps.update(pkg.iter_all_recursive_foreign_dep_pkgs())
+        foreign_deps.difference_update(pkg.name for pkg in packages)
+
+        key = hashlib.sha256(f"pkgbuild {pkgbuild_commit}\n".encode())
+        for dep in sorted(pacman_deps):
+            version = self._pacman.get_satisfier_version(dep)
+            if version is None:
+                return None
+            key.update(f"pacman {dep} {version}\n".encode())
+
+        for dep in sorted(foreign_deps):
+            record = self._store.get_build_key(dep)
+            if record is not None:
+                sha256 = record[1]
+            else:
+                entry = self._store.get_package(dep)
+                sha256 = _hash_file(entry[1]) if entry is not None else None
+            if sha256 is None:
+                return None
+            key.update(f"foreign {dep} {sha256}\n".encode())
+
+        return key.hexdigest()
+
+    def ensure_build_environment(self):
+        """
+        Creates the build environment unless it has already been created.
+        """
+        with self._environment_lock:
+            if not self._environment_created:
+                self._environment_created = True
+                self.create_build_environment()
+
+    def store_wd(self):
+        """
+        Remembers the current working directory as the original working directory.
+        """
+        self.original_wd = os.getcwd()
+
+    def restore_wd(self):
+        """
+        Returns to the original working directory.
+        """
+        os.chdir(self.original_wd)
+
+    def create_build_environment(self):
+        """
+        Prepares the chroot and clones the PKGBUILDS of the package bases that will be built.
+        """
+        l.print_info("Creating a build environment..")
+
+        if os.path.exists(conf.build_dir):
+            l.print_info("Removing previous build directory.")
+            shutil.rmtree(conf.build_dir)
 
         l.print_info("Getting all PKGBUILDS.")
 
         # Set up PKGBUILDS
+        git_urls = {}
         for pkgbase in self._resolved_deps.all_pkgbases():
+            if (
+                self._pkgbases_to_build is not None
+                and pkgbase not in self._pkgbases_to_build
+            ):
+                continue
+
             pkgbuild_dir = os.path.join(conf.build_dir, pkgbase)
             self.pkgbase_dir_map[pkgbase] = pkgbuild_dir
             os.makedirs(pkgbuild_dir)
-            os.chdir(pkgbuild_dir)
 
             git_url_info = self._search.get_package_info(
                 self._resolved_deps.get_some_pkgname(pkgbase)
@@ -896,122 +2674,326 @@ class PackageBuilder:
             # Because all dependencies and packages should be resolved during the creation
             # of ResolvedDependencies. git_url should not be None.
             assert git_url_info is not None
-            git_url = git_url_info.git_url
-
-            l.print_debug(f"Git URL for '{pkgbase}' is '{git_url}'")
-            self._git_clone_and_review_pkgbuild(pkgbase, git_url)
-            shutil.chown(pkgbuild_dir, user=conf.makepkg_user)
-
-        l.print_info("Creating a new chroot.")
-        os.makedirs(self.chroot_wd_dir)
-
-        # Remove GNUPGHOME from mkarchroot environment variables since it may interfere with
-        # the chroot creation
-        mkarchroot_env_vars = os.environ.copy()
-        try:
-            del mkarchroot_env_vars["GNUPGHOME"]
-            l.print_debug("Removed GNUPGHOME variable from mkarchroot environment.")
-        except KeyError:
-            pass
+            git_urls[pkgbase] = git_url_info.git_url
+            l.print_debug(f"Git URL for '{pkgbase}' is '{git_url_info.git_url}'")
 
-        # Ensure decman's pacman/yay/paru guard wrappers do not block mkarchroot
-        # which legitimately needs to invoke pacman on the host.
-        mkarchroot_env_vars["DECMAN_ALLOW"] = "1"
+        self._clone_pkgbuilds(git_urls)
 
-        # Normalize package specs to real package names for mkarchroot
-        mkarchroot_pkgs = self._resolve_host_pkg_names(list(self._pkgs_in_chroot))
+        for pkgbase, git_url in git_urls.items():
+            pkgbuild_dir = self.pkgbase_dir_map[pkgbase]
+            commit = self._get_local_commit(pkgbuild_dir)
+            if (
+                self._checkpoint is not None
+                and commit is not None
+                and self._checkpoint.was_reviewed(pkgbase, commit)
+            ):
+                l.print_info(f"PKGBUILD of '{pkgbase}' was reviewed by the resumed install.")
+            else:
+                self._review_pkgbuild(pkgbase, git_url, pkgbuild_dir)
+            shutil.chown(pkgbuild_dir, user=conf.makepkg_user)
 
-        try:
-            subprocess.run(
-                conf.commands.make_chroot(self.chroot_dir, mkarchroot_pkgs),
-                env=mkarchroot_env_vars,
+        os.makedirs(conf.pkg_cache_dir, exist_ok=True)
+        if self.local_repo is not None:
+            self.local_repo.ensure_database()
+        # The existing chroot is upgraded with its own pacman.conf, which may still list the
+        # repository after it was disabled.
+        if os.path.isfile(os.path.join(self.chroot_dir, "etc/pacman.conf")):
+            LocalRepository.configure_chroot(self.local_repo, self.chroot_dir)
+
+        self.chroot.prepare()
+        self._pkgs_in_chroot_before_run = self.chroot.installed_packages()
+        CompilerCache.configure_chroot(self.compiler_cache, self.chroot_dir)
+        LocalRepository.configure_chroot(self.local_repo, self.chroot_dir)
+        self.cache_index.refresh()
+        if self.local_repo is not None:
+            # Packages cached before the repository existed or while it was disabled.
+            cached = []
+            for pkgname in self._resolved_deps.packages:
+                entry = self._store.get_package(pkgname)
+                pkg_file = self.cache_index.get(entry[1]) if entry is not None else None
+                if pkg_file is not None:
+                    cached.append((pkg_file.name, pkg_file.version, pkg_file.path))
+            self.local_repo.add_missing(cached)
+        if self.source_cache is not None:
+            self.source_cache.prepare()
+
+        run_pacman_deps = self._resolve_chroot_pkg_names(
+            sorted(self._resolved_deps.pacman_deps)
+        )
+        if run_pacman_deps:
+            l.print_info("Installing pacman dependencies to chroot.")
+            l.run_command(
+                conf.commands.install_chroot_packages(self.chroot_dir, run_pacman_deps),
                 check=True,
                 capture_output=conf.suppress_command_output,
             )
-        except subprocess.CalledProcessError as e:
-            # Surface mkarchroot stderr/stdout to help diagnose exit 255 issues
-            try:
-                err_out = (e.stderr or b"").decode(errors="ignore").strip()
-                out = (e.stdout or b"").decode(errors="ignore").strip()
-            except Exception:
-                err_out, out = "", ""
-            l.print_error(
-                f"mkarchroot failed (exit {e.returncode}). Packages: {mkarchroot_pkgs}"
-            )
-            if out:
-                l.print_warning("mkarchroot stdout:")
-                l.print_continuation(out)
-            if err_out:
-                l.print_warning("mkarchroot stderr:")
-                l.print_continuation(err_out)
-            raise
 
     def remove_build_environment(self):
         """
-        Deletes the build environment.
+        Deletes the PKGBUILDs and removes packages installed for this run from the chroot.
         """
-        shutil.rmtree(conf.build_dir)
+        if os.path.exists(conf.build_dir):
+            shutil.rmtree(conf.build_dir)
+
+        self.cache_index.save()
+
+        if self.source_cache is not None:
+            try:
+                removed, freed = self.source_cache.prune()
+                if removed:
+                    l.print_info(
+                        f"Removed {removed} cached sources ({freed / 1024**2:.1f} MiB)."
+                    )
+            except OSError as e:
+                l.print_warning(f"Failed to prune the source cache: {e}")
+
+        if self.compiler_cache is not None:
+            self.compiler_cache.print_size()
+
+        if self.reused_build_deps:
+            l.print_info(
+                f"Avoided {self.reused_build_deps} build dependency installs by keeping "
+                "them in the chroot between builds."
+            )
+
+        if self._pkgs_in_chroot_before_run is None:
+            return
+
+        try:
+            to_remove = sorted(
+                self.chroot.installed_packages() - self._pkgs_in_chroot_before_run
+            )
+            if to_remove:
+                l.print_info("Removing pacman dependencies from chroot.")
+                l.run_command(
+                    conf.commands.remove_chroot_packages(self.chroot_dir, to_remove),
+                    check=True,
+                    capture_output=conf.suppress_command_output,
+                )
+            self.chroot.mark_clean()
+        except (subprocess.CalledProcessError, OSError) as e:
+            # The chroot is recreated during the next run, since it isn't marked as clean.
+            l.print_warning(f"Failed to clean up the chroot: {e}")
 
     def build_packages(
-        self, package_base: str, packages: list[ForeignPackage], force: bool
+        self,
+        package_base: str,
+        packages: list[ForeignPackage],
+        force: bool,
+        working_copy: typing.Optional[str] = None,
     ):
         """
         Builds package(s) with the same package base.
 
         Set force to true to force rebuilds of packages that are already cached
+
+        When working_copy is given, the package is built in a chroot copy with that name and the
+        master chroot is not modified, so that multiple packages can be built at the same time.
+        Pacman build dependencies are then installed into the copy by makepkg.
         """
 
         package_names = list(map(lambda p: p.name, packages))
 
         # Rebuild is only needed if at least one package is not in the cache.
 
-        if self._are_all_pkgs_cached(packages) and not force:
+        if self._pkgbases_to_build is not None:
+            needs_build = package_base in self._pkgbases_to_build
+        else:
+            needs_build = force or not self._is_build_cached(package_base, packages, set())
+
+        if not needs_build:
             l.print_info(
                 f"Skipped building '{' '.join(package_names)}'. Already up to date."
             )
             return
 
+        self.ensure_build_environment()
+
+        with l.resource_usage.attribute_to(package_base):
+            self._build_package_base(package_base, packages, working_copy)
+
+    def _build_package_base(
+        self,
+        package_base: str,
+        packages: list[ForeignPackage],
+        working_copy: typing.Optional[str],
+    ):
+        package_names = [p.name for p in packages]
+
         l.print_info(f"Building '{' '.join(package_names)}'.")
 
         chroot_new_pacman_pkgs, chroot_pkg_files = self._get_chroot_packages(packages)
+        if self.local_repo is not None:
+            # makepkg installs foreign dependencies from the local repository. The lock keeps
+            # the copy from overlapping with packages being added to the repository.
+            with self._store_lock:
+                self.local_repo.sync_chroot(self.chroot_dir)
+            chroot_pkg_files = []
 
         pkgbuild_dir = self.pkgbase_dir_map[package_base]
-        os.chdir(pkgbuild_dir)
+
+        # Query upstream before building so that commits made during the build cause a rebuild
+        # on the next run.
+        upstream_commits = None
+        if self._devel_tracker is not None and any(map(is_devel, package_names)):
+            upstream_commits = self._devel_tracker.get_upstream_commits(pkgbuild_dir)
+
+        # Foreign dependencies have been built already, so the key of this build is known.
+        pkgbuild_commit = self._get_local_commit(pkgbuild_dir)
+        with self._store_lock:
+            build_key = self._get_build_key(packages, pkgbuild_commit)
 
         l.print_debug(
             f"Chroot dir is: '{self.chroot_dir}', pkgbuild dir is '{pkgbuild_dir}'."
         )
 
-        l.print_info("Installing build dependencies to chroot.")
+        if working_copy is not None:
+            l.print_info(f"Making package in chroot copy '{working_copy}'.")
+            self._make_chroot_pkg(
+                package_base, package_names, pkgbuild_dir, chroot_pkg_files, working_copy
+            )
+            self._cache_built_packages(
+                package_base, package_names, pkgbuild_dir, upstream_commits, build_key
+            )
+            l.print_info(f"Finished building: '{' '.join(package_names)}'.")
+            return
 
-        # Resolve any virtual/soname-style specs to real package names within the chroot
-        chroot_install_pkgs = self._resolve_chroot_pkg_names(
-            chroot_new_pacman_pkgs
-        ) + PackageBuilder.always_included_packages
-
-        subprocess.run(
-            conf.commands.install_chroot_packages(
-                self.chroot_dir,
-                chroot_install_pkgs,
-            ),
-            check=True,
-            capture_output=conf.suppress_command_output,
-        )
+        self._update_chroot_build_deps(chroot_new_pacman_pkgs)
 
         l.print_info("Making package.")
 
-        subprocess.run(
-            conf.commands.make_chroot_pkg(
-                self.chroot_wd_dir, conf.makepkg_user, chroot_pkg_files
-            ),
-            check=True,
-            capture_output=conf.quiet_output,
+        self._make_chroot_pkg(
+            package_base, package_names, pkgbuild_dir, chroot_pkg_files
+        )
+
+        self._cache_built_packages(
+            package_base, package_names, pkgbuild_dir, upstream_commits, build_key
+        )
+
+        l.print_info(f"Finished building: '{' '.join(package_names)}'.")
+
+    def _update_chroot_build_deps(self, pacman_build_deps: list[str]):
+        """
+        Changes the build dependencies installed in the chroot to the given ones.
+
+        Build dependencies are left in the chroot after a build, so only the difference to the
+        previous build is removed and installed. Everything is removed when the build
+        environment is removed.
+        """
+        # Resolve any virtual/soname-style specs to real package names within the chroot
+        required = set(self._resolve_chroot_pkg_names(pacman_build_deps))
+        required -= self._pkgs_in_chroot_before_run or set()
+
+        stale = sorted(self._chroot_build_deps - required)
+        if stale:
+            l.print_info("Removing unneeded build dependencies from chroot.")
+            l.run_command(
+                conf.commands.remove_chroot_packages(self.chroot_dir, stale),
+                check=True,
+                capture_output=conf.suppress_command_output,
+            )
+
+        # Removing stale packages may also remove packages that were only installed as their
+        # dependencies, so the chroot database is checked instead of trusting the previous set.
+        installed = self.chroot.installed_packages()
+        missing = sorted(required - installed)
+        if missing:
+            l.print_info("Installing build dependencies to chroot.")
+            l.run_command(
+                conf.commands.install_chroot_packages(self.chroot_dir, missing),
+                check=True,
+                capture_output=conf.suppress_command_output,
+            )
+
+        # Packages installed only as dependencies of the run's pacman dependencies would not
+        # have been installed again by 'pacman -S --needed' either, so they aren't counted.
+        reused = len(required & self._chroot_build_deps & installed)
+        l.print_debug(
+            f"Build dependencies: {len(missing)} installed, {len(stale)} removed, "
+            f"{reused} reused."
         )
+        self.reused_build_deps += reused
+        self._chroot_build_deps = required
+
+    def _make_chroot_pkg(
+        self,
+        package_base: str,
+        package_names: list[str],
+        pkgbuild_dir: str,
+        chroot_pkg_files: list[str],
+        working_copy: typing.Optional[str] = None,
+    ):
+        bind_mounts = None
+        if self.compiler_cache is not None:
+            bind_mounts = [self.compiler_cache.cache_dir]
+            cache_stats = self.compiler_cache.get_statistics()
+        read_only_bind_mounts = None
+        if self.local_repo is not None:
+            read_only_bind_mounts = [self.local_repo.directory]
+
+        env = None
+        if self.source_cache is not None:
+            env = dict(os.environ, **self.source_cache.environment())
+        if conf.devel_work_dir is not None and any(map(is_devel, package_names)):
+            # VCS checkouts of devel packages are kept in a work area of their own, so that
+            # they are updated incrementally and never pruned from the source cache.
+            srcdest = os.path.join(conf.devel_work_dir, package_base)
+            os.makedirs(srcdest, exist_ok=True)
+            shutil.chown(srcdest, user=conf.makepkg_user)
+            env = dict(env or os.environ, SRCDEST=srcdest)
+
+        build_log = BuildLog(conf.build_log_dir, package_base, conf.build_log_tail_lines)
+        try:
+            build_log.run(
+                conf.commands.make_chroot_pkg(
+                    self.chroot_wd_dir,
+                    conf.makepkg_user,
+                    chroot_pkg_files,
+                    working_copy=working_copy,
+                    bind_mounts=bind_mounts,
+                    read_only_bind_mounts=read_only_bind_mounts,
+                ),
+                cwd=pkgbuild_dir,
+                env=env,
+                echo=not conf.quiet_output,
+            )
+        except subprocess.CalledProcessError:
+            if conf.quiet_output and build_log.tail:
+                l.print_error(
+                    f"Last lines of the build output of '{package_base}':\n"
+                    f"{build_log.tail_text().rstrip()}"
+                )
+            if build_log.path is not None:
+                l.print_error(f"Full build log of '{package_base}': '{build_log.path}'.")
+            raise
+
+        if build_log.path is not None:
+            l.print_debug(f"Build log of '{package_base}' written to '{build_log.path}'.")
+
+        if self.source_cache is not None:
+            self.source_cache.mark_used(pkgbuild_dir)
+
+        if self.compiler_cache is not None:
+            self.compiler_cache.print_statistics(package_names, cache_stats)
+
+    def _cache_built_packages(
+        self,
+        package_base: str,
+        package_names: list[str],
+        pkgbuild_dir: str,
+        upstream_commits: typing.Optional[dict[str, str]] = None,
+        build_key: typing.Optional[str] = None,
+    ):
+        build_index = PackageFileIndex(pkgbuild_dir)
+        build_index.refresh()
 
+        cached_files = []
         for pkgname in package_names:
-            file = self._find_pkgfile(pkgname, pkgbuild_dir)
+            pkg_file = self._find_pkgfile(pkgname, build_index)
 
-            dest = shutil.copy(file, conf.pkg_cache_dir)
+            dest = shutil.copy(pkg_file.path, conf.pkg_cache_dir)
+            cached_files.append(dest)
+            sha256 = _hash_file(dest) if build_key is not None else None
 
             pkg_info = self._search.get_package_info(pkgname)
 
@@ -1024,31 +3006,24 @@ class PackageBuilder:
                 f"Adding '{pkgname}', version: '{version}' to cache as file '{dest}'."
             )
 
-            self._store.add_package_to_cache(pkgname, version, dest)
-
-        l.print_info("Removing build dependencies from chroot.")
-
-        if len(chroot_new_pacman_pkgs) != 0:
-            to_remove = []
-            for p in chroot_new_pacman_pkgs:
-                if p not in self._pkgs_in_chroot:
-                    real_pkgname = (
-                        subprocess.run(
-                            conf.commands.resolve_real_name(self.chroot_dir, p),
-                            check=True,
-                            stdout=subprocess.PIPE,
-                        )
-                        .stdout.decode()
-                        .strip()
-                    )
-                    to_remove.append(real_pkgname)
-            subprocess.run(
-                conf.commands.remove_chroot_packages(self.chroot_dir, to_remove),
-                check=True,
-                capture_output=conf.suppress_command_output,
-            )
-
-        l.print_info(f"Finished building: '{' '.join(package_names)}'.")
+            with self._store_lock:
+                self.cache_index.add(
+                    alpm.PackageFile(dest, pkg_file.name, pkg_file.version, pkg_file.arch)
+                )
+                self._store.add_package_to_cache(pkgname, version, dest)
+                if build_key is not None and sha256 is not None:
+                    self._store.set_build_key(pkgname, build_key, dest, sha256)
+
+        # Packages of the same package base are built only once per run.
+        with self._store_lock:
+            if self.local_repo is not None:
+                self.local_repo.add(cached_files)
+            if self._checkpoint is not None:
+                self._checkpoint.mark_built(package_base, cached_files)
+            if self._devel_tracker is not None and any(map(is_devel, package_names)):
+                self._devel_tracker.record(package_base, upstream_commits)
+            if self._pkgbases_to_build is not None:
+                self._pkgbases_to_build.discard(package_base)
 
     def _are_all_pkgs_cached(self, pkgs: list[ForeignPackage]) -> bool:
         for pkg in pkgs:
@@ -1064,19 +3039,44 @@ class PackageBuilder:
             assert pkg_info is not None
             fetched_version = pkg_info.version
 
-            if cached_version != fetched_version or is_devel(pkg.name):
+            if cached_version != fetched_version:
                 return False
-        return True
 
-    def _get_chroot_packages(
-        self, pkgs_to_build: list[ForeignPackage]
-    ) -> tuple[list[str], list[str]]:
+        return not self._has_devel_upstream_changed(pkgs)
+
+    def _has_devel_upstream_changed(self, pkgs: list[ForeignPackage]) -> bool:
+        for pkg in pkgs:
+            if is_devel(pkg.name) and (
+                self._devel_tracker is None
+                or self._devel_tracker.has_upstream_changed(
+                    self._resolved_deps.get_pkgbase(pkg.name)
+                )
+            ):
+                return True
+        return False
+
+    def _get_local_commit(self, pkgbuild_dir: str) -> typing.Optional[str]:
+        try:
+            return (
+                l.run_command(
+                    conf.commands.git_get_commit_id(),
+                    cwd=pkgbuild_dir,
+                    check=True,
+                    capture_output=True,
+                )
+                .stdout.decode()
+                .strip()
+            )
+        except (subprocess.CalledProcessError, OSError) as e:
+            l.print_debug(f"Failed to get the commit of '{pkgbuild_dir}': {e}")
+            return None
+
+    def get_pacman_build_deps(self, pkgs_to_build: list[ForeignPackage]) -> set[str]:
         """
-        Returns a tuple of pacman build dependencies and built foreign pkgs files that are needed
-        in the chroot before building. pkgs_to_build share the same pkgbase.
+        Returns the pacman build dependencies that have to be installed to the chroot in
+        addition to the pacman dependencies of this run. pkgs_to_build share the same pkgbase.
         """
         chroot_pacman_build_deps = set()
-        chroot_foreign_pkgs = set()
 
         def add_to_pacman_build_deps(deps: list[str]):
             for dep in deps:
@@ -1092,11 +3092,8 @@ class PackageBuilder:
             add_to_pacman_build_deps(info.pacman_make_dependencies)
             add_to_pacman_build_deps(info.pacman_check_dependencies)
 
-            foreign_deps = pkg.get_all_recursive_foreign_dep_pkgs()
-            chroot_foreign_pkgs.update(foreign_deps)
-
             # Add pacman deps of foreign packages
-            for dep in foreign_deps:
+            for dep in pkg.iter_all_recursive_foreign_dep_pkgs():
                 dep_info = self._search.get_package_info(dep)
                 # Because all dependencies and packages should be resolved during the creation
                 # of ResolvedDependencies. git_url should not be None.
@@ -1105,6 +3102,21 @@ class PackageBuilder:
                 add_to_pacman_build_deps(dep_info.pacman_make_dependencies)
                 add_to_pacman_build_deps(dep_info.pacman_check_dependencies)
 
+        return chroot_pacman_build_deps
+
+    def _get_chroot_packages(
+        self, pkgs_to_build: list[ForeignPackage]
+    ) -> tuple[list[str], list[str]]:
+        """
+        Returns a tuple of pacman build dependencies and built foreign pkgs files that are needed
+        in the chroot before building. pkgs_to_build share the same pkgbase.
+        """
+        chroot_pacman_build_deps = self.get_pacman_build_deps(pkgs_to_build)
+        chroot_foreign_pkgs = set()
+
+        for pkg in pkgs_to_build:
+            chroot_foreign_pkgs.update(pkg.iter_all_recursive_foreign_dep_pkgs())
+
         # Packages with the same pkgbase might depend on each other,
         # but they don't need to be installed for the build to succeed.
         for pkg in pkgs_to_build:
@@ -1124,45 +3136,100 @@ before and thus are found in the cache."
 
             chroot_foreign_pkg_files.append(file)
 
-        return (list(chroot_pacman_build_deps), chroot_foreign_pkg_files)
-
-    def _find_pkgfile(self, pkgname: str, pkgbuild_dir: str) -> str:
-        # HACK: Because we don't know the pkgarch we can't be sure what is the build result.
-        # Instead: we just try with pre- and postfixes.
+        return (sorted(chroot_pacman_build_deps), chroot_foreign_pkg_files)
 
-        matches = []
+    def _find_pkgfile(self, pkgname: str, build_index: PackageFileIndex) -> alpm.PackageFile:
+        matches = build_index.find(pkgname)
 
         info = self._search.get_package_info(pkgname)
         assert info is not None
-        prefix = info.pkg_file_prefix()
-
-        for file in os.scandir(pkgbuild_dir):
-            if file.is_file() and file.name.startswith(prefix):
-                for ext in conf.valid_pkgexts:
-                    if file.name.endswith(ext):
-                        matches.append(file.path)
-                        continue
+        if len(matches) > 1:
+            # The built version can differ from the AUR version when pkgver() is used.
+            matches = [pkg for pkg in matches if pkg.version == info.version] or matches
 
         if len(matches) != 1:
             raise err.UserFacingError(
-                f"Failed to build package '{pkgname}', because the pkg file cannot be determined. Possible files are: {matches}"
+                f"Failed to build package '{pkgname}', because the pkg file cannot be determined. Possible files are: {[pkg.path for pkg in matches]}"
             )
 
         return matches[0]
 
-    def _git_clone_and_review_pkgbuild(self, pkgbase: str, git_url: str):
+    def _clone_pkgbuilds(self, git_urls: dict[str, str]):
         """
-        Clones an PKGBUILD to the current directory.
+        Clones the PKGBUILDs of the given package bases to their build directories.
 
-        The user is prompted to review the PKGBUILD and confirm if the package should be built.
+        The repositories are cloned from persistent mirrors in conf.pkgbuild_mirror_dir, which are
+        first created or updated. At most conf.max_parallel_clones mirrors are updated at the same
+        time.
         """
-        try:
-            subprocess.run(
-                conf.commands.git_clone(git_url, "."),
+        if not git_urls:
+            return
+
+        os.makedirs(conf.pkgbuild_mirror_dir, exist_ok=True)
+
+        def clone(pkgbase: str):
+            git_url = git_urls[pkgbase]
+            mirror = os.path.join(conf.pkgbuild_mirror_dir, f"{pkgbase}.git")
+
+            updated = False
+            if os.path.isdir(mirror):
+                try:
+                    l.run_command(
+                        conf.commands.git_fetch_mirror(git_url),
+                        cwd=mirror,
+                        check=True,
+                        capture_output=True,
+                    )
+                    updated = True
+                except subprocess.CalledProcessError as error:
+                    l.print_debug(
+                        f"Failed to update mirror of '{pkgbase}', recreating it: "
+                        f"{(error.stderr or b'').decode(errors='ignore').strip()}"
+                    )
+                    shutil.rmtree(mirror)
+
+            if not updated:
+                l.run_command(
+                    conf.commands.git_clone_mirror(git_url, mirror),
+                    check=True,
+                    capture_output=True,
+                )
+
+            l.run_command(
+                conf.commands.git_clone(mirror, self.pkgbase_dir_map[pkgbase]),
                 check=True,
-                capture_output=conf.suppress_command_output,
+                capture_output=True,
+            )
+
+        failed = []
+        max_workers = max(1, min(conf.max_parallel_clones, len(git_urls)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(clone, pkgbase): pkgbase for pkgbase in git_urls}
+            for cloned, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                pkgbase = futures[future]
+                try:
+                    future.result()
+                    l.print_info(f"Cloned '{pkgbase}' ({cloned}/{len(futures)}).")
+                except subprocess.CalledProcessError as error:
+                    l.print_error(f"Failed to clone PKGBUILD from {git_urls[pkgbase]}")
+                    if conf.suppress_command_output:
+                        l.print_error("Output:")
+                        l.print_continuation(
+                            (error.stderr or b"").decode(errors="ignore").strip()
+                        )
+                    failed.append(pkgbase)
+
+        if failed:
+            raise err.UserFacingError(
+                f"Failed to clone PKGBUILDs of {', '.join(sorted(failed))}."
             )
 
+    def _review_pkgbuild(self, pkgbase: str, git_url: str, pkgbuild_dir: str):
+        """
+        Prompts the user to review the PKGBUILD cloned to pkgbuild_dir and confirm if the package
+        should be built.
+        """
+        try:
             if l.prompt_confirm(
                 f"Review PKGBUILD or show diff for {pkgbase}?", default=True
             ):
@@ -1171,8 +3238,9 @@ before and thus are found in the cache."
                 )
 
                 git_commit_ids = (
-                    subprocess.run(
+                    l.run_command(
                         conf.commands.git_log_commit_ids(),
+                        cwd=pkgbuild_dir,
                         check=True,
                         stdout=subprocess.PIPE,
                     )
@@ -1185,20 +3253,23 @@ before and thus are found in the cache."
                     latest_reviewed_commit is None
                     or latest_reviewed_commit not in git_commit_ids
                 ):
-                    for file in os.scandir("."):
+                    for file in os.scandir(pkgbuild_dir):
                         if file.is_file() and not file.name.startswith("."):
-                            subprocess.run(
+                            l.run_command(
                                 conf.commands.review_file(file.path), check=True
                             )
                 else:
-                    subprocess.run(
-                        conf.commands.git_diff(latest_reviewed_commit), check=True
+                    l.run_command(
+                        conf.commands.git_diff(latest_reviewed_commit),
+                        cwd=pkgbuild_dir,
+                        check=True,
                     )
 
             if l.prompt_confirm("Build this package?", default=True):
                 commit_id = (
-                    subprocess.run(
+                    l.run_command(
                         conf.commands.git_get_commit_id(),
+                        cwd=pkgbuild_dir,
                         check=True,
                         capture_output=True,
                     )
@@ -1214,63 +3285,12 @@ before and thus are found in the cache."
                 l.print_error("Output:")
                 l.print_continuation(error.output)
             raise err.UserFacingError(
-                f"Failed to clone and review PKGBUILD from {git_url}"
+                f"Failed to review PKGBUILD from {git_url}"
             ) from error
 
-    def _resolve_host_pkg_names(self, pkgs: list[str]) -> list[str]:
-        """
-        Resolve package specs (including soname-style like 'libfoo.so>=1') to real
-        repository package names on the host, using pacman. Falls back to the
-        original spec if resolution fails.
-        """
-        resolved: list[str] = []
-        for p in pkgs:
-            try:
-                result = subprocess.run(
-                    ["pacman", "-Sddp", "--print-format=%n", p],
-                    check=False,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                name = result.stdout.decode().strip()
-                resolved.append(name if result.returncode == 0 and name else p)
-            except Exception:  # pylint: disable=broad-except
-                resolved.append(p)
-        # Deduplicate while preserving order
-        seen = set()
-        ordered: list[str] = []
-        for n in resolved:
-            if n not in seen:
-                seen.add(n)
-                ordered.append(n)
-        return ordered
-
     def _resolve_chroot_pkg_names(self, pkgs: list[str]) -> list[str]:
         """
-        Resolve package specs to real package names inside the chroot using pacman
-        via arch-nspawn. Falls back to the original spec if resolution fails.
+        Resolve package specs to real package names inside the chroot. Falls back to the
+        original spec if resolution fails.
         """
-        resolved: list[str] = []
-        for p in pkgs:
-            try:
-                name = (
-                    subprocess.run(
-                        conf.commands.resolve_real_name(self.chroot_dir, p),
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                    )
-                    .stdout.decode()
-                    .strip()
-                )
-                resolved.append(name if name else p)
-            except Exception:  # pylint: disable=broad-except
-                resolved.append(p)
-        # Deduplicate while preserving order
-        seen = set()
-        ordered: list[str] = []
-        for n in resolved:
-            if n not in seen:
-                seen.add(n)
-                ordered.append(n)
-        return ordered
+        return list(dict.fromkeys(self.chroot.resolve_package_names(pkgs).values()))
@@ -0,0 +1,77 @@
+import itertools
+import os
+import random
+import sys
+import time
+
+# This benchmark is manual. Run it with python and compare the printed times.
+
+cd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cd, "../../src/."))
+
+from decman.lib.fpm import DepGraph
+
+NODES = 5000
+LAYERS = 50
+EDGES_PER_NODE = 4
+
+
+def layered_edges(seed: int) -> list[tuple[str, str]]:
+    """
+    Diamond heavy graph: every package depends on a few packages of the next layer, so most
+    packages are reachable through many different paths.
+    """
+    rng = random.Random(seed)
+    per_layer = NODES // LAYERS
+    layers = [[f"pkg-{layer}-{i}" for i in range(per_layer)] for layer in range(LAYERS)]
+    edges = []
+    for upper, lower in itertools.pairwise(layers):
+        for parent in upper:
+            for child in rng.sample(lower, EDGES_PER_NODE):
+                edges.append((child, parent))
+    return edges
+
+
+def shared_base_edges() -> list[tuple[str, str]]:
+    """
+    Many packages sharing a chain of common make dependencies.
+    """
+    edges = []
+    bases = [f"python-base-{i}" for i in range(NODES // 10)]
+    for upper, lower in itertools.pairwise(bases):
+        edges.append((lower, upper))
+    for i in range(NODES - len(bases)):
+        for base in bases[:3]:
+            edges.append((base, f"app-{i}-git"))
+    return edges
+
+
+def bench(name: str, edges: list[tuple[str, str]], bottom_up: bool):
+    if bottom_up:
+        edges = list(reversed(edges))
+
+    graph = DepGraph()
+    start = time.perf_counter()
+    for child, parent in edges:
+        graph.add_requirement(parent, None)
+        graph.add_requirement(child, parent)
+    added = time.perf_counter()
+
+    count = 0
+    while True:
+        removed = graph.get_and_remove_outer_dep_pkgs()
+        if not removed:
+            break
+        count += len(removed)
+    ordered = time.perf_counter()
+
+    order = "bottom-up" if bottom_up else "top-down"
+    print(
+        f"{name:12} {order:9} {len(graph.package_nodes):5} nodes {len(edges):6} edges: "
+        f"add_requirement {added - start:7.3f}s, build order {ordered - added:7.3f}s ({count})"
+    )
+
+
+for bottom_up in (False, True):
+    bench("layered", layered_edges(0), bottom_up)
+    bench("shared-base", shared_base_edges(), bottom_up)
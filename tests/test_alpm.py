@@ -0,0 +1,284 @@
+# pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
+
+import io
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import decman.config as conf
+from decman.lib import alpm
+
+
+def _write_db(path: str, entries: dict[str, str]):
+    with tarfile.open(path, "w:gz") as archive:
+        for name, content in entries.items():
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def _write_pkg(path: str, mode: str, pkginfo: str):
+    with tarfile.open(path, mode) as archive:
+        for name, content in [(".BUILDINFO", "format = 2\n"), (".PKGINFO", pkginfo),
+                              ("usr/bin/foo", "#!/bin/sh\n")]:
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def _desc(**sections: list[str]) -> str:
+    return "".join(
+        f"%{name}%\n" + "".join(f"{v}\n" for v in values) + "\n"
+        for name, values in sections.items()
+    )
+
+
+class TestSyncDbIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db_path = self.tmp.name
+        os.makedirs(os.path.join(db_path, "sync"))
+
+        self.config_file = os.path.join(db_path, "pacman.conf")
+        with open(self.config_file, "wt", encoding="utf-8") as file:
+            file.write("[options]\nHoldPkg = pacman\n\n[core]\nInclude = x\n\n"
+                       "# [testing]\n[extra]\n[missing]\n")
+
+        _write_db(
+            os.path.join(db_path, "sync", "core.db"), {
+                "glibc-2.40-1/desc":
+                _desc(NAME=["glibc"],
+                      VERSION=["2.40-1"],
+                      PROVIDES=["libc.so=6-64"]),
+                "gcc-14.1-1/desc":
+                _desc(NAME=["gcc"], VERSION=["14.1-1"], GROUPS=["base-devel"]),
+            })
+        _write_db(
+            os.path.join(db_path, "sync", "extra.db"), {
+                "glibc-1.0-1/desc":
+                _desc(NAME=["glibc"], VERSION=["1.0-1"]),
+                "jdk-21-1/desc":
+                _desc(NAME=["jdk"], VERSION=["21-1"]),
+                "jdk-21-1/depends":
+                _desc(PROVIDES=["java-environment"], DEPENDS=["glibc"]),
+            })
+        _write_db(os.path.join(db_path, "sync", "testing.db"), {
+            "foo-1-1/desc": _desc(NAME=["foo"], VERSION=["1-1"]),
+        })
+
+        self.index = alpm.SyncDbIndex.load(self.config_file, db_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_repo_order(self):
+        self.assertEqual(alpm.read_repo_names(self.config_file),
+                         ["core", "extra", "missing"])
+
+    def test_first_repo_is_preferred(self):
+        self.assertEqual(self.index.packages["glibc"].repo, "core")
+        self.assertEqual(self.index.packages["glibc"].version, "2.40-1")
+
+    def test_unconfigured_repo_is_ignored(self):
+        self.assertNotIn("foo", self.index.packages)
+
+    def test_separate_depends_file(self):
+        self.assertEqual(self.index.packages["jdk"].depends, ["glibc"])
+        self.assertTrue(self.index.is_satisfiable("java-environment"))
+
+    def test_is_satisfiable(self):
+        self.assertTrue(self.index.is_satisfiable("gcc"))
+        self.assertTrue(self.index.is_satisfiable("base-devel"))
+        self.assertTrue(self.index.is_satisfiable("libc.so"))
+        self.assertFalse(self.index.is_satisfiable("not-a-package"))
+        self.assertFalse(self.index.is_satisfiable("not-a-package>=1"))
+
+    def test_versioned_dependencies(self):
+        self.assertTrue(self.index.is_satisfiable("glibc>=2.39"))
+        self.assertFalse(self.index.is_satisfiable("glibc<2"))
+        self.assertTrue(self.index.is_satisfiable("libc.so=6-64"))
+        self.assertFalse(self.index.is_satisfiable("libc.so>=7"))
+        self.assertFalse(self.index.is_satisfiable("java-environment>=11"))
+        self.assertFalse(self.index.is_satisfiable("base-devel>=1"))
+
+    def test_parse_dep(self):
+        self.assertEqual(alpm.parse_dep("foo>=1.2-1"), ("foo", ">=", "1.2-1"))
+        self.assertEqual(alpm.parse_dep("libfoo.so=1-64"),
+                         ("libfoo.so", "=", "1-64"))
+        self.assertEqual(alpm.parse_dep("foo"), ("foo", None, None))
+
+
+class TestLocalDb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        local = os.path.join(self.tmp.name, "local")
+        os.makedirs(local)
+        with open(os.path.join(local, "ALPM_DB_VERSION"), "wt",
+                  encoding="utf-8") as file:
+            file.write("9\n")
+
+        packages = {
+            "app-1-1": _desc(NAME=["app"], VERSION=["1-1"],
+                             DEPENDS=["libfoo>=2", "sh"],
+                             OPTDEPENDS=["extra-tool: for extra features"]),
+            "libfoo-2-1": _desc(NAME=["libfoo"], VERSION=["2-1"], REASON=["1"]),
+            "bash-5-1": _desc(NAME=["bash"], VERSION=["5-1"], REASON=["1"],
+                              PROVIDES=["sh"]),
+            "extra-tool-1-1": _desc(NAME=["extra-tool"], VERSION=["1-1"],
+                                    REASON=["1"]),
+            "leftover-1-1": _desc(NAME=["leftover"], VERSION=["1-1"],
+                                  REASON=["1"]),
+            "aur-pkg-3-1": _desc(NAME=["aur-pkg"], VERSION=["3-1"]),
+        }
+        for entry, desc in packages.items():
+            os.makedirs(os.path.join(local, entry))
+            with open(os.path.join(local, entry, "desc"), "wt",
+                      encoding="utf-8") as file:
+                file.write(desc)
+
+        self.db = alpm.LocalDb.load(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_explicitly_installed(self):
+        self.assertEqual(self.db.explicitly_installed(), ["app", "aur-pkg"])
+
+    def test_orphans(self):
+        self.assertEqual(self.db.orphans(), ["leftover"])
+
+    def test_foreign(self):
+        index = alpm.SyncDbIndex()
+        for name in ["app", "libfoo", "bash", "extra-tool", "leftover"]:
+            index.add_package(alpm.SyncPackage(name, "1-1", "core", [], [], []))
+
+        self.assertEqual([(p.name, p.version) for p in self.db.foreign(index)],
+                         [("aur-pkg", "3-1")])
+
+
+# Test cases from pacman's vercmptest.sh
+_VERCMP_CASES = [
+    ("1.5.0", "1.5.0", 0),
+    ("1.5.1", "1.5.0", 1),
+    ("1.5.1", "1.5", 1),
+    ("1.5.0-1", "1.5.0-1", 0),
+    ("1.5.0-1", "1.5.0-2", -1),
+    ("1.5.0-1", "1.5.1-1", -1),
+    ("1.5.0-2", "1.5.1-1", -1),
+    ("1.5-1", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-2", -1),
+    ("1.5", "1.5-1", 0),
+    ("1.5-1", "1.5", 0),
+    ("1.1-1", "1.1", 0),
+    ("1.0-1", "1.1", -1),
+    ("1.1-1", "1.0", 1),
+    ("1.5b-1", "1.5-1", -1),
+    ("1.5b", "1.5", -1),
+    ("1.5b-1", "1.5", -1),
+    ("1.5b", "1.5.1", -1),
+    ("1.0a", "1.0alpha", -1),
+    ("1.0alpha", "1.0b", -1),
+    ("1.0b", "1.0beta", -1),
+    ("1.0beta", "1.0rc", -1),
+    ("1.0rc", "1.0", -1),
+    ("1.5.a", "1.5", 1),
+    ("1.5.b", "1.5.a", 1),
+    ("1.5.1", "1.5.b", 1),
+    ("1.5.b-1", "1.5.b", 0),
+    ("1.5-1", "1.5.b", -1),
+    ("2.0", "2_0", 0),
+    ("2.0_a", "2_0.a", 0),
+    ("2.0a", "2.0.a", -1),
+    ("2___a", "2_a", 1),
+    ("0:1.0", "0:1.0", 0),
+    ("0:1.0", "0:1.1", -1),
+    ("1:1.0", "0:1.0", 1),
+    ("1:1.0", "0:1.1", 1),
+    ("1:1.0", "2:1.1", -1),
+    ("1:1.0", "0:1.0-1", 1),
+    ("1:1.0-1", "0:1.1-1", 1),
+    ("0:1.0", "1.0", 0),
+    ("0:1.0", "1.1", -1),
+    ("0:1.1", "1.0", 1),
+    ("1:1.0", "1.0", 1),
+    ("1:1.0", "1.1", 1),
+    ("1:1.1", "1.1", 1),
+]
+
+
+class TestReadPackageFile(unittest.TestCase):
+
+    PKGINFO = "# Generated by makepkg\npkgname = foo-bar\npkgver = 1:2.0-1\narch = x86_64\n"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compressions(self):
+        for ext, mode in [("gz", "w:gz"), ("xz", "w:xz"), ("bz2", "w:bz2")]:
+            path = os.path.join(self.tmp.name, f"foo-bar-1:2.0-1-x86_64.pkg.tar.{ext}")
+            _write_pkg(path, mode, self.PKGINFO)
+
+            pkg = alpm.read_package_file(path)
+            self.assertEqual((pkg.name, pkg.version, pkg.arch), ("foo-bar", "1:2.0-1", "x86_64"))
+
+    @unittest.skipIf(shutil.which("zstd") is None, "zstd is not installed")
+    def test_zstd(self):
+        tar_path = os.path.join(self.tmp.name, "pkg.tar")
+        _write_pkg(tar_path, "w", self.PKGINFO)
+        subprocess.run(["zstd", "-q", "--rm", tar_path], check=True)
+
+        pkg = alpm.read_package_file(f"{tar_path}.zst")
+        self.assertEqual((pkg.name, pkg.version), ("foo-bar", "1:2.0-1"))
+
+    def test_missing_pkginfo(self):
+        path = os.path.join(self.tmp.name, "broken.pkg.tar.gz")
+        _write_pkg(path, "w:gz", "")
+
+        with self.assertRaises(OSError):
+            alpm.read_package_file(path)
+
+
+def _random_version(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        parts.append(rng.choice(["0", "1", "2", "01", "10", "a", "b", "rc", "alpha", "1a", "r3"]))
+        parts.append(rng.choice([".", ".", "_", "+", "..", "-"]))
+    version = "".join(parts[:-1])
+    if rng.random() < 0.2:
+        version = f"{rng.randint(0, 2)}:{version}"
+    if rng.random() < 0.5:
+        version = f"{version}-{rng.randint(1, 3)}"
+    return version
+
+
+class TestVercmp(unittest.TestCase):
+
+    def test_known_versions(self):
+        for a, b, expected in _VERCMP_CASES:
+            self.assertEqual(alpm.vercmp(a, b), expected, f"{a} {b}")
+            self.assertEqual(alpm.vercmp(b, a), -expected, f"{b} {a}")
+
+    @unittest.skipIf(shutil.which("vercmp") is None, "vercmp is not installed")
+    def test_against_vercmp_binary(self):
+        rng = random.Random(0)
+        pairs = [(a, b) for a, b, _ in _VERCMP_CASES]
+        pairs += [(_random_version(rng), _random_version(rng)) for _ in range(300)]
+
+        for a, b in pairs:
+            expected = int(
+                subprocess.run(conf.commands.compare_versions(a, b),
+                               check=True,
+                               stdout=subprocess.PIPE).stdout.decode())
+            self.assertEqual(alpm.vercmp(a, b), expected, f"{a} {b}")
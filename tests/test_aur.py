@@ -0,0 +1,153 @@
+# pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
+
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import decman.error as err
+from decman.lib import aur
+
+_RESULT = {
+    "Name": "foo",
+    "PackageBase": "foo",
+    "Version": "1.0-1",
+    "Depends": ["bar"],
+    "MakeDepends": [],
+    "Popularity": 1.5,
+}
+
+
+class TestAurMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "aur-metadata.json.gz")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_entries_persist(self):
+        cache = aur.AurMetadataCache(self.path, 3600)
+        cache.put_package("foo", _RESULT)
+        cache.put_package("missing", None)
+        cache.put_providers("java-environment", ["jdk-bin", "jdk"])
+        cache.save()
+
+        cache = aur.AurMetadataCache(self.path, 3600)
+        self.assertEqual(
+            cache.get_package("foo"),
+            (True, {
+                "Name": "foo",
+                "PackageBase": "foo",
+                "Version": "1.0-1",
+                "Depends": ["bar"],
+            }),
+        )
+        self.assertEqual(cache.get_package("missing"), (True, None))
+        self.assertEqual(cache.get_package("unknown"), (False, None))
+        self.assertEqual(cache.get_providers("java-environment"),
+                         ["jdk-bin", "jdk"])
+        self.assertIsNone(cache.get_providers("unknown"))
+
+    def test_stale_entries_are_ignored(self):
+        cache = aur.AurMetadataCache(self.path, 60)
+        cache.put_package("foo", _RESULT)
+        cache._packages["foo"] = (int(time.time()) - 120, _RESULT)
+        self.assertEqual(cache.get_package("foo"), (False, None))
+
+    def test_refresh_ignores_entries(self):
+        cache = aur.AurMetadataCache(self.path, 3600)
+        cache.put_package("foo", _RESULT)
+        cache.save()
+
+        cache = aur.AurMetadataCache(self.path, 3600, refresh=True)
+        self.assertEqual(cache.get_package("foo"), (False, None))
+
+    def test_disabled_cache_is_not_written(self):
+        cache = aur.AurMetadataCache(self.path, 0)
+        cache.put_package("foo", _RESULT)
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestAurSnapshotIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dump_path = os.path.join(self.tmp.name, "packages-meta-ext-v1.json.gz")
+        self.index_path = os.path.join(self.tmp.name, "cache", "aur-snapshot.sqlite3")
+        self._write_dump([
+            _RESULT,
+            {
+                "Name": "jdk-bin",
+                "PackageBase": "jdk-bin",
+                "Version": "21-1",
+                "Provides": ["java-environment=21", "jdk"],
+            },
+            {
+                "Name": "jdk",
+                "PackageBase": "jdk",
+                "Version": "21-2",
+            },
+        ])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write_dump(self, packages):
+        with gzip.open(self.dump_path, "wt", encoding="utf-8") as file:
+            json.dump(packages, file)
+
+    def test_get_packages(self):
+        index = aur.AurSnapshotIndex(self.dump_path, self.index_path)
+        results = index.get_packages(["foo", "jdk", "missing"])
+        self.assertEqual(sorted(results), ["foo", "jdk"])
+        self.assertEqual(results["foo"]["Depends"], ["bar"])
+        self.assertNotIn("Popularity", results["foo"])
+
+    def test_find_providers(self):
+        index = aur.AurSnapshotIndex(self.dump_path, self.index_path)
+        self.assertEqual(
+            index.find_providers(["java-environment", "jdk", "missing"]), {
+                "java-environment": ["jdk-bin"],
+                "jdk": ["jdk", "jdk-bin"],
+                "missing": [],
+            })
+
+    def test_index_is_rebuilt_when_dump_changes(self):
+        aur.AurSnapshotIndex(self.dump_path, self.index_path).get_packages(["foo"])
+
+        self._write_dump([{"Name": "new", "PackageBase": "new", "Version": "1-1"}])
+        os.utime(self.dump_path, ns=(0, 0))
+
+        index = aur.AurSnapshotIndex(self.dump_path, self.index_path)
+        self.assertEqual(list(index.get_packages(["foo", "new"])), ["new"])
+
+    def test_truncated_dump_is_rejected(self):
+        with gzip.open(self.dump_path, "wt", encoding="utf-8") as file:
+            file.write(json.dumps([_RESULT, _RESULT])[:-20])
+        os.utime(self.dump_path, ns=(0, 0))
+
+        index = aur.AurSnapshotIndex(self.dump_path, self.index_path)
+        with self.assertRaises(err.UserFacingError):
+            index.get_packages(["foo"])
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def test_elements_span_chunks(self):
+        packages = [dict(_RESULT, Name=f"pkg{i}") for i in range(20)]
+        file = io.StringIO(json.dumps(packages, indent=1))
+        self.assertEqual(list(aur._iter_json_array(file, chunk_size=7)), packages)
+
+    def test_empty_array(self):
+        self.assertEqual(list(aur._iter_json_array(io.StringIO(" [ ] \n"))), [])
+
+    def test_malformed_arrays_are_rejected(self):
+        for text in ["", "{}", "[{}", "[{},]", "[{} {}]", "[1]", "[{}] x"]:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                list(aur._iter_json_array(io.StringIO(text), chunk_size=2))
@@ -1,9 +1,25 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
 
+import io
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+
+import decman.config as conf
+import decman.lib as l
 from decman.error import UserFacingError
-from decman.lib import Pacman, Store
-from decman.lib.fpm import ForeignPackageManager, DepGraph, ForeignPackage, ExtendedPackageSearch
+from decman.lib import Pacman, Store, alpm
+from decman.lib.fpm import (BuildCheckpoint, BuildChroot, BuildLog,
+                            BuildScheduler, CompilerCache, DepGraph,
+                            DevelUpstreamTracker, ExtendedPackageSearch,
+                            ForeignPackage, ForeignPackageManager,
+                            LocalRepository, PackageFileIndex, PackageInfo,
+                            PackageNameTable, ResolvedDependencies,
+                            SourceCache)
 
 
 class TestVersionComparisons(unittest.TestCase):
@@ -57,6 +73,18 @@ class TestDepGraph(unittest.TestCase):
         with self.assertRaises(UserFacingError):
             graph.add_requirement("A", "C")
 
+    def test_cycle_error_names_path(self):
+        graph = DepGraph()
+
+        graph.add_requirement("A", None)
+        graph.add_requirement("B", "A")
+        graph.add_requirement("C", "B")
+        graph.add_requirement("D", "A")
+        graph.add_requirement("C", "D")
+
+        with self.assertRaisesRegex(UserFacingError, "A -> (B|D) -> C -> A"):
+            graph.add_requirement("A", "C")
+
     def test_get_and_remove_outer_deps(self):
         graph = DepGraph()
 
@@ -104,3 +132,652 @@ class TestDepGraph(unittest.TestCase):
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [b2])
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [a])
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [])
+
+    def test_recursive_deps_are_merged(self):
+        graph = DepGraph()
+
+        graph.add_requirement("A", None)
+        graph.add_requirement("B", "A")
+        graph.add_requirement("C", "B")
+
+        graph.get_and_remove_outer_dep_pkgs()
+        graph.get_and_remove_outer_dep_pkgs()
+        a = graph.get_and_remove_outer_dep_pkgs()[0]
+
+        self.assertEqual(a.get_all_recursive_foreign_dep_pkgs(), {"B", "C"})
+        self.assertCountEqual(a.iter_all_recursive_foreign_dep_pkgs(), ["B", "C"])
+
+        standalone = ForeignPackage("A")
+        standalone.add_foreign_dependency_packages(["C", "B", "C"])
+        self.assertEqual(a, standalone)
+
+
+class TestPackageNameTable(unittest.TestCase):
+
+    def test_names_are_yielded_in_id_order(self):
+        table = PackageNameTable()
+        for i in range(100):
+            table.get_id(f"pkg-{i}")
+
+        bitset = table.to_bitset(["pkg-70", "pkg-1", "pkg-0", "pkg-64"])
+
+        self.assertEqual(list(table.iter_names(bitset)), ["pkg-0", "pkg-1", "pkg-64", "pkg-70"])
+        self.assertEqual(list(table.iter_names(0)), [])
+
+
+class FakeChrootCommands(conf.Commands):
+
+    def __init__(self):
+        self.created = 0
+        self.upgraded = 0
+        self.resolved = []
+
+    def make_chroot(self, chroot_dir, with_pkgs):
+        self.created += 1
+        return ["mkdir", "-p", chroot_dir]
+
+    def upgrade_chroot(self, chroot_dir, bind_mounts=None):
+        self.upgraded += 1
+        return ["true"]
+
+    def resolve_real_names(self, chroot_dir, pkgs):
+        self.resolved.append(pkgs)
+        return ["printf", "libfoo.so\\tfoo\\nmissing\\t\\n"]
+
+
+class TestBuildChroot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_commands = conf.commands
+        self.original_pacman_config_file = conf.pacman_config_file
+        self.original_makepkg_config_file = conf.makepkg_config_file
+
+        conf.commands = FakeChrootCommands()
+        conf.pacman_config_file = os.path.join(self.tmp.name, "pacman.conf")
+        conf.makepkg_config_file = os.path.join(self.tmp.name, "makepkg.conf")
+        with open(conf.pacman_config_file, "wt", encoding="utf-8") as file:
+            file.write("[core]\n")
+
+        self.chroot_wd_dir = os.path.join(self.tmp.name, "chroot")
+
+    def tearDown(self):
+        conf.commands = self.original_commands
+        conf.pacman_config_file = self.original_pacman_config_file
+        conf.makepkg_config_file = self.original_makepkg_config_file
+        self.tmp.cleanup()
+
+    def test_clean_chroot_is_reused(self):
+        BuildChroot(self.chroot_wd_dir, ["base"]).prepare()
+        BuildChroot(self.chroot_wd_dir, ["base"]).mark_clean()
+        BuildChroot(self.chroot_wd_dir, ["base"]).prepare()
+
+        self.assertEqual(conf.commands.created, 1)
+        self.assertEqual(conf.commands.upgraded, 1)
+
+    def test_unclean_chroot_is_recreated(self):
+        BuildChroot(self.chroot_wd_dir, ["base"]).prepare()
+        BuildChroot(self.chroot_wd_dir, ["base"]).prepare()
+
+        self.assertEqual(conf.commands.created, 2)
+
+    def test_changed_configuration_recreates_chroot(self):
+        chroot = BuildChroot(self.chroot_wd_dir, ["base"])
+        chroot.prepare()
+        chroot.mark_clean()
+
+        BuildChroot(self.chroot_wd_dir, ["base", "git"]).prepare()
+        BuildChroot(self.chroot_wd_dir, ["base", "git"]).mark_clean()
+        self.assertEqual(conf.commands.created, 2)
+
+        with open(conf.pacman_config_file, "at", encoding="utf-8") as file:
+            file.write("[extra]\n")
+        BuildChroot(self.chroot_wd_dir, ["base", "git"]).prepare()
+        self.assertEqual(conf.commands.created, 3)
+
+    def test_package_names_are_resolved_once(self):
+        original_read_pacman_databases = conf.read_pacman_databases
+        conf.read_pacman_databases = False
+        try:
+            chroot = BuildChroot(self.chroot_wd_dir, ["base"])
+            chroot.prepare()
+
+            self.assertEqual(chroot.resolve_package_names(["libfoo.so", "missing"]),
+                             {"libfoo.so": "foo", "missing": "missing"})
+            self.assertEqual(chroot.resolve_package_names(["missing"]), {"missing": "missing"})
+            self.assertEqual(conf.commands.resolved, [["libfoo.so", "missing"]])
+        finally:
+            conf.read_pacman_databases = original_read_pacman_databases
+
+
+class FakeBuilder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = []
+        self.running = 0
+        self.max_running = 0
+
+    def build_packages(self, package_base, packages, force, working_copy=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+            self.built.append(package_base)
+
+
+class TestBuildScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # app-a and app-b share the lib base, tool is independent.
+        graph = DepGraph()
+        resolved = ResolvedDependencies()
+        for name, pkgbase in [("app-a", "app-a"), ("app-b", "app-b"), ("lib", "lib"),
+                              ("lib-docs", "lib"), ("core", "core"), ("tool", "tool")]:
+            resolved.add_pkgbase_info(name, pkgbase)
+            graph.add_requirement(name, None)
+        graph.add_requirement("lib", "app-a")
+        graph.add_requirement("lib", "app-b")
+        graph.add_requirement("core", "lib")
+
+        while to_add := graph.get_and_remove_outer_dep_pkgs():
+            for pkg in to_add:
+                resolved.build_order.append(pkg.name)
+                resolved.packages[pkg.name] = pkg
+
+        self.scheduler = BuildScheduler(resolved)
+
+    def test_dependencies_and_priorities(self):
+        self.assertEqual(self.scheduler.dependencies["app-a"], {"lib", "core"})
+        self.assertEqual(self.scheduler.dependencies["lib"], {"core"})
+        self.assertEqual(self.scheduler.priorities["core"], 3)
+        self.assertEqual(self.scheduler.priorities["tool"], 1)
+
+    def test_builds_respect_dependencies(self):
+        builder = FakeBuilder()
+        self.scheduler.run(builder, False, 4)
+
+        self.assertCountEqual(builder.built, ["app-a", "app-b", "lib", "core", "tool"])
+        self.assertLess(builder.built.index("core"), builder.built.index("lib"))
+        self.assertLess(builder.built.index("lib"), builder.built.index("app-a"))
+        self.assertLess(builder.built.index("lib"), builder.built.index("app-b"))
+        self.assertGreater(builder.max_running, 1)
+
+    def test_builds_with_similar_build_deps_are_grouped(self):
+        order = self.scheduler.group_by_build_deps({
+            "core": {"cmake"}, "tool": {"cmake", "rust"}, "lib": {"meson"},
+            "app-a": {"rust", "qt6-base"}, "app-b": {"meson"},
+        })
+
+        self.assertEqual(order, ["core", "tool", "lib", "app-b", "app-a"])
+
+    def test_cached_builds_are_ordered_first(self):
+        order = self.scheduler.group_by_build_deps({"tool": {"rust"}, "app-a": {"meson", "qt6-base"}})
+
+        self.assertEqual(order, ["core", "lib", "app-b", "tool", "app-a"])
+
+
+class TestCompilerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.chroot_dir = os.path.join(self.tmp.name, "root")
+        self.cache_dir = os.path.join(self.tmp.name, "ccache")
+        self.drop_in = os.path.join(self.chroot_dir, "etc/makepkg.conf.d",
+                                    "decman-compiler-cache.conf")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_drop_in_is_written_and_removed(self):
+        CompilerCache.configure_chroot(CompilerCache("ccache", self.cache_dir),
+                                       self.chroot_dir)
+        with open(self.drop_in, "rt", encoding="utf-8") as file:
+            content = file.read()
+        self.assertIn("BUILDENV+=(ccache)", content)
+        self.assertIn(f"CCACHE_DIR='{self.cache_dir}'", content)
+
+        CompilerCache.configure_chroot(None, self.chroot_dir)
+        self.assertFalse(os.path.exists(self.drop_in))
+
+    def test_unsupported_cache_fails(self):
+        with self.assertRaises(UserFacingError):
+            CompilerCache("distcc", self.cache_dir)
+
+
+class TestSourceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = SourceCache(os.path.join(self.tmp.name, "sources"), 250)
+        self.cache.prepare()
+
+        self.pkgbuild_dir = os.path.join(self.tmp.name, "pkg")
+        os.makedirs(self.pkgbuild_dir)
+        with open(os.path.join(self.pkgbuild_dir, ".SRCINFO"), "wt", encoding="utf-8") as file:
+            file.write("pkgbase = pkg\n"
+                       "\tsource = pkg-1.0.tar.gz::https://example.com/v1.0.tar.gz\n"
+                       "\tsource = git+https://example.com/repo.git#tag=v1\n"
+                       "\tsource_x86_64 = https://example.com/bin-x86_64.zst\n"
+                       "\tsource = local.patch\n")
+
+        for i, name in enumerate(["old.tar.gz", "pkg-1.0.tar.gz", "bin-x86_64.zst"]):
+            path = os.path.join(self.cache.srcdest, name)
+            with open(path, "wb") as file:
+                file.write(b"x" * 100)
+            os.utime(path, (i, i))
+        os.makedirs(os.path.join(self.cache.srcdest, "repo"))
+        os.utime(os.path.join(self.cache.srcdest, "repo"), (0, 0))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_least_recently_used_sources_are_pruned(self):
+        self.cache.mark_used(self.pkgbuild_dir)
+
+        self.assertEqual(self.cache.prune(), (1, 100))
+        self.assertCountEqual(os.listdir(self.cache.srcdest),
+                              ["pkg-1.0.tar.gz", "bin-x86_64.zst", "repo"])
+
+    def test_prune_everything(self):
+        self.assertEqual(self.cache.prune(0), (4, 300))
+
+
+class TestDevelUpstreamTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.upstream = os.path.join(self.tmp.name, "upstream")
+        self._git("init", "-q", "-b", "main", self.upstream)
+        self._commit()
+
+        self.pkgbuild_dir = os.path.join(self.tmp.name, "pkg")
+        os.makedirs(self.pkgbuild_dir)
+        with open(os.path.join(self.pkgbuild_dir, ".SRCINFO"), "wt", encoding="utf-8") as file:
+            file.write("pkgbase = pkg-git\n"
+                       f"\tsource = pkg::git+file://{self.upstream}#branch=main\n"
+                       f"\tsource = git+file://{self.upstream}#commit=abc\n"
+                       "\tsource = local.patch\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _git(self, *args):
+        return subprocess.run(["git", *args], check=True, capture_output=True).stdout.decode()
+
+    def _commit(self):
+        self._git("-C", self.upstream, "-c", "user.name=t", "-c", "user.email=t@t",
+                  "commit", "-q", "--allow-empty", "-m", "commit")
+        return self._git("-C", self.upstream, "rev-parse", "HEAD").strip()
+
+    def test_unchanged_upstream_is_detected(self):
+        store = Store()
+        tracker = DevelUpstreamTracker(store)
+        self.assertTrue(tracker.has_upstream_changed("pkg-git"))
+
+        commits = tracker.get_upstream_commits(self.pkgbuild_dir)
+        head = self._git("-C", self.upstream, "rev-parse", "HEAD").strip()
+        self.assertEqual(commits, {f"file://{self.upstream}#refs/heads/main": head})
+        tracker.record("pkg-git", commits)
+
+        self.assertFalse(DevelUpstreamTracker(store).has_upstream_changed("pkg-git"))
+        self._commit()
+        self.assertTrue(DevelUpstreamTracker(store).has_upstream_changed("pkg-git"))
+
+    def test_other_vcs_sources_are_not_tracked(self):
+        with open(os.path.join(self.pkgbuild_dir, ".SRCINFO"), "at", encoding="utf-8") as file:
+            file.write("\tsource = hg+https://example.com/repo\n")
+
+        self.assertIsNone(DevelUpstreamTracker(Store()).get_upstream_commits(self.pkgbuild_dir))
+
+
+class TestBuildKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = Store()
+        self.files = []
+        for version in ["1.0-1", "1.1-1"]:
+            path = os.path.join(self.tmp.name, f"pkg-{version}-any.pkg.tar.zst")
+            with open(path, "wb") as file:
+                file.write(version.encode())
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_build_key_belongs_to_latest_file(self):
+        self.store.add_package_to_cache("pkg", "1.0-1", self.files[0])
+        self.assertIsNone(self.store.get_build_key("pkg"))
+
+        self.store.set_build_key("pkg", "key", self.files[0], "sha")
+        self.assertEqual(self.store.get_build_key("pkg"), ("key", "sha"))
+
+        os.remove(self.files[0])
+        self.store.add_package_to_cache("pkg", "1.1-1", self.files[1])
+        self.assertIsNone(self.store.get_build_key("pkg"))
+
+
+class FakeRepoCommands(conf.Commands):
+
+    def __init__(self):
+        self.added = []
+
+    def repo_add(self, db_path, pkg_files):
+        self.added += pkg_files
+        return ["true"]
+
+
+class TestLocalRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_commands = conf.commands
+        conf.commands = FakeRepoCommands()
+        self.repo = LocalRepository(os.path.join(self.tmp.name, "cache"), "decman")
+
+        self.chroot_dir = os.path.join(self.tmp.name, "root")
+        os.makedirs(os.path.join(self.chroot_dir, "etc"))
+        with open(os.path.join(self.chroot_dir, "etc/pacman.conf"), "wt",
+                  encoding="utf-8") as file:
+            file.write("[options]\n\n[core]\nInclude = /etc/pacman.d/mirrorlist\n")
+
+    def tearDown(self):
+        conf.commands = self.original_commands
+        self.tmp.cleanup()
+
+    def _read_pacman_conf(self):
+        with open(os.path.join(self.chroot_dir, "etc/pacman.conf"), "rt",
+                  encoding="utf-8") as file:
+            return file.read()
+
+    def test_repository_section_is_added_once_and_removed(self):
+        original = self._read_pacman_conf()
+
+        LocalRepository.configure_chroot(self.repo, self.chroot_dir)
+        LocalRepository.configure_chroot(self.repo, self.chroot_dir)
+        content = self._read_pacman_conf()
+        self.assertEqual(content.count("[decman]"), 1)
+        self.assertIn(f"Server = file://{self.repo.directory}\n", content)
+
+        LocalRepository.configure_chroot(None, self.chroot_dir)
+        self.assertEqual(self._read_pacman_conf(), original)
+
+    def test_empty_database_is_created(self):
+        self.repo.ensure_database()
+        self.repo.ensure_database()
+
+        index = alpm.SyncDbIndex()
+        index.add_db("decman", os.path.join(self.repo.directory, "decman.db"))
+        self.assertEqual(index.packages, {})
+
+    def test_chroot_is_synced_from_concurrent_threads(self):
+        self.repo.ensure_database()
+        sync_dir = os.path.join(self.chroot_dir, "var/lib/pacman/sync")
+        os.makedirs(sync_dir)
+
+        errors = []
+
+        def sync():
+            try:
+                for _ in range(50):
+                    self.repo.sync_chroot(self.chroot_dir)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=sync) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(sync_dir), ["decman.db"])
+        with open(self.repo.db_path, "rb") as expected, \
+                open(os.path.join(sync_dir, "decman.db"), "rb") as actual:
+            self.assertEqual(actual.read(), expected.read())
+
+    def test_missing_packages_are_added(self):
+        self.repo.add_missing([("foo", "1.0-1", "/cache/foo-1.0-1-any.pkg.tar.zst")])
+
+        self.assertEqual(conf.commands.added, ["/cache/foo-1.0-1-any.pkg.tar.zst"])
+
+
+class TestPackageFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_file = os.path.join(self.tmp.name, "index.json")
+        # The file names of foo and foo-bar share the prefix 'foo-bar-1'.
+        self.files = {"foo": os.path.join(self.tmp.name, "foo-bar-1-1-any.pkg.tar.gz"),
+                      "foo-bar": os.path.join(self.tmp.name, "foo-bar-1-1-any.pkg.tar")}
+        for name, path in self.files.items():
+            with tarfile.open(path, "w:gz" if path.endswith(".gz") else "w") as archive:
+                data = f"pkgname = {name}\npkgver = {'bar-1-1' if name == 'foo' else '1-1'}\n"
+                info = tarfile.TarInfo(".PKGINFO")
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data.encode()))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_files_are_found_by_package_name(self):
+        index = PackageFileIndex(self.tmp.name, self.index_file)
+        index.refresh()
+
+        self.assertEqual([pkg.path for pkg in index.find("foo")], [self.files["foo"]])
+        self.assertEqual([pkg.path for pkg in index.find("foo-bar")], [self.files["foo-bar"]])
+        index.save()
+
+        reloaded = PackageFileIndex(self.tmp.name, self.index_file)
+        self.assertEqual(reloaded.get(self.files["foo"]).version, "bar-1-1")
+
+        os.remove(self.files["foo"])
+        reloaded.refresh()
+        self.assertEqual(reloaded.find("foo"), [])
+        self.assertIsInstance(reloaded.get(self.files["foo-bar"]), alpm.PackageFile)
+
+
+class FakeSearch:
+
+    def __init__(self, versions):
+        self.versions = versions
+
+    def get_package_info(self, name):
+        return PackageInfo(name, name, self.versions[name], [], [], [], [], "", None)
+
+
+class CountingStore(Store):
+
+    def __init__(self):
+        super().__init__()
+        self.saved = 0
+
+    def save(self):
+        self.saved += 1
+
+
+class TestBuildCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = CountingStore()
+        self.resolved = ResolvedDependencies()
+        self.resolved.foreign_pkgs.add("app")
+        self.resolved.build_order = ["lib", "app"]
+        self.search = FakeSearch({"app": "1-1", "lib": "2-1"})
+
+        self.file = os.path.join(self.tmp.name, "lib-2-1-any.pkg.tar.zst")
+        with open(self.file, "wb"):
+            pass
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_built_pkgbases_are_resumed(self):
+        checkpoint = BuildCheckpoint(self.store, self.search, self.resolved)
+        checkpoint.load(False)
+        checkpoint.start()
+        checkpoint.mark_built("lib", [self.file])
+        self.assertEqual(self.store.saved, 1)
+        self.assertFalse(checkpoint.is_built("lib"))
+
+        resumed = BuildCheckpoint(self.store, self.search, self.resolved)
+        resumed.load(True)
+        resumed.start()
+        self.assertTrue(resumed.is_built("lib"))
+        self.assertFalse(resumed.is_built("app"))
+
+        resumed.finish()
+        self.assertEqual(self.store.build_checkpoints, {})
+
+    def test_checkpoints_are_kept_until_started(self):
+        checkpoint = BuildCheckpoint(self.store, self.search, self.resolved)
+        checkpoint.load(False)
+        checkpoint.start()
+        checkpoint.mark_built("lib", [self.file])
+
+        self.search.versions["app"] = "1-2"
+        other = BuildCheckpoint(self.store, self.search, self.resolved)
+        other.load(False)
+        self.assertIn(checkpoint.plan, self.store.build_checkpoints)
+
+        other.start()
+        self.assertEqual(list(self.store.build_checkpoints), [other.plan])
+
+    def test_changed_plan_is_not_resumed(self):
+        checkpoint = BuildCheckpoint(self.store, self.search, self.resolved)
+        checkpoint.load(False)
+        checkpoint.start()
+        checkpoint.mark_built("lib", [self.file])
+
+        self.search.versions["lib"] = "2-2"
+        resumed = BuildCheckpoint(self.store, self.search, self.resolved)
+        resumed.load(True)
+        resumed.start()
+        self.assertFalse(resumed.is_built("lib"))
+
+
+class TestBuildLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.logs_kept = conf.build_logs_kept
+
+    def tearDown(self):
+        conf.build_logs_kept = self.logs_kept
+        self.tmp.cleanup()
+
+    def test_output_is_written_to_log_and_tail_kept(self):
+        build_log = BuildLog(self.tmp.name, "pkg", tail_lines=3)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            build_log.run(["sh", "-c", "seq 1 1000; echo failed >&2; exit 2"])
+
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertEqual(cm.exception.output, "999\n1000\nfailed\n")
+        with open(build_log.path, encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        self.assertEqual(len(lines), 1001)
+        self.assertEqual(lines[-1], "failed")
+
+    def test_builds_started_in_the_same_second_get_own_logs(self):
+        first = BuildLog(self.tmp.name, "pkg")
+        second = BuildLog(self.tmp.name, "pkg")
+        first.run(["echo", "first"])
+        second.run(["echo", "second"])
+
+        self.assertNotEqual(first.path, second.path)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, "pkg"))), 2)
+
+    def test_old_logs_are_removed(self):
+        conf.build_logs_kept = 2
+        log_dir = os.path.join(self.tmp.name, "pkg")
+        os.makedirs(log_dir)
+        for name in ["20200101-000000.log", "20210101-000000.log"]:
+            with open(os.path.join(log_dir, name), "w", encoding="utf-8"):
+                pass
+
+        build_log = BuildLog(self.tmp.name, "pkg")
+        build_log.run(["true"])
+
+        self.assertEqual(
+            sorted(os.listdir(log_dir)),
+            ["20210101-000000.log", os.path.basename(build_log.path)],
+        )
+
+
+class TestResourceAccounting(unittest.TestCase):
+
+    def setUp(self):
+        self.resource_usage = l.resource_usage
+        self.history_size = conf.resource_usage_history_size
+        l.resource_usage = l.ResourceAccounting()
+
+    def tearDown(self):
+        l.resource_usage = self.resource_usage
+        conf.resource_usage_history_size = self.history_size
+
+    def test_usage_is_recorded_per_command_and_pkgbase(self):
+        result = l.run_command(["sh", "-c", "echo out; echo err >&2"], capture_output=True)
+        self.assertEqual((result.stdout, result.stderr), (b"out\n", b"err\n"))
+
+        with l.resource_usage.attribute_to("pkg"), \
+                self.assertRaises(subprocess.CalledProcessError) as cm:
+            l.run_command(["sh", "-c", "exit 3"], check=True)
+        self.assertEqual(cm.exception.returncode, 3)
+
+        self.assertEqual(l.resource_usage.commands["sh"].processes, 2)
+        self.assertGreater(l.resource_usage.commands["sh"].max_rss, 0)
+        self.assertEqual(l.resource_usage.pkgbases["pkg"].processes, 1)
+
+    def test_timed_out_command_is_killed_and_reaped(self):
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            l.run_command(["sleep", "10"], capture_output=True, timeout=0.2)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(l.resource_usage.commands["sleep"].processes, 1)
+
+    def test_history_is_trimmed(self):
+        conf.resource_usage_history_size = 2
+        store = Store()
+        store.add_resource_usage(l.resource_usage)
+        self.assertEqual(store.resource_usage_history, [])
+
+        for i in range(3):
+            l.resource_usage.record(["cmd"], l.ResourceUsage(wall_time=i, processes=1))
+            store.add_resource_usage(l.resource_usage)
+
+        self.assertEqual(len(store.resource_usage_history), 2)
+        self.assertEqual(store.resource_usage_history[-1]["commands"]["cmd"]["processes"], 3)
+
+
+class FakeSystemdCommands(conf.Commands):
+
+    def enable_units(self, units):
+        return ["true"]
+
+    def disable_units(self, units):
+        return ["false"]
+
+
+class TestSystemd(unittest.TestCase):
+
+    def setUp(self):
+        self.original_commands = conf.commands
+        conf.commands = FakeSystemdCommands()
+        self.store = Store()
+        self.systemd = l.Systemd(self.store)
+
+    def tearDown(self):
+        conf.commands = self.original_commands
+
+    def test_enabled_units_are_stored(self):
+        self.systemd.enable_units(["foo.service"])
+        self.assertEqual(self.store.enabled_systemd_units, ["foo.service"])
+
+    def test_failed_command_raises(self):
+        with self.assertRaises(UserFacingError):
+            self.systemd.disable_units(["foo.service"])